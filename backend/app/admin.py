@@ -0,0 +1,97 @@
+import os
+from functools import wraps
+
+import app.db as db
+from app.bulk_import import IMPORT_BATCH_SIZE, import_users
+from app.export import export_ndjson, user_summary
+from app.profiling import profiler
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask_login import current_user, login_required
+
+# Comma-separated user ids allowed to use the /admin endpoints
+ADMIN_USERS = {u for u in os.getenv("ADMIN_USERS", "").split(",") if u}
+# default and max `limit` of GET /admin/users
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# settings of POST /admin/profiling (the directory is not changed over HTTP)
+PROFILING_SETTINGS = {
+    "enabled",
+    "mode",
+    "sample_rate",
+    "endpoints",
+    "token",
+    "max_bytes",
+    "stack_interval",
+    "stack_flush_seconds",
+}
+
+bp = Blueprint("admin", __name__)
+
+
+# login_required, and the logged-in user must be one of ADMIN_USERS
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if current_user.id not in ADMIN_USERS:
+            return jsonify({"error": "forbidden"}), 403
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+# Bulk import of users from an NDJSON request body (one user per line).
+# The body is read and validated line by line; see bulk_import.import_users.
+@bp.route("/admin/users/import", methods=["POST"])
+@admin_required
+def import_users_endpoint():
+    batch_size = request.args.get("batch_size", IMPORT_BATCH_SIZE, type=int)
+    if batch_size < 1:
+        return jsonify({"error": "batch_size must be positive"}), 400
+
+    report = import_users(request.stream, batch_size)
+    return jsonify(report.to_dict())
+
+
+# Keyset-paginated listing in user_id order: GET /admin/users?after=<user_id>&limit=N
+# `next` is the `after` of the next page (null on the last page).
+@bp.route("/admin/users", methods=["GET"])
+@admin_required
+def list_users():
+    after = request.args.get("after") or None
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+    users = [user_summary(u, user) for u, user in db.store.list_users(after, limit)]
+    next_after = users[-1]["username"] if len(users) == limit else None
+    return jsonify({"users": users, "next": next_after})
+
+
+# Every user as NDJSON, streamed with chunked transfer encoding
+@bp.route("/admin/users/export", methods=["GET"])
+@admin_required
+def export_users():
+    return Response(
+        stream_with_context(export_ndjson()), mimetype="application/x-ndjson"
+    )
+
+
+# Profiling of this worker process (see profiling.Profiler).
+# GET returns the settings; POST changes those given in the JSON body, e.g.
+# {"enabled": true, "mode": "stacks", "sample_rate": 0.01, "endpoints": ["/login"]}
+@bp.route("/admin/profiling", methods=["GET", "POST"])
+@admin_required
+def profiling():
+    if request.method == "POST":
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            return jsonify({"error": "a JSON object is required"}), 400
+        unknown = set(changes) - PROFILING_SETTINGS
+        if unknown:
+            return jsonify({"error": f"unknown settings: {', '.join(sorted(unknown))}"}), 400
+        try:
+            profiler.update(**changes)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify({**profiler.config.to_dict(), "stats": profiler.stats()})
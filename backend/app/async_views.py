@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Any, Callable, Optional
+
+from app import challenges, metrics, passkey_auth, passkey_reg
+from app.hashing import HashingOverloaded, hasher
+from app.password_upgrades import upgrader
+from app.users import User
+from quart import Blueprint, Response, abort, g, jsonify, request, session
+
+# The routes and JSON contracts of login.py, users.py, passkey_auth.py and
+# passkey_reg.py as async (Quart) views, served by asgi.py.
+#
+# A request waiting on the network costs a coroutine, not a thread. The
+# blocking parts run on thread pools so the event loop never waits for them:
+# password hashing and signature verification (CPU) on ASYNC_CPU_THREADS
+# threads, user store and challenge store calls (I/O) on ASYNC_IO_THREADS.
+# ASYNC_CPU_THREADS is the number of CPUs if empty or unset.
+ASYNC_CPU_THREADS = int(os.getenv("ASYNC_CPU_THREADS") or os.cpu_count() or 1)
+ASYNC_IO_THREADS = int(os.getenv("ASYNC_IO_THREADS", "32"))
+
+_cpu = ThreadPoolExecutor(ASYNC_CPU_THREADS, thread_name_prefix="async-cpu")
+_io = ThreadPoolExecutor(ASYNC_IO_THREADS, thread_name_prefix="async-io")
+
+bp = Blueprint("async_auth", __name__)
+
+
+async def run_cpu(fn: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_cpu, partial(fn, *args))
+
+
+async def run_io(fn: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_io, partial(fn, *args))
+
+
+def shutdown() -> None:
+    _cpu.shutdown()
+    _io.shutdown()
+
+
+# Sessions as flask_login keeps them (same keys and session identifier), so
+# that a session cookie is valid in both serving modes.
+# flask_login computes the identifier (utils._create_identifier, private) from
+# Flask's request only, so it can't be called here: this is a copy of it, down
+# to hashing the repr of the bytes, which must be kept in sync with the
+# flask_login version in use (test_session_identifier_matches_flask_login).
+def _session_identifier() -> str:
+    address: Optional[bytes] = None
+    forwarded = request.headers.get("X-Forwarded-For", request.remote_addr)
+    if forwarded is not None:
+        address = forwarded.encode("utf-8").split(b",")[0].strip()
+    agent = request.headers.get("User-Agent")
+    user_agent = None if agent is None else agent.encode("utf-8")
+    return hashlib.sha512(f"{address!r}|{user_agent!r}".encode("utf8")).hexdigest()
+
+
+def login_user(user: User) -> None:
+    session["_user_id"] = user.get_id()
+    session["_fresh"] = True
+    session["_id"] = _session_identifier()
+    g.user = user
+
+
+def logout_user() -> None:
+    for key in ("_user_id", "_fresh", "_id"):
+        session.pop(key, None)
+    g.user = None
+
+
+# The logged-in user (flask_login's current_user), loaded once per request
+async def current_user() -> Optional[User]:
+    if "user" not in g:
+        # session protection "basic": a session from elsewhere is no longer fresh
+        if session and session.get("_id") != _session_identifier():
+            if session.get("_fresh") is not False:
+                session["_fresh"] = False
+        user_id = session.get("_user_id")
+        g.user = await run_io(User.get_by_id, user_id) if user_id else None
+    return g.user
+
+
+def login_required(view):
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        if await current_user() is None:
+            abort(401)
+        return await view(*args, **kwargs)
+
+    return wrapper
+
+
+# POST bodies as in the Flask views: form fields, else JSON
+async def _field(name: str) -> Optional[str]:
+    form = await request.form
+    if form.get(name):
+        return form.get(name)
+    data = await request.get_json(silent=True)
+    return data.get(name) if isinstance(data, dict) else None
+
+
+@bp.route("/login", methods=["POST"])
+async def login():
+    username = await _field("username")
+    password = await _field("password")
+
+    user = await run_io(User.get_by_id, username)
+
+    try:
+        if user is None:
+            verified = await run_cpu(hasher.check_dummy, password or "")
+        else:
+            verified = await run_cpu(hasher.check, user.password, password)
+    except HashingOverloaded:
+        return jsonify({"error": "server busy"}), 503, {"Retry-After": "1"}
+
+    if not verified:
+        return jsonify({"error": "Incorrect username or password."}), 400
+
+    await run_cpu(upgrader.upgrade, user.id, user.password, password)
+    login_user(user)
+    return jsonify({"status": "logged_in", "username": username})
+
+
+@bp.route("/logout", methods=["POST"])
+async def logout():
+    logout_user()
+    return jsonify({"status": "logged_out"})
+
+
+@bp.route("/users", methods=["POST"])
+async def create_user():
+    # as Flask's request.json: 415 unless the body is JSON, 400 if it's malformed
+    if not request.is_json:
+        abort(415)
+    data = await request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "username and password required"}), 400
+    username = data.get("username")
+    password = data.get("password")
+
+    if not username or not password:
+        return jsonify({"error": "username and password required"}), 400
+
+    if await run_io(User.get_by_id, username):
+        return jsonify({"error": "user already exists"}), 400
+
+    try:
+        user = User(username, await run_cpu(hasher.generate, password))
+    except HashingOverloaded:
+        return jsonify({"error": "server busy"}), 503, {"Retry-After": "1"}
+    await run_io(user.create)
+
+    return jsonify({"status": "created", "username": username})
+
+
+@bp.route("/users/me", methods=["GET"])
+@login_required
+async def get_me():
+    user = await current_user()
+    return jsonify({"username": user.id})
+
+
+@bp.route("/generate-registration-options", methods=["GET"])
+@login_required
+async def register_options():
+    user = await current_user()
+
+    try:
+        data, challenge = await run_io(passkey_reg.registration_options, user)
+        # only the handle of the challenge goes into the (cookie) session
+        session["challenge"] = await run_io(challenges.store.put, challenge)
+        return jsonify(data)
+    except Exception as e:
+        print("error: with", e)
+        return jsonify({"status": "failed", "error": str(e)}), 400
+
+
+@bp.route("/verify-registration", methods=["POST"])
+@login_required
+async def register_verify():
+    user = await current_user()
+    body = await request.get_json()
+
+    # one-shot: the challenge can't be used again whatever the result
+    challenge = await run_io(challenges.store.pop, session.pop("challenge", None))
+    if challenge is None:
+        return jsonify({"status": "failed", "error": "challenge expired or missing"}), 400
+
+    try:
+        v = await run_cpu(passkey_reg.verify_registration, body, challenge)
+        await run_io(passkey_reg.store_credential, user, body, v)
+        return jsonify({"status": "ok", "verified": v.user_verified})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"status": "failed", "error": str(e)}), 400
+
+
+@bp.route("/generate-authentication-options", methods=["GET"])
+async def authenticate_options():
+    username = request.args.get("username") or None
+    try:
+        data, challenge = await run_io(passkey_auth.authentication_options, username)
+        # only the handle of the challenge goes into the (cookie) session
+        session["challenge"] = await run_io(challenges.store.put, challenge)
+        session["challenge_user"] = username
+        return jsonify(data)
+    except Exception as e:
+        print("error: with", e)
+        return jsonify({"status": "failed", "error": str(e)}), 400
+
+
+@bp.route("/verify-authentication", methods=["POST"])
+async def authenticate_verify():
+    body = await request.get_json()
+
+    # one-shot: the challenge can't be used again whatever the result, even
+    # for an unknown credential
+    challenge_user = session.pop("challenge_user", None)
+    challenge = await run_io(challenges.store.pop, session.pop("challenge", None))
+
+    # Doesn't disclose whether user (or credential) exists for security reasons
+    owner = await run_io(
+        passkey_auth.credential_owner,
+        body["id"],
+        challenge_user,
+        passkey_auth.user_handle_of(body),
+    )
+    if owner is None:
+        return jsonify({"error": "No credential for user with this site"}), 404
+    user, public_key = owner
+
+    if challenge is None:
+        return jsonify({"status": "failed", "error": "challenge expired or missing"}), 400
+
+    try:
+        v = await run_cpu(passkey_auth.verify_assertion, user, public_key, body, challenge)
+        session.clear()
+        login_user(user)
+        return jsonify({"status": "ok", "verified": v.user_verified})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"status": "failed", "error": str(e)}), 400
+
+
+# Same request metrics as metrics.init_app, and /metrics
+@bp.route("/metrics", methods=["GET"])
+async def metrics_endpoint():
+    return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.before_app_request
+async def _start_timer() -> None:
+    g.metrics_started = time.perf_counter()
+
+
+@bp.after_app_request
+async def _record(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        rule = request.url_rule
+        endpoint = rule.rule if rule is not None else "unmatched"
+        metrics.request_seconds.observe(time.perf_counter() - started, endpoint)
+        metrics.requests_total.inc(endpoint, request.method, str(response.status_code))
+    return response
@@ -0,0 +1,171 @@
+import json
+import os
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+import app.db as db
+from app.hashing import HashingOverloaded, hasher
+from app.model import Credential, StoredUser, b64encode_no_pad
+
+# Users inserted (and committed) at once by a bulk import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+# Longest wait between retries of a hash while the hashing queue is full
+IMPORT_HASH_MAX_BACKOFF_SECONDS = 1.0
+
+
+# A row which was not imported (line numbers start at 1)
+class RowError(NamedTuple):
+    line: int
+    error: str
+
+
+class ImportReport:
+    def __init__(self) -> None:
+        self.rows = 0
+        self.imported = 0
+        self.batches = 0
+        self.errors: List[RowError] = []
+
+    def to_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "batches": self.batches,
+            "errors": [error._asdict() for error in self.errors],
+        }
+
+
+# A validated row; `password` is a hash if `hashed`, else a plaintext
+class ImportRow(NamedTuple):
+    user_id: str
+    password: str
+    hashed: bool
+    credentials: Tuple[Credential, ...]
+
+
+# werkzeug hashes are "<method>$<salt>$<hash>"
+def is_password_hash(value: str) -> bool:
+    parts = value.split("$")
+    return len(parts) == 3 and all(parts)
+
+
+# Parse one NDJSON row:
+#   {"username": ..., "password": <plaintext>}  or  {"username": ..., "password_hash": ...}
+#   optionally with "credentials": [<credential as in userdb.json>, ...]
+def parse_row(line: Union[str, bytes]) -> ImportRow:
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError("row must be a JSON object")
+
+    username = row.get("username")
+    if not isinstance(username, str) or not username:
+        raise ValueError("username required")
+
+    password, password_hash = row.get("password"), row.get("password_hash")
+    if (password is None) == (password_hash is None):
+        raise ValueError("exactly one of password and password_hash required")
+    secret: str
+    if password_hash is not None:
+        if not isinstance(password_hash, str) or not is_password_hash(password_hash):
+            raise ValueError("password_hash is not a password hash")
+        secret, hashed = password_hash, True
+    else:
+        if not isinstance(password, str) or not password:
+            raise ValueError("password must be a non-empty string")
+        secret, hashed = password, False
+
+    records = row.get("credentials", [])
+    if not isinstance(records, list):
+        raise ValueError("credentials must be a list")
+    credentials = []
+    for n, record in enumerate(records):
+        try:
+            credentials.append(Credential.from_dict(record))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"invalid credential {n}: {e!r}")
+
+    return ImportRow(username, secret, hashed, tuple(credentials))
+
+
+# Hash a plaintext password of an imported row. A full hashing queue means
+# logins are busy, not that the row is bad: back off (doubling the wait up to
+# IMPORT_HASH_MAX_BACKOFF_SECONDS) and retry until it is admitted.
+def hash_password(password: str) -> str:
+    delay = 0.01
+    while True:
+        try:
+            return hasher.generate(password)
+        except HashingOverloaded:
+            time.sleep(delay)
+            delay = min(delay * 2, IMPORT_HASH_MAX_BACKOFF_SECONDS)
+
+
+# Import users from NDJSON lines into db.store.
+# Rows are validated one by one as they are read and inserted in batches of
+# `batch_size`, each committed with one store write. A bad row is reported
+# in the returned report and skipped; it does not abort the import.
+# `progress` is called with the report after every batch.
+def import_users(
+    lines: Iterable[Union[str, bytes]],
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[ImportReport], None]] = None,
+) -> ImportReport:
+    report = ImportReport()
+    batch: Dict[str, StoredUser] = {}
+    batch_lines: Dict[str, int] = {}
+    batch_credentials: Set[bytes] = set()
+
+    def commit() -> None:
+        try:
+            db.store.add_users(batch)
+            report.imported += len(batch)
+        except ValueError:
+            # someone else added one of the users since it was checked:
+            # insert the rows one by one to find out which
+            for user_id, user in batch.items():
+                try:
+                    db.store.add_users({user_id: user})
+                    report.imported += 1
+                except ValueError as e:
+                    report.errors.append(RowError(batch_lines[user_id], str(e)))
+        report.batches += 1
+        batch.clear()
+        batch_lines.clear()
+        batch_credentials.clear()
+        if progress is not None:
+            progress(report)
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        report.rows += 1
+        try:
+            row = parse_row(line)
+            if row.user_id in batch or db.store.get_user(row.user_id) is not None:
+                raise ValueError(f"user '{row.user_id}' already exists")
+            row_credentials: Set[bytes] = set()
+            for cred in row.credentials:
+                if (
+                    cred.credential_id in row_credentials
+                    or cred.credential_id in batch_credentials
+                    or db.store.find_by_credential(b64encode_no_pad(cred.credential_id))
+                ):
+                    raise ValueError(
+                        f"credential '{b64encode_no_pad(cred.credential_id)}' already exists"
+                    )
+                row_credentials.add(cred.credential_id)
+            # hash last: it is by far the most expensive step
+            password = row.password if row.hashed else hash_password(row.password)
+        except ValueError as e:
+            report.errors.append(RowError(number, str(e)))
+            continue
+
+        batch[row.user_id] = StoredUser(password=password, credentials=row.credentials)
+        batch_lines[row.user_id] = number
+        batch_credentials.update(row_credentials)
+        if len(batch) >= batch_size:
+            commit()
+
+    if batch:
+        commit()
+    return report
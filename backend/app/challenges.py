@@ -0,0 +1,201 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Protocol, Tuple
+
+# "memory" (per process) or "sqlite" (shared by processes on one host)
+CHALLENGE_STORE = os.getenv("CHALLENGE_STORE", "memory")
+CHALLENGE_TTL_SECONDS = float(os.getenv("CHALLENGE_TTL_SECONDS", "300"))
+CHALLENGE_MAX_ENTRIES = int(os.getenv("CHALLENGE_MAX_ENTRIES", "100000"))
+CHALLENGE_SQLITE_FILE = os.getenv("CHALLENGE_SQLITE_FILE", "challenges.sqlite3")
+
+
+# Server-side store of WebAuthn challenges.
+# The options endpoints keep only the opaque handle returned by `put` in the
+# session, and the verify endpoints `pop` the challenge with it. `pop` is
+# one-shot: a challenge is returned at most once, and never after it expired.
+class ChallengeStore(Protocol):
+    def put(self, challenge: bytes) -> str: ...
+
+    def pop(self, handle: Optional[str]) -> Optional[bytes]: ...
+
+    def metrics(self) -> Dict[str, int]: ...
+
+
+def new_handle() -> str:
+    return secrets.token_urlsafe(16)
+
+
+# In-process store.
+# All entries share one TTL, so insertion order is also expiry order: expired
+# entries are purged from the front, and when full the oldest one is evicted.
+class MemoryChallengeStore:
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.consumed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    # Must be called while holding self._lock
+    def _purge(self, now: float) -> None:
+        while self._entries:
+            handle, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[handle]
+            self.expired += 1
+
+    def put(self, challenge: bytes) -> str:
+        handle = new_handle()
+        with self._lock:
+            now = self.clock()
+            self._purge(now)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            self._entries[handle] = (now + self.ttl, challenge)
+            self.issued += 1
+        return handle
+
+    def pop(self, handle: Optional[str]) -> Optional[bytes]:
+        if not handle:
+            return None
+        with self._lock:
+            entry = self._entries.pop(handle, None)
+            if entry is None:
+                return None
+            expires_at, challenge = entry
+            if expires_at <= self.clock():
+                self.expired += 1
+                return None
+            self.consumed += 1
+            return challenge
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            self._purge(self.clock())
+            return {
+                "live": len(self._entries),
+                "issued": self.issued,
+                "consumed": self.consumed,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+# Store on a SQLite file, shared by every worker process of a host
+class SqliteChallengeStore:
+    def __init__(
+        self, path: str, ttl: float, clock: Callable[[], float] = time.time
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # counters of this process
+        self.issued = 0
+        self.consumed = 0
+        self.expired = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            # forked: don't use the parent's connection
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit; transactions are started explicitly where needed
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS challenges ("
+                " handle TEXT PRIMARY KEY, challenge BLOB NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS challenges_expires_at"
+                " ON challenges (expires_at)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def put(self, challenge: bytes) -> str:
+        handle = new_handle()
+        now = self.clock()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute("DELETE FROM challenges WHERE expires_at <= ?", (now,))
+            self.expired += cur.rowcount
+            conn.execute(
+                "INSERT INTO challenges (handle, challenge, expires_at) VALUES (?, ?, ?)",
+                (handle, challenge, now + self.ttl),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.issued += 1
+        return handle
+
+    def pop(self, handle: Optional[str]) -> Optional[bytes]:
+        if not handle:
+            return None
+        # DELETE ... RETURNING makes read-and-consume a single atomic statement
+        row = (
+            self._conn()
+            .execute(
+                "DELETE FROM challenges WHERE handle = ? RETURNING challenge, expires_at",
+                (handle,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        challenge, expires_at = row
+        if expires_at <= self.clock():
+            self.expired += 1
+            return None
+        self.consumed += 1
+        return challenge
+
+    def metrics(self) -> Dict[str, int]:
+        (live,) = (
+            self._conn()
+            .execute(
+                "SELECT COUNT(*) FROM challenges WHERE expires_at > ?", (self.clock(),)
+            )
+            .fetchone()
+        )
+        return {
+            "live": live,
+            "issued": self.issued,
+            "consumed": self.consumed,
+            "expired": self.expired,
+        }
+
+
+def open_challenge_store(kind: str) -> ChallengeStore:
+    if kind == "memory":
+        return MemoryChallengeStore(CHALLENGE_TTL_SECONDS, CHALLENGE_MAX_ENTRIES)
+    if kind == "sqlite":
+        return SqliteChallengeStore(CHALLENGE_SQLITE_FILE, CHALLENGE_TTL_SECONDS)
+    raise ValueError(f"unknown CHALLENGE_STORE '{kind}'")
+
+
+store: ChallengeStore = open_challenge_store(CHALLENGE_STORE)
@@ -0,0 +1,149 @@
+import click
+from flask.cli import AppGroup
+
+import app.db as db
+
+# `flask --app main userdb <command>`
+cli = AppGroup("userdb", help="Manage the user store.")
+
+
+@cli.command("migrate")
+@click.argument("json_path", default=db.USERDB_FILE)
+@click.option(
+    "--sqlite-file",
+    default=db.USERDB_SQLITE_FILE,
+    show_default=True,
+    help="SQLite file to migrate into.",
+)
+def migrate(json_path: str, sqlite_file: str) -> None:
+    """Copy users and credentials from a userdb.json into a SQLite store."""
+    from app.db_sqlite import SqliteUserStore, migrate_from_json
+
+    store = SqliteUserStore(sqlite_file)
+    try:
+        count = migrate_from_json(json_path, store)
+    finally:
+        store.close()
+    click.echo(f"migrated {count} users from {json_path} to {sqlite_file}")
+
+
+@cli.command("to-binary")
+@click.argument("json_path", default=db.USERDB_FILE)
+@click.option(
+    "--binary-file",
+    default=db.USERDB_BINARY_FILE,
+    show_default=True,
+    help="Binary snapshot to write.",
+)
+def to_binary(json_path: str, binary_file: str) -> None:
+    """Convert a userdb.json into a binary snapshot."""
+    from app.db_binary import json_to_binary
+
+    count = json_to_binary(json_path, binary_file)
+    click.echo(f"converted {count} users from {json_path} to {binary_file}")
+
+
+@cli.command("to-json")
+@click.argument("json_path", default=db.USERDB_FILE)
+@click.option(
+    "--binary-file",
+    default=db.USERDB_BINARY_FILE,
+    show_default=True,
+    help="Binary snapshot to read.",
+)
+def to_json(json_path: str, binary_file: str) -> None:
+    """Convert a binary snapshot back into a userdb.json."""
+    from app.db_binary import binary_to_json
+
+    count = binary_to_json(binary_file, json_path)
+    click.echo(f"converted {count} users from {binary_file} to {json_path}")
+
+
+@cli.command("import")
+@click.argument("ndjson_file", type=click.File("rb"), default="-")
+@click.option(
+    "--batch-size",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Users committed at once (IMPORT_BATCH_SIZE by default).",
+)
+def import_command(ndjson_file, batch_size) -> None:
+    """Import users from NDJSON (one user per line, '-' for stdin)."""
+    from app.bulk_import import IMPORT_BATCH_SIZE, import_users
+
+    def progress(report) -> None:
+        click.echo(
+            f"{report.rows} rows read, {report.imported} imported,"
+            f" {len(report.errors)} errors",
+            err=True,
+        )
+
+    try:
+        report = import_users(ndjson_file, batch_size or IMPORT_BATCH_SIZE, progress)
+    finally:
+        db.store.close()
+    for error in report.errors:
+        click.echo(f"line {error.line}: {error.error}", err=True)
+    click.echo(f"imported {report.imported} of {report.rows} users")
+
+
+@cli.command("export")
+@click.argument("output", type=click.File("w"), default="-")
+def export_command(output) -> None:
+    """Export every user and its credential metadata as NDJSON ('-' for stdout)."""
+    from app.export import export_ndjson
+
+    for chunk in export_ndjson():
+        output.write(chunk)
+
+
+# `flask --app main password <command>`
+password_cli = AppGroup("password", help="Manage the password hash policy.")
+
+
+@password_cli.command("calibrate")
+@click.option(
+    "--target-ms",
+    default=50.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Median time of hashing one password.",
+)
+@click.option(
+    "--algorithm",
+    default="scrypt",
+    show_default=True,
+    type=click.Choice(["scrypt", "pbkdf2"]),
+)
+@click.option(
+    "--samples",
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Hashes timed per candidate.",
+)
+@click.option(
+    "--max-memory-mb",
+    default=64,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Memory of one scrypt hash at most.",
+)
+def calibrate_command(
+    target_ms: float, algorithm: str, samples: int, max_memory_mb: int
+) -> None:
+    """Pick the strongest PASSWORD_HASH_METHOD meeting a latency target on this host.
+
+    Run it on the production hardware while idle: a login costs one hash
+    per request, and concurrent logins beyond the CPU count queue up.
+    """
+    from app.hashing import calibrate
+
+    method, tried = calibrate(
+        algorithm, target_ms / 1000, samples, max_memory_mb * 2**20
+    )
+    for candidate, seconds in tried:
+        click.echo(f"{candidate}: {seconds * 1000:.1f} ms", err=True)
+    if dict(tried)[method] * 1000 > target_ms:
+        click.echo(f"warning: even {method} takes longer than {target_ms} ms", err=True)
+    click.echo(f"PASSWORD_HASH_METHOD={method}")
@@ -1,63 +1,394 @@
+import dataclasses
 import json
 import os
-from typing import Dict, Optional
+import threading
+from typing import (
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+)
 
-from app.model import Credential, CredentialRecord, UserRecord
+from app import lookup_filter
+from app.metrics import timed
+from app.model import (
+    Credential,
+    CredentialRecord,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    UserRecord,
+    b64decode_no_pad,
+    new_user_handle,
+)
+from app.persister import WriteBehindPersister
+from app.sorted_ids import SortedIds
 
 USERDB_FILE = "userdb.json"
 
+# Storage backend of users and credentials:
+# "json" (USERDB_FILE), "journal" (USERDB_JOURNAL_DIR), "sqlite",
+# "binary" (USERDB_BINARY_FILE) or "sharded" (USERDB_SHARDS files in USERDB_SHARD_DIR)
+USERDB_BACKEND = os.getenv("USERDB_BACKEND", "json")
+USERDB_SQLITE_FILE = os.getenv("USERDB_SQLITE_FILE", "userdb.sqlite3")
+USERDB_BINARY_FILE = os.getenv("USERDB_BINARY_FILE", "userdb.bin")
+USERDB_SHARD_DIR = os.getenv("USERDB_SHARD_DIR", "userdb.shards")
+USERDB_SHARDS = int(os.getenv("USERDB_SHARDS", "4"))
+USERDB_JOURNAL_DIR = os.getenv("USERDB_JOURNAL_DIR", "userdb.d")
+# journal entries before the journal is folded into a new snapshot
+USERDB_COMPACT_EVERY = int(os.getenv("USERDB_COMPACT_EVERY", "1000"))
+# The json, binary and sharded backends save from a worker thread, coalescing the changes
+# made while a save is running (up to USERDB_FLUSH_MAX_BATCH) into the next one.
+# 0 saves synchronously on every change instead.
+USERDB_FLUSH_WINDOW_MS = int(os.getenv("USERDB_FLUSH_WINDOW_MS", "50"))
+USERDB_FLUSH_MAX_BATCH = int(os.getenv("USERDB_FLUSH_MAX_BATCH", "100"))
+# Durability of the changes made by requests (sign-up, passkey registration):
+# "1" answers once the change is durable, "0" answers right away and leaves the
+# write to the backend (a crash before it is done loses the change).
+USERDB_WRITE_WAIT = os.getenv("USERDB_WRITE_WAIT", "1") == "1"
 
-def load_userdb() -> Dict[str, UserRecord]:
-    if not os.path.exists(USERDB_FILE):
-        return {}
+# Secondary index: credential_id (raw bytes) -> user_id.
+# Looking up the owner of a credential is on the passkey login path,
+# so it must not scan every user (and every credential) in userdb.
+credential_index: Dict[bytes, str] = {}
+# Secondary index: user_handle (raw bytes) -> user_id, for the userHandle
+# which authenticators return with discoverable credentials.
+user_handle_index: Dict[bytes, str] = {}
+# Every user_id of userdb in sorted order, for keyset pages (see page_of).
+# Users are never removed, so it only ever grows.
+sorted_user_ids = SortedIds()
+# The userdb object credential_index (and the other indexes) was built from.
+# `userdb` may be replaced as a whole (e.g. in tests), so the index is rebuilt
+# when it no longer belongs to the current userdb.
+_indexed_userdb: Optional[Dict[str, StoredUser]] = None
 
-    with open(USERDB_FILE, "r") as f:
-        content: dict[str, UserRecord] = json.load(f)
-        return content
+# Concurrency of userdb (and credential_index):
+# - writers are serialized by _write_lock.
+# - records are copy-on-write: StoredUser and Credential are immutable, and a
+#   changed user is stored as a new StoredUser, so a record read from userdb
+#   never changes afterwards.
+# - readers take no lock. A single dict get/set is atomic, so they see
+#   either the old or the new record.
+# - snapshot_userdb() is a shallow copy of the dict, which is consistent
+#   since records are immutable, and persisting it does not block anyone.
+_write_lock = threading.RLock()
+# serializes writers of USERDB_FILE
+_save_lock = threading.Lock()
+
+
+def build_credential_index(records: Dict[str, StoredUser]) -> Dict[bytes, str]:
+    index: Dict[bytes, str] = {}
+    for user_id, user in records.items():
+        for cred in user.credentials:
+            # keep the first owner, same as the former linear scan did
+            index.setdefault(cred.credential_id, user_id)
+    return index
+
+
+def build_user_handle_index(records: Dict[str, StoredUser]) -> Dict[bytes, str]:
+    return {
+        user.user_handle: user_id
+        for user_id, user in records.items()
+        if user.user_handle is not None
+    }
+
+
+def _reindex(records: Dict[str, StoredUser]) -> None:
+    global credential_index, user_handle_index, sorted_user_ids, _indexed_userdb
+    with _write_lock:
+        credential_index = build_credential_index(records)
+        user_handle_index = build_user_handle_index(records)
+        sorted_user_ids = SortedIds(records)
+        _indexed_userdb = records
+
+
+# Return a consistent point-in-time view of userdb
+def snapshot_userdb() -> Dict[str, StoredUser]:
+    with _write_lock:
+        return dict(userdb)
+
+
+# Conversion between the in-memory form of users and the persisted (JSON) one
+def from_records(records: Dict[str, UserRecord]) -> Dict[str, StoredUser]:
+    return {user_id: StoredUser.from_dict(user) for user_id, user in records.items()}
+
+
+def to_records(users: Dict[str, StoredUser]) -> Dict[str, UserRecord]:
+    return {user_id: user.to_dict() for user_id, user in users.items()}
+
+
+@timed("load_userdb")
+def load_userdb() -> Dict[str, StoredUser]:
+    content: Dict[str, StoredUser] = {}
+    if os.path.exists(USERDB_FILE):
+        with open(USERDB_FILE, "r") as f:
+            content = from_records(json.load(f))
+
+    _reindex(content)
+    return content
 
 
 # Add a new user to userdb
 # Assuming this is called by the endpoint creates a user
-def append_user(user_id: str, password: str) -> None:
-    if user_id in userdb:
-        raise ValueError(f"user '{user_id}' already exists")
-    # credentials is initialized as an empty list, not None
-    userdb[user_id] = UserRecord(password=password, credentials=[])
-    save_userdb()
+# wait=False returns before the change is written to USERDB_FILE.
+def append_user(user_id: str, password: str, wait: bool = True) -> None:
+    _insert_user(user_id, password)
+    persister.mark_dirty(wait)
+
+
+# Add many new users (with their credentials) with a single save.
+# Either all of them are added or, if one of them exists, none (ValueError).
+def append_users(users: Dict[str, StoredUser], wait: bool = True) -> None:
+    _insert_users(users)
+    persister.mark_dirty(wait)
 
 
 # Add a given credential to the user's credentials list
 # Assuming this is called by the endpoint verifies a response in the passkey registration
-def update_user_credentials(user_id: str, credential: Credential) -> None:
-    user = userdb.get(user_id)
-    if not user:
-        raise KeyError(f"user '{user_id}' not found")
-
-    # Convert a credential object as a record type defined in this file.
-    # `Credential` dataclass type is incompatible with `CredentialRecord` type directly.
-    cred_dict = credential.to_dict()
-    user["credentials"].append(
-        CredentialRecord(
-            credential_id=cred_dict["credential_id"],
-            public_key=cred_dict["public_key"],
-            sign_count=cred_dict["sign_count"],
-            transports=cred_dict.get("transports", []),
+def update_user_credentials(
+    user_id: str, credential: Credential, wait: bool = True
+) -> None:
+    _insert_credential(user_id, credential)
+    persister.mark_dirty(wait)
+
+
+# Decode a credential_id as sent by clients (urlsafe-base64 w/o padding)
+def decode_credential_id(credential_id: str) -> Optional[bytes]:
+    try:
+        return b64decode_no_pad(credential_id)
+    except ValueError:
+        return None
+
+
+# The in-memory part of append_user / update_user_credentials / update_sign_count.
+# Persisting the change is up to the caller.
+def _insert_user(user_id: str, password: str) -> None:
+    with _write_lock:
+        if user_id in userdb:
+            raise ValueError(f"user '{user_id}' already exists")
+        # credentials is initialized as empty, not None
+        userdb[user_id] = StoredUser(password=password)
+        if _indexed_userdb is userdb:
+            sorted_user_ids.add(user_id)
+        else:
+            _reindex(userdb)
+
+
+def _insert_users(users: Dict[str, StoredUser]) -> None:
+    with _write_lock:
+        for user_id in users:
+            if user_id in userdb:
+                raise ValueError(f"user '{user_id}' already exists")
+        if _indexed_userdb is not userdb:
+            _reindex(userdb)
+        for user_id, user in users.items():
+            userdb[user_id] = user
+            for cred in user.credentials:
+                credential_index.setdefault(cred.credential_id, user_id)
+            if user.user_handle is not None:
+                user_handle_index[user.user_handle] = user_id
+        sorted_user_ids.update(users)
+
+
+def _insert_credential(user_id: str, credential: Credential) -> None:
+    with _write_lock:
+        user = userdb.get(user_id)
+        if not user:
+            raise KeyError(f"user '{user_id}' not found")
+
+        userdb[user_id] = dataclasses.replace(
+            user, credentials=(*user.credentials, credential)
         )
+        if _indexed_userdb is userdb:
+            credential_index.setdefault(credential.credential_id, user_id)
+        else:
+            _reindex(userdb)
+
+
+# Return the user handle of user_id, giving it a new one first if it has none.
+# The flag tells whether the handle was just assigned (and must be persisted).
+def _assign_user_handle(user_id: str) -> Tuple[bytes, bool]:
+    with _write_lock:
+        user = userdb.get(user_id)
+        if not user:
+            raise KeyError(f"user '{user_id}' not found")
+        if user.user_handle is not None:
+            return user.user_handle, False
+        user_handle = new_user_handle()
+        _set_user_handle(user_id, user_handle)
+        return user_handle, True
+
+
+def _set_user_handle(user_id: str, user_handle: bytes) -> None:
+    with _write_lock:
+        user = userdb.get(user_id)
+        if not user:
+            raise KeyError(f"user '{user_id}' not found")
+        userdb[user_id] = dataclasses.replace(user, user_handle=user_handle)
+        if _indexed_userdb is userdb:
+            user_handle_index[user_handle] = user_id
+        else:
+            _reindex(userdb)
+
+
+def _set_sign_count(
+    user_id: str,
+    credential_id: str,
+    sign_count: int,
+    last_used: Optional[float] = None,
+) -> None:
+    with _write_lock:
+        user = userdb.get(user_id)
+        if not user:
+            raise KeyError(f"user '{user_id}' not found")
+        userdb[user_id] = with_sign_count(user, credential_id, sign_count, last_used)
+
+
+# Returns whether the update was applied (see PasswordUpdate)
+def _set_password(update: PasswordUpdate) -> bool:
+    with _write_lock:
+        user = userdb.get(update.user_id)
+        if not user or user.password != update.old_password:
+            return False
+        userdb[update.user_id] = dataclasses.replace(user, password=update.password)
+        return True
+
+
+# Return a copy of user with sign_count (and last_used) of a credential replaced
+def with_sign_count(
+    user: StoredUser,
+    credential_id: str,
+    sign_count: int,
+    last_used: Optional[float] = None,
+) -> StoredUser:
+    raw_id = decode_credential_id(credential_id)
+    if not any(c.credential_id == raw_id for c in user.credentials):
+        raise KeyError(f"credential '{credential_id}' not found")
+    return dataclasses.replace(
+        user,
+        credentials=tuple(
+            dataclasses.replace(
+                c,
+                sign_count=sign_count,
+                last_used=c.last_used if last_used is None else last_used,
+            )
+            if c.credential_id == raw_id
+            else c
+            for c in user.credentials
+        ),
     )
-    save_userdb()
+
+
+# Return user_id of the user who owns the given credential_id (urlsafe-base64 w/o padding)
+def find_user_id_by_credential_id(credential_id: str) -> Optional[str]:
+    raw_id = decode_credential_id(credential_id)
+    if raw_id is None:
+        return None
+    if _indexed_userdb is not userdb:
+        _reindex(userdb)
+    return credential_index.get(raw_id)
+
+
+# Return user_id of the user with the given user handle (raw bytes)
+def find_user_id_by_user_handle(user_handle: bytes) -> Optional[str]:
+    if _indexed_userdb is not userdb:
+        _reindex(userdb)
+    return user_handle_index.get(user_handle)
+
+
+# Give the user a user handle if it has none yet, and return it
+def assign_user_handle(user_id: str, wait: bool = True) -> bytes:
+    user_handle, assigned = _assign_user_handle(user_id)
+    if assigned:
+        persister.mark_dirty(wait)
+    return user_handle
+
+
+# Overwrite sign_count (and last_used) of the user's credential
+def update_sign_count(
+    user_id: str,
+    credential_id: str,
+    sign_count: int,
+    last_used: Optional[float] = None,
+    wait: bool = True,
+) -> None:
+    _set_sign_count(user_id, credential_id, sign_count, last_used)
+    persister.mark_dirty(wait)
+
+
+# Apply many sign_count updates with a single save.
+# Updates of credentials which no longer exist are skipped.
+def update_sign_counts(updates: Iterable[SignCountUpdate], wait: bool = True) -> None:
+    for update in updates:
+        try:
+            _set_sign_count(*update)
+        except KeyError:
+            pass
+    persister.mark_dirty(wait)
+
+
+# Apply many password rehashes with a single save (if any applied)
+def update_passwords(updates: Iterable[PasswordUpdate], wait: bool = True) -> None:
+    applied = [_set_password(update) for update in updates]
+    if any(applied):
+        persister.mark_dirty(wait)
+
+
+# Ids taken from a sorted id list at a time by page_of
+PAGE_CHUNK = 256
+
+
+# Keyset page of sorted_ids: the ids > after (all if None), at most `limit`.
+# The ids are sliced in chunks of PAGE_CHUNK under `lock`, since an insert
+# shifts positions; each chunk costs a binary search, and a page of any size
+# (limit=None too) holds one chunk at a time. Ids are never removed, so the
+# next chunk resumes after the last id handed out.
+def page_of(
+    sorted_ids: SortedIds,
+    lock: ContextManager,
+    after: Optional[str],
+    limit: Optional[int],
+) -> Iterator[str]:
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = PAGE_CHUNK if remaining is None else min(PAGE_CHUNK, remaining)
+        with lock:
+            chunk = sorted_ids.slice_after(after, size)
+        yield from chunk
+        if len(chunk) < size:
+            return
+        after = chunk[-1]
+        if remaining is not None:
+            remaining -= size
+
+
+# Keyset page of userdb (see UserStore.list_users)
+def list_userdb(
+    after: Optional[str] = None, limit: Optional[int] = None
+) -> Iterator[Tuple[str, StoredUser]]:
+    with _write_lock:
+        if _indexed_userdb is not userdb:
+            _reindex(userdb)
+        records, sorted_ids = userdb, sorted_user_ids
+    for user_id in page_of(sorted_ids, _write_lock, after, limit):
+        yield user_id, records[user_id]
 
 
 # Return decoded public_key corresponding to the given credential_id
 def find_decoded_public_key(user_id: str, credential_id: str) -> Optional[bytes]:
-    user = userdb.get(user_id)
+    user = store.get_user(user_id)
+    raw_id = decode_credential_id(credential_id)
 
-    if not user:
+    if not user or raw_id is None:
         return None
 
-    for cred in user["credentials"]:
-        if cred["credential_id"] == credential_id:
-            # Return the value via converting dataclass for implementation reasons
-            return Credential.from_dict(cred).public_key
+    for cred in user.credentials:
+        if cred.credential_id == raw_id:
+            return cred.public_key
 
     # no necessary, but for evasion of "no return" linter warning
     return None
@@ -65,20 +396,168 @@ def find_decoded_public_key(user_id: str, credential_id: str) -> Optional[bytes]
 
 # Persist userdb to USERDB_FILE.
 # The process of converting data into a dict type in order to dump it
-# is delegated to the UserRecord type as its responsibility.
+# is delegated to the StoredUser type as its responsibility.
+@timed("save_userdb")
 def save_userdb() -> None:
-    # This is not necessary if we operate the userdb directly,
-    # but for implementation reasons this object is temporarily defined.
-    formatted_userdb: Dict[str, UserRecord] = {}
-
-    for user_id, user in userdb.items():
-        formatted_userdb[user_id] = UserRecord(
-            password=user["password"],
-            credentials=user["credentials"],
+    # snapshot under _save_lock: concurrent saves must write in snapshot order
+    with _save_lock:
+        formatted_userdb = to_records(snapshot_userdb())
+        with open(USERDB_FILE, "w") as f:
+            json.dump(formatted_userdb, f, indent=2)
+
+
+# Interface of the user store.
+# `User` and the endpoints access users and credentials only through this,
+# so the storage backend can be switched by USERDB_BACKEND.
+# credential_id is always the urlsafe-base64 (w/o padding) string form.
+# Changes take `wait`: True returns once the change is durable,
+# False may return before that (backends which are cheap to make durable
+# may ignore it).
+class UserStore(Protocol):
+    def load(self) -> None: ...
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]: ...
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None: ...
+
+    # Add new users with their credentials in one commit (all or nothing)
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None: ...
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None: ...
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]: ...
+
+    # user_id of the user with this user handle (raw bytes)
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]: ...
+
+    # The user handle of the user (raw bytes). Users get one, randomly
+    # generated and then kept, the first time this is called for them.
+    # KeyError for an unknown user.
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes: ...
+
+    # Users with user_id > after (all if None) in user_id order, at most `limit`
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]: ...
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None: ...
+
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None: ...
+
+    # Replace password hashes in one batch. Updates of unknown users, or of
+    # users whose hash is no longer old_password, are skipped.
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None: ...
+
+    def close(self) -> None: ...
+
+
+# The original JSON file store: users live in the module-global `userdb`
+# and the whole of it is written to USERDB_FILE by `persister`.
+class JsonUserStore:
+    def load(self) -> None:
+        global userdb
+        userdb = load_userdb()
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        return userdb.get(user_id)
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        append_user(user_id, password, wait)
+
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        append_users(users, wait)
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        update_user_credentials(user_id, credential, wait)
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        return find_user_id_by_credential_id(credential_id)
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        return find_user_id_by_user_handle(user_handle)
+
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        return assign_user_handle(user_id, wait)
+
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        return list_userdb(after, limit)
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        update_sign_count(user_id, credential_id, sign_count, last_used, wait)
+
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        update_sign_counts(updates, wait)
+
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        update_passwords(updates, wait)
+
+    def close(self) -> None:
+        persister.close()
+        save_userdb()
+
+
+def open_store(backend: str) -> UserStore:
+    if backend == "json":
+        return JsonUserStore()
+    if backend == "sqlite":
+        # imported here since the sqlite backend is optional
+        from app.db_sqlite import SqliteUserStore
+
+        return SqliteUserStore(USERDB_SQLITE_FILE)
+    if backend == "journal":
+        from app.db_journal import JournalUserStore
+
+        return JournalUserStore(USERDB_JOURNAL_DIR, USERDB_COMPACT_EVERY)
+    if backend == "binary":
+        from app.db_binary import BinaryUserStore
+
+        return BinaryUserStore(
+            USERDB_BINARY_FILE, USERDB_FLUSH_WINDOW_MS / 1000, USERDB_FLUSH_MAX_BATCH
         )
+    if backend == "sharded":
+        from app.db_sharded import ShardedUserStore
 
-    with open(USERDB_FILE, "w") as f:
-        json.dump(formatted_userdb, f, indent=2)
+        return ShardedUserStore(
+            USERDB_SHARD_DIR,
+            USERDB_SHARDS,
+            USERDB_FLUSH_WINDOW_MS / 1000,
+            USERDB_FLUSH_MAX_BATCH,
+        )
+    raise ValueError(f"unknown USERDB_BACKEND '{backend}'")
 
 
-userdb: Dict[str, UserRecord] = load_userdb()
+userdb: Dict[str, StoredUser] = {}
+# save_userdb is looked up on every flush, so it can be replaced (e.g. in tests)
+persister = WriteBehindPersister(
+    lambda: save_userdb(), USERDB_FLUSH_WINDOW_MS / 1000, USERDB_FLUSH_MAX_BATCH
+)
+store: UserStore = lookup_filter.wrap(open_store(USERDB_BACKEND), USERDB_BACKEND)
+store.load()
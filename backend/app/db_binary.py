@@ -0,0 +1,667 @@
+import bisect
+import dataclasses
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+
+import app.db as db
+from app.model import (
+    Credential,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    new_user_handle,
+)
+from app.persister import WriteBehindPersister
+
+# Binary snapshot of userdb, read through mmap.
+#
+# Layout (little endian):
+#   header   magic, number of users, then offset and slot count of the
+#            user_id index, of the credential_id index and of the
+#            user_handle index, and offset of the user_id order
+#   records  one length-prefixed record per user (see encode_user)
+#   indexes  open-addressing hash tables of (8-byte key hash, record offset)
+#            slots; offset 0 marks an empty slot.
+#   order    the record offsets sorted by user_id (u64 each), for keyset
+#            pages by binary search
+# Opening a snapshot only maps the file and reads the header, so startup does
+# not depend on the number of users. A lookup probes the index and decodes the
+# one record it points to. Keys are hashed with blake2b (not hash(), which is
+# randomized per process) and compared against the record on a match.
+MAGIC = b"USERDB\x00\x03"
+HEADER = struct.Struct("<8sQQQQQQQQ")
+# Version 2, written before the user_id order: pages of it sort the user_ids
+# in memory once. Still read; the next flush rewrites it.
+MAGIC_V2 = b"USERDB\x00\x02"
+HEADER_V2 = struct.Struct("<8sQQQQQQQ")
+# Version 1, written before user handles existed: no user_handle index, and
+# no user_handle field in the records. Still read; the next flush rewrites it.
+MAGIC_V1 = b"USERDB\x00\x01"
+HEADER_V1 = struct.Struct("<8sQQQQQ")
+SLOT = struct.Struct("<QQ")
+OFFSET = struct.Struct("<Q")
+RECORD_LENGTH = struct.Struct("<I")
+FIELD_LENGTH = struct.Struct("<H")
+COUNT = struct.Struct("<B")
+# sign_count (a 32-bit counter in WebAuthn) and last_used (NaN if unknown)
+CREDENTIAL_FIXED = struct.Struct("<Id")
+NO_TRANSPORTS = 0xFF
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+# struct.pack, raising ValueError naming `what` if a value does not fit
+def _pack(fmt: struct.Struct, what: str, *values: float) -> bytes:
+    try:
+        return fmt.pack(*values)
+    except struct.error as e:
+        raise ValueError(f"{what} does not fit a userdb record ({e})") from None
+
+
+def _field(value: bytes, what: str) -> bytes:
+    return _pack(FIELD_LENGTH, f"{what} of {len(value)} bytes", len(value)) + value
+
+
+# record := u32 length, then
+#   user_id, password                      (u16 length + utf-8)
+#   user_handle                            (u16 length + raw bytes; empty: None)
+#   u16 number of credentials, each:
+#     credential_id, public_key            (u16 length + raw bytes; non-canonical
+#                                           base64 texts come back canonical)
+#     u32 sign_count, f64 last_used
+#     u8 number of transports (0xFF: None), each u8 length + utf-8
+# A value which does not fit raises ValueError.
+def encode_user(user_id: str, user: StoredUser) -> bytes:
+    parts = [
+        _field(user_id.encode(), "user_id"),
+        _field(user.password.encode(), "password"),
+        _field(user.user_handle or b"", "user_handle"),
+        _pack(FIELD_LENGTH, "number of credentials", len(user.credentials)),
+    ]
+    for cred in user.credentials:
+        parts.append(_field(cred.credential_id, "credential_id"))
+        parts.append(_field(cred.public_key, "public_key"))
+        parts.append(
+            _pack(
+                CREDENTIAL_FIXED,
+                f"sign_count {cred.sign_count}",
+                cred.sign_count,
+                math.nan if cred.last_used is None else cred.last_used,
+            )
+        )
+        if cred.transports is None:
+            parts.append(COUNT.pack(NO_TRANSPORTS))
+        else:
+            if len(cred.transports) >= NO_TRANSPORTS:
+                raise ValueError(
+                    f"{len(cred.transports)} transports do not fit a userdb record"
+                )
+            parts.append(COUNT.pack(len(cred.transports)))
+            for transport in cred.transports:
+                name = transport.encode()
+                parts.append(_pack(COUNT, f"transport '{transport}'", len(name)) + name)
+    payload = b"".join(parts)
+    return RECORD_LENGTH.pack(len(payload)) + payload
+
+
+def _read_field(buf: mmap.mmap, pos: int) -> Tuple[bytes, int]:
+    (length,) = FIELD_LENGTH.unpack_from(buf, pos)
+    pos += FIELD_LENGTH.size
+    return buf[pos : pos + length], pos + length
+
+
+# Decode the record at `offset`; returns its user_id, the user and the end offset.
+# Records of version 1 snapshots have no user_handle (`user_handles` False).
+def decode_user(
+    buf: mmap.mmap, offset: int, user_handles: bool = True
+) -> Tuple[str, StoredUser, int]:
+    (length,) = RECORD_LENGTH.unpack_from(buf, offset)
+    pos = offset + RECORD_LENGTH.size
+    end = pos + length
+
+    user_id, pos = _read_field(buf, pos)
+    password, pos = _read_field(buf, pos)
+    user_handle = b""
+    if user_handles:
+        user_handle, pos = _read_field(buf, pos)
+    (count,) = FIELD_LENGTH.unpack_from(buf, pos)
+    pos += FIELD_LENGTH.size
+
+    credentials = []
+    for _ in range(count):
+        credential_id, pos = _read_field(buf, pos)
+        public_key, pos = _read_field(buf, pos)
+        sign_count, last_used = CREDENTIAL_FIXED.unpack_from(buf, pos)
+        pos += CREDENTIAL_FIXED.size
+        (transport_count,) = COUNT.unpack_from(buf, pos)
+        pos += COUNT.size
+        transports = None
+        if transport_count != NO_TRANSPORTS:
+            transports = []
+            for _ in range(transport_count):
+                (name_length,) = COUNT.unpack_from(buf, pos)
+                pos += COUNT.size
+                transports.append(buf[pos : pos + name_length].decode())
+                pos += name_length
+        credentials.append(
+            Credential(
+                credential_id=credential_id,
+                public_key=public_key,
+                sign_count=sign_count,
+                transports=transports,
+                last_used=None if math.isnan(last_used) else last_used,
+            )
+        )
+
+    if pos != end:
+        raise ValueError(f"corrupted userdb record at offset {offset}")
+    user = StoredUser(
+        password=password.decode(),
+        credentials=tuple(credentials),
+        user_handle=user_handle or None,
+    )
+    return user_id.decode(), user, end
+
+
+# Build an open-addressing table (linear probing) with at least twice as many
+# slots as entries. Entries are inserted in order, so among equal keys the
+# first one is found first.
+def _build_index(hashes: array, offsets: array) -> Tuple[bytearray, int]:
+    slots = 1
+    while slots < 2 * len(hashes):
+        slots *= 2
+    mask = slots - 1
+    table = bytearray(slots * SLOT.size)
+    for h, offset in zip(hashes, offsets):
+        i = h & mask
+        while SLOT.unpack_from(table, i * SLOT.size)[1] != 0:
+            i = (i + 1) & mask
+        SLOT.pack_into(table, i * SLOT.size, h, offset)
+    return table, slots
+
+
+# user_id of the record at `offset`, without decoding the rest of it
+def _read_user_id(buf: mmap.mmap, offset: int) -> str:
+    user_id, _ = _read_field(buf, offset + RECORD_LENGTH.size)
+    return user_id.decode()
+
+
+# Write users to a new snapshot at `path` and return the number of users.
+# The file is written under a temporary name and atomically renamed.
+# Users given in user_id order (as the store flushes them) are written without
+# holding their user_ids; others are sorted by reading the user_ids back.
+def write_snapshot(path: str, users: Iterable[Tuple[str, StoredUser]]) -> int:
+    user_hashes, user_offsets = array("Q"), array("Q")
+    credential_hashes, credential_offsets = array("Q"), array("Q")
+    handle_hashes, handle_offsets = array("Q"), array("Q")
+    count = 0
+    last_id: Optional[str] = None
+    in_order = True
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w+b") as f:
+        # the header is written last, once the offsets are known
+        f.write(bytes(HEADER.size))
+        offset = HEADER.size
+        for user_id, user in users:
+            record = encode_user(user_id, user)
+            if last_id is not None and user_id < last_id:
+                in_order = False
+            last_id = user_id
+            user_hashes.append(key_hash(user_id.encode()))
+            user_offsets.append(offset)
+            for cred in user.credentials:
+                credential_hashes.append(key_hash(cred.credential_id))
+                credential_offsets.append(offset)
+            if user.user_handle is not None:
+                handle_hashes.append(key_hash(user.user_handle))
+                handle_offsets.append(offset)
+            f.write(record)
+            offset += len(record)
+            count += 1
+
+        user_table, user_slots = _build_index(user_hashes, user_offsets)
+        user_index = offset
+        f.write(user_table)
+        credential_table, credential_slots = _build_index(
+            credential_hashes, credential_offsets
+        )
+        credential_index = user_index + len(user_table)
+        f.write(credential_table)
+        handle_table, handle_slots = _build_index(handle_hashes, handle_offsets)
+        handle_index = credential_index + len(credential_table)
+        f.write(handle_table)
+
+        order = user_offsets
+        if not in_order:
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as written:
+                order = array(
+                    "Q",
+                    sorted(user_offsets, key=lambda o: _read_user_id(written, o)),
+                )
+        order_index = handle_index + len(handle_table)
+        f.write(struct.pack(f"<{len(order)}Q", *order))
+
+        f.seek(0)
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                count,
+                user_index,
+                user_slots,
+                credential_index,
+                credential_slots,
+                handle_index,
+                handle_slots,
+                order_index,
+            )
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+# Read-only view of a snapshot file
+class BinarySnapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self._map[: len(MAGIC)]
+        headers = {MAGIC: HEADER, MAGIC_V2: HEADER_V2, MAGIC_V1: HEADER_V1}
+        if magic not in headers or len(self._map) < headers[magic].size:
+            raise ValueError(f"'{path}' is not a userdb snapshot")
+        self._user_handles = magic != MAGIC_V1
+        self._header = headers[magic]
+        # version 1 snapshots: an empty user_handle index
+        self._handle_index, self._handle_slots = 0, 0
+        # versions 1 and 2: no user_id order in the file (see _sorted_offsets)
+        self._order_index = 0
+        self._order: Optional[array] = None
+        (
+            _,
+            self.users,
+            self._user_index,
+            self._user_slots,
+            self._credential_index,
+            self._credential_slots,
+            *tables,
+        ) = self._header.unpack_from(self._map, 0)
+        end = self._credential_index + self._credential_slots * SLOT.size
+        if tables:
+            self._handle_index, self._handle_slots, *order_table = tables
+            end = self._handle_index + self._handle_slots * SLOT.size
+            if order_table:
+                (self._order_index,) = order_table
+                end = self._order_index + self.users * OFFSET.size
+        if end != len(self._map):
+            raise ValueError(f"'{path}' is not a userdb snapshot")
+
+    def __len__(self) -> int:
+        return self.users
+
+    # Offsets of the records whose key hash equals that of `key`
+    def _probe(self, table: int, slots: int, key: bytes) -> Iterator[int]:
+        h = key_hash(key)
+        mask = slots - 1
+        i = h & mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._map, table + i * SLOT.size)
+            if offset == 0:
+                return
+            if slot_hash == h:
+                yield offset
+            i = (i + 1) & mask
+
+    def _decode(self, offset: int) -> Tuple[str, StoredUser, int]:
+        return decode_user(self._map, offset, self._user_handles)
+
+    def get(self, user_id: str) -> Optional[StoredUser]:
+        for offset in self._probe(self._user_index, self._user_slots, user_id.encode()):
+            record_id, user, _ = self._decode(offset)
+            if record_id == user_id:
+                return user
+        return None
+
+    # user_id of the owner of a credential (raw credential_id)
+    def find_credential(self, credential_id: bytes) -> Optional[str]:
+        for offset in self._probe(
+            self._credential_index, self._credential_slots, credential_id
+        ):
+            record_id, user, _ = self._decode(offset)
+            if any(c.credential_id == credential_id for c in user.credentials):
+                return record_id
+        return None
+
+    # user_id of the user with a user handle (raw bytes)
+    def find_user_handle(self, user_handle: bytes) -> Optional[str]:
+        if not self._handle_slots:
+            return None
+        for offset in self._probe(self._handle_index, self._handle_slots, user_handle):
+            record_id, user, _ = self._decode(offset)
+            if user.user_handle == user_handle:
+                return record_id
+        return None
+
+    # Every user, in the order they were written
+    def items(self) -> Iterator[Tuple[str, StoredUser]]:
+        offset = self._header.size
+        while offset < self._user_index:
+            user_id, user, offset = self._decode(offset)
+            yield user_id, user
+
+    # Offsets of the records sorted by user_id. Older snapshots lack the
+    # order, so it is built in memory on first use (until the next flush
+    # rewrites the file in the current format).
+    def _sorted_offsets(self) -> Union["_Offsets", array]:
+        if self._order_index:
+            return _Offsets(self._map, self._order_index, self.users)
+        if self._order is None:
+            offsets = []
+            offset = self._header.size
+            while offset < self._user_index:
+                offsets.append(offset)
+                (length,) = RECORD_LENGTH.unpack_from(self._map, offset)
+                offset += RECORD_LENGTH.size + length
+            offsets.sort(key=lambda o: _read_user_id(self._map, o))
+            self._order = array("Q", offsets)
+        return self._order
+
+    # Users with user_id > after (all if None) in user_id order.
+    # Finding the first costs a binary search of the order; records are
+    # decoded one at a time as they are consumed.
+    def items_after(self, after: Optional[str] = None) -> Iterator[Tuple[str, StoredUser]]:
+        order = self._sorted_offsets()
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(
+                order, after, key=lambda o: _read_user_id(self._map, o)
+            )
+        for rank in range(start, len(order)):
+            user_id, user, _ = self._decode(order[rank])
+            yield user_id, user
+
+    def close(self) -> None:
+        self._map.close()
+
+
+# The user_id order of a snapshot, read in place as a sequence of offsets
+class _Offsets:
+    def __init__(self, buf: mmap.mmap, start: int, length: int):
+        self._buf = buf
+        self._start = start
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, rank: int) -> int:
+        if not 0 <= rank < self._length:
+            raise IndexError(rank)
+        return OFFSET.unpack_from(self._buf, self._start + rank * OFFSET.size)[0]
+
+
+# User store on a binary snapshot (USERDB_BINARY_FILE).
+# Users changed since the snapshot was written are kept in memory and
+# looked up first. Like the JSON store, changes are persisted by rewriting the
+# whole file (coalesced by `persister`), so this backend suits read-mostly
+# deployments that need to restart fast; it assumes a single writing process.
+class BinaryUserStore:
+    def __init__(self, path: str, window: float = 0.0, max_batch: int = 100):
+        self.path = path
+        self._snapshot: Optional[BinarySnapshot] = None
+        # users, credential owners and user handles changed since the snapshot
+        self._changed: Dict[str, StoredUser] = {}
+        self._owners: Dict[bytes, str] = {}
+        self._handles: Dict[bytes, str] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.persister = WriteBehindPersister(self._flush, window, max_batch)
+
+    def load(self) -> None:
+        self._snapshot = BinarySnapshot(self.path) if os.path.exists(self.path) else None
+        self._changed = {}
+        self._owners = {}
+        self._handles = {}
+
+    # Must be called while holding self._lock.
+    # A user which cannot be written is rejected here (ValueError), rather than
+    # failing the flush, and with it every later one.
+    def _put(self, user_id: str, user: StoredUser) -> None:
+        encode_user(user_id, user)
+        self._changed[user_id] = user
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        user = self._changed.get(user_id)
+        if user is not None:
+            return user
+        snapshot = self._snapshot
+        return snapshot.get(user_id) if snapshot is not None else None
+
+    def _find_owner(self, credential_id: bytes) -> Optional[str]:
+        owner = self._owners.get(credential_id)
+        if owner is not None:
+            return owner
+        snapshot = self._snapshot
+        return snapshot.find_credential(credential_id) if snapshot is not None else None
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        with self._lock:
+            if self.get_user(user_id) is not None:
+                raise ValueError(f"user '{user_id}' already exists")
+            self._put(user_id, StoredUser(password=password))
+        self.persister.mark_dirty(wait)
+
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        with self._lock:
+            for user_id in users:
+                if self.get_user(user_id) is not None:
+                    raise ValueError(f"user '{user_id}' already exists")
+            for user_id, user in users.items():
+                encode_user(user_id, user)
+            for user_id, user in users.items():
+                self._changed[user_id] = user
+                for cred in user.credentials:
+                    if self._find_owner(cred.credential_id) is None:
+                        self._owners[cred.credential_id] = user_id
+                if user.user_handle is not None:
+                    self._handles[user.user_handle] = user_id
+        self.persister.mark_dirty(wait)
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        with self._lock:
+            user = self.get_user(user_id)
+            if user is None:
+                raise KeyError(f"user '{user_id}' not found")
+            self._put(
+                user_id,
+                dataclasses.replace(user, credentials=(*user.credentials, credential)),
+            )
+            # keep the first owner, same as the other stores
+            if self._find_owner(credential.credential_id) is None:
+                self._owners[credential.credential_id] = user_id
+        self.persister.mark_dirty(wait)
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        raw_id = db.decode_credential_id(credential_id)
+        return self._find_owner(raw_id) if raw_id is not None else None
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        user_id = self._handles.get(user_handle)
+        if user_id is not None:
+            return user_id
+        snapshot = self._snapshot
+        return snapshot.find_user_handle(user_handle) if snapshot is not None else None
+
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        with self._lock:
+            user = self.get_user(user_id)
+            if user is None:
+                raise KeyError(f"user '{user_id}' not found")
+            if user.user_handle is not None:
+                return user.user_handle
+            user_handle = new_user_handle()
+            self._put(user_id, dataclasses.replace(user, user_handle=user_handle))
+            self._handles[user_handle] = user_id
+        self.persister.mark_dirty(wait)
+        return user_handle
+
+    # The snapshot's users from a binary search of its user_id order, merged
+    # with the (few, not yet flushed) changed users sorted in memory
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        with self._lock:
+            changed = dict(self._changed)
+            snapshot = self._snapshot
+        return itertools.islice(self._merged(snapshot, changed, after), limit)
+
+    # Every user of snapshot with changed folded in, in user_id order
+    @staticmethod
+    def _merged(
+        snapshot: Optional[BinarySnapshot],
+        changed: Dict[str, StoredUser],
+        after: Optional[str] = None,
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        new = sorted(
+            (item for item in changed.items() if after is None or item[0] > after),
+            key=lambda item: item[0],
+        )
+        if snapshot is None:
+            return iter(new)
+        stored = (
+            (user_id, user)
+            for user_id, user in snapshot.items_after(after)
+            if user_id not in changed
+        )
+        return heapq.merge(stored, new, key=lambda item: item[0])
+
+    # Must be called while holding self._lock
+    def _set_sign_count(self, update: SignCountUpdate) -> None:
+        user = self.get_user(update.user_id)
+        if user is None:
+            raise KeyError(f"user '{update.user_id}' not found")
+        self._put(
+            update.user_id,
+            db.with_sign_count(
+                user, update.credential_id, update.sign_count, update.last_used
+            ),
+        )
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        with self._lock:
+            self._set_sign_count(
+                SignCountUpdate(user_id, credential_id, sign_count, last_used)
+            )
+        self.persister.mark_dirty(wait)
+
+    # Unknown credentials (and counters out of range) are skipped;
+    # one rewrite for the whole batch
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        applied = 0
+        with self._lock:
+            for update in updates:
+                try:
+                    self._set_sign_count(update)
+                except (KeyError, ValueError):
+                    continue
+                applied += 1
+        if applied:
+            self.persister.mark_dirty(wait)
+
+    # Skipped unless the stored hash is still old_password; one rewrite for the whole batch
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        applied = 0
+        with self._lock:
+            for update in updates:
+                user = self.get_user(update.user_id)
+                if user is None or user.password != update.old_password:
+                    continue
+                changed = dataclasses.replace(user, password=update.password)
+                try:
+                    self._put(update.user_id, changed)
+                except ValueError:
+                    continue
+                applied += 1
+        if applied:
+            self.persister.mark_dirty(wait)
+
+    # Rewrite the snapshot with the changed users folded in
+    def _flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                changed = dict(self._changed)
+                owners = list(self._owners)
+                handles = list(self._handles)
+                snapshot = self._snapshot
+            if not changed:
+                return
+
+            # in user_id order, so the new snapshot's order is the records'
+            write_snapshot(self.path, self._merged(snapshot, changed))
+            new_snapshot = BinarySnapshot(self.path)
+
+            with self._lock:
+                # switch the snapshot before forgetting the changes, so readers
+                # find every user in one or the other. The old mapping stays
+                # valid for readers still using it and is unmapped once unused.
+                self._snapshot = new_snapshot
+                for user_id, user in changed.items():
+                    if self._changed.get(user_id) is user:
+                        del self._changed[user_id]
+                for credential_id in owners:
+                    self._owners.pop(credential_id, None)
+                for user_handle in handles:
+                    self._handles.pop(user_handle, None)
+
+    def close(self) -> None:
+        self.persister.close()
+        self._flush()
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+
+# Converters between userdb.json and the binary snapshot.
+# Both return the number of converted users.
+def json_to_binary(json_path: str, binary_path: str) -> int:
+    with open(json_path, "r") as f:
+        records = json.load(f)
+    return write_snapshot(binary_path, db.from_records(records).items())
+
+
+def binary_to_json(binary_path: str, json_path: str) -> int:
+    snapshot = BinarySnapshot(binary_path)
+    try:
+        records = db.to_records(dict(snapshot.items()))
+    finally:
+        snapshot.close()
+    with open(json_path, "w") as f:
+        json.dump(records, f, indent=2)
+    return len(records)
@@ -0,0 +1,376 @@
+import contextlib
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import app.db as db
+from app.model import (
+    Credential,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    b64decode_no_pad,
+    b64encode_no_pad,
+    new_user_handle,
+)
+
+SNAPSHOT_PREFIX = "snapshot."
+SNAPSHOT_SUFFIX = ".json"
+JOURNAL_PREFIX = "journal."
+JOURNAL_SUFFIX = ".ndjson"
+
+
+# JSON store persisted as snapshots plus an append-only journal.
+#
+# USERDB_JOURNAL_DIR holds files of "generations":
+#   snapshot.<gen>.json   all users as of the start of generation <gen>
+#   journal.<gen>.ndjson  one JSON line per change made during generation <gen>
+# A change costs one fsync'd line instead of rewriting the whole userdb.json
+# (with wait=False the line is written but not fsync'd).
+# Startup replays the newest snapshot plus the journals of its generation
+# and later. Compaction starts a new generation and writes its snapshot to a
+# temporary file which is atomically renamed, so a crash at any point leaves
+# either the old or the new snapshot complete, with the journals it needs.
+class JournalUserStore:
+    def __init__(self, directory: str, compact_every: int = 1000):
+        self.directory = directory
+        # number of journal entries that triggers a background compaction
+        self.compact_every = compact_every
+        self.generation = 0
+        self.entries = 0
+        self._journal: Optional[Any] = None
+        # serializes changes: journal order must match the in-memory order
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+
+    def _path(self, prefix: str, generation: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{prefix}{generation}{suffix}")
+
+    def _generations(self, prefix: str, suffix: str) -> List[int]:
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                number = name[len(prefix) : -len(suffix)]
+                if number.isdigit():
+                    generations.append(int(number))
+        return sorted(generations)
+
+    def load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        snapshots = self._generations(SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+        records: Dict[str, StoredUser]
+        if snapshots:
+            generation = snapshots[-1]
+            path = self._path(SNAPSHOT_PREFIX, generation, SNAPSHOT_SUFFIX)
+            with open(path, "r") as f:
+                records = db.from_records(json.load(f))
+        else:
+            # first start: seed from an existing userdb.json, if any
+            generation = 0
+            records = db.load_userdb()
+        db.userdb = records
+
+        self.entries = 0
+        journals = [
+            g for g in self._generations(JOURNAL_PREFIX, JOURNAL_SUFFIX) if g >= generation
+        ]
+        for g in journals:
+            self.entries += self._replay(self._path(JOURNAL_PREFIX, g, JOURNAL_SUFFIX))
+
+        self.generation = max(journals, default=generation)
+        self._journal = open(
+            self._path(JOURNAL_PREFIX, self.generation, JOURNAL_SUFFIX), "a"
+        )
+        self._remove_before(generation)
+
+    # Apply every entry of a journal file and return the number of entries.
+    # A torn last line (crash in the middle of a write) is cut off.
+    def _replay(self, path: str) -> int:
+        count = 0
+        good_size = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(entry)
+                good_size += len(line)
+                count += 1
+
+        if good_size < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_size)
+        return count
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        op = entry["op"]
+        if op == "add_user":
+            db._insert_user(entry["user_id"], entry["password"])
+        elif op == "add_credential":
+            db._insert_credential(
+                entry["user_id"], Credential.from_dict(entry["credential"])
+            )
+        elif op == "user_handle":
+            db._set_user_handle(entry["user_id"], b64decode_no_pad(entry["user_handle"]))
+        elif op == "sign_count":
+            db._set_sign_count(
+                entry["user_id"],
+                entry["credential_id"],
+                entry["sign_count"],
+                entry.get("last_used"),
+            )
+        elif op == "password":
+            db._set_password(
+                PasswordUpdate(entry["user_id"], entry["old_password"], entry["password"])
+            )
+        else:
+            raise ValueError(f"unknown journal op '{op}'")
+
+    # Must be called while holding self._lock.
+    # Changes are journaled before they are applied in memory, so a change
+    # which could not be journaled is never visible. The lines are written
+    # (and fsync'd if `wait`) as one; if that fails they are cut off again,
+    # so a failed change isn't replayed on the next load either.
+    def _append(self, entries: List[Dict[str, Any]], wait: bool) -> None:
+        if not entries:
+            return
+        assert self._journal is not None
+        start = self._journal.tell()
+        try:
+            self._journal.write(
+                "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in entries)
+            )
+            self._journal.flush()
+            if wait:
+                os.fsync(self._journal.fileno())
+        except BaseException:
+            with contextlib.suppress(OSError):
+                self._journal.seek(start)
+                self._journal.truncate()
+            raise
+        self.entries += len(entries)
+
+        if self.entries >= self.compact_every:
+            self._start_compaction()
+
+    # The user, or KeyError (checked before anything is journaled)
+    @staticmethod
+    def _existing(user_id: str) -> StoredUser:
+        user = db.userdb.get(user_id)
+        if not user:
+            raise KeyError(f"user '{user_id}' not found")
+        return user
+
+    @staticmethod
+    def _check_new(user_ids: Iterable[str]) -> None:
+        for user_id in user_ids:
+            if user_id in db.userdb:
+                raise ValueError(f"user '{user_id}' already exists")
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        return db.userdb.get(user_id)
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        with self._lock:
+            self._check_new([user_id])
+            self._append(
+                [{"op": "add_user", "user_id": user_id, "password": password}], wait
+            )
+            db._insert_user(user_id, password)
+
+    # One line per user and credential, fsync'd once at the end
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        with self._lock:
+            self._check_new(users)
+            entries: List[Dict[str, Any]] = []
+            for user_id, user in users.items():
+                entries.append(
+                    {"op": "add_user", "user_id": user_id, "password": user.password}
+                )
+                for cred in user.credentials:
+                    entries.append(
+                        {
+                            "op": "add_credential",
+                            "user_id": user_id,
+                            "credential": cred.to_dict(),
+                        }
+                    )
+                if user.user_handle is not None:
+                    entries.append(self._user_handle_entry(user_id, user.user_handle))
+            self._append(entries, wait)
+            db._insert_users(users)
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        with self._lock:
+            self._existing(user_id)
+            self._append(
+                [
+                    {
+                        "op": "add_credential",
+                        "user_id": user_id,
+                        "credential": credential.to_dict(),
+                    }
+                ],
+                wait,
+            )
+            db._insert_credential(user_id, credential)
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        return db.find_user_id_by_credential_id(credential_id)
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        return db.find_user_id_by_user_handle(user_handle)
+
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        with self._lock:
+            user = self._existing(user_id)
+            if user.user_handle is not None:
+                return user.user_handle
+            user_handle = new_user_handle()
+            self._append([self._user_handle_entry(user_id, user_handle)], wait)
+            db._set_user_handle(user_id, user_handle)
+        return user_handle
+
+    @staticmethod
+    def _user_handle_entry(user_id: str, user_handle: bytes) -> Dict[str, Any]:
+        return {
+            "op": "user_handle",
+            "user_id": user_id,
+            "user_handle": b64encode_no_pad(user_handle),
+        }
+
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        return db.list_userdb(after, limit)
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        update = SignCountUpdate(user_id, credential_id, sign_count, last_used)
+        with self._lock:
+            # KeyError for an unknown user or credential
+            db.with_sign_count(self._existing(user_id), credential_id, sign_count)
+            self._append([self._sign_count_entry(update)], wait)
+            db._set_sign_count(*update)
+
+    # One line per update, fsync'd once at the end
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        with self._lock:
+            applied = []
+            for update in updates:
+                try:
+                    db.with_sign_count(
+                        self._existing(update.user_id),
+                        update.credential_id,
+                        update.sign_count,
+                    )
+                except KeyError:
+                    continue
+                applied.append(update)
+            self._append([self._sign_count_entry(u) for u in applied], wait)
+            for update in applied:
+                db._set_sign_count(*update)
+
+    @staticmethod
+    def _sign_count_entry(update: SignCountUpdate) -> Dict[str, Any]:
+        return {
+            "op": "sign_count",
+            "user_id": update.user_id,
+            "credential_id": update.credential_id,
+            "sign_count": update.sign_count,
+            "last_used": update.last_used,
+        }
+
+    # One line per applicable update, fsync'd once at the end
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        with self._lock:
+            applied = []
+            for update in updates:
+                user = db.userdb.get(update.user_id)
+                if user is not None and user.password == update.old_password:
+                    applied.append(update)
+            self._append([{"op": "password", **u._asdict()} for u in applied], wait)
+            for update in applied:
+                db._set_password(update)
+
+    # Must be called while holding self._lock, so that two writers crossing
+    # the threshold one after the other don't both start a compactor
+    def _start_compaction(self) -> None:
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, daemon=True)
+        self._compactor.start()
+
+    # Fold everything journaled so far into a new snapshot
+    def compact(self) -> None:
+        with self._compact_lock:
+            with self._lock:
+                # later changes go to the journal of the new generation
+                assert self._journal is not None
+                self._journal.close()
+                self.generation += 1
+                generation = self.generation
+                self._journal = open(
+                    self._path(JOURNAL_PREFIX, generation, JOURNAL_SUFFIX), "a"
+                )
+                self.entries = 0
+                records = db.snapshot_userdb()
+
+            path = self._path(SNAPSHOT_PREFIX, generation, SNAPSHOT_SUFFIX)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(db.to_records(records), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._fsync_directory()
+            self._remove_before(generation)
+
+    def _fsync_directory(self) -> None:
+        # make the rename itself durable (not supported on every platform)
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    # Remove snapshots and journals superseded by the snapshot of `generation`
+    def _remove_before(self, generation: int) -> None:
+        for prefix, suffix in (
+            (SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX),
+            (JOURNAL_PREFIX, JOURNAL_SUFFIX),
+        ):
+            for g in self._generations(prefix, suffix):
+                if g < generation:
+                    os.remove(self._path(prefix, g, suffix))
+
+    def close(self) -> None:
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,295 @@
+import contextlib
+import dataclasses
+import heapq
+import itertools
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import app.db as db
+from app.model import (
+    Credential,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    new_user_handle,
+)
+from app.persister import WriteBehindPersister
+from app.sorted_ids import SortedIds
+
+SHARD_PREFIX = "shard-"
+SHARD_SUFFIX = ".json"
+
+
+# One partition of the users, with its own lock and its own JSON file.
+# Records are copy-on-write as in db.userdb, so readers take no lock.
+class _Shard:
+    def __init__(self, path: str, window: float, max_batch: int):
+        self.path = path
+        self.users: Dict[str, StoredUser] = {}
+        # user_ids of the shard in sorted order, for keyset pages
+        self.user_ids = SortedIds()
+        self.lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self.persister = WriteBehindPersister(self.save, window, max_batch)
+
+    # Rewrite the shard file (temporary file + atomic rename).
+    # The copy is taken under _save_lock, so an older copy never overwrites
+    # the file written from a newer one.
+    def save(self) -> None:
+        with self._save_lock:
+            with self.lock:
+                users = dict(self.users)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(db.to_records(users), f)
+            os.replace(tmp_path, self.path)
+
+
+# JSON store partitioned into `shards` files by a stable hash of user_id
+# (USERDB_SHARD_DIR/shard-<n>.json). A sign-up or a registration locks and
+# rewrites only the shard of its user, so the cost of a write is 1/shards of
+# the JSON store's, and writes to different shards don't wait for each other.
+# The owner of each credential and of each user handle is kept in a global
+# routing index (rebuilt shard by shard on load, so among users sharing a
+# credential_id the first owner is only kept until a restart).
+# Changing the number of shards redistributes the users on the next load.
+class ShardedUserStore:
+    def __init__(
+        self, directory: str, shards: int, window: float = 0.0, max_batch: int = 100
+    ):
+        if shards < 1:
+            raise ValueError("the number of shards must be at least 1")
+        self.directory = directory
+        self.window = window
+        self.max_batch = max_batch
+        self._shards = [self._new_shard(n) for n in range(shards)]
+        # routing indexes: credential_id / user_handle (raw bytes) -> user_id
+        self._owners: Dict[bytes, str] = {}
+        self._handles: Dict[bytes, str] = {}
+        self._owners_lock = threading.Lock()
+
+    def _new_shard(self, n: int) -> _Shard:
+        path = os.path.join(self.directory, f"{SHARD_PREFIX}{n}{SHARD_SUFFIX}")
+        return _Shard(path, self.window, self.max_batch)
+
+    def _shard_number(self, user_id: str) -> int:
+        # crc32, unlike hash(), is the same in every process and every run
+        return zlib.crc32(user_id.encode()) % len(self._shards)
+
+    def _shard(self, user_id: str) -> _Shard:
+        return self._shards[self._shard_number(user_id)]
+
+    def _shard_files(self) -> Dict[int, str]:
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.startswith(SHARD_PREFIX) and name.endswith(SHARD_SUFFIX):
+                number = name[len(SHARD_PREFIX) : -len(SHARD_SUFFIX)]
+                if number.isdigit():
+                    files[int(number)] = os.path.join(self.directory, name)
+        return files
+
+    def load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._shards = [self._new_shard(n) for n in range(len(self._shards))]
+        self._owners = {}
+        self._handles = {}
+
+        files = self._shard_files()
+        # users in a file other than the one of their shard
+        misplaced = 0
+        if files:
+            for n, path in sorted(files.items()):
+                with open(path, "r") as f:
+                    users = db.from_records(json.load(f))
+                for user_id, user in users.items():
+                    if self._shard_number(user_id) != n:
+                        misplaced += 1
+                    self._place(user_id, user)
+        else:
+            # first start: seed from an existing userdb.json, if any
+            for user_id, user in db.load_userdb().items():
+                self._place(user_id, user)
+                misplaced += 1
+
+        for shard in self._shards:
+            shard.user_ids = SortedIds(shard.users)
+
+        if misplaced:
+            for shard in self._shards:
+                shard.save()
+            for n, path in files.items():
+                if n >= len(self._shards):
+                    os.remove(path)
+
+    def _place(self, user_id: str, user: StoredUser) -> None:
+        self._shard(user_id).users[user_id] = user
+        for cred in user.credentials:
+            # keep the first owner, same as the other stores
+            self._owners.setdefault(cred.credential_id, user_id)
+        if user.user_handle is not None:
+            self._handles[user.user_handle] = user_id
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        return self._shard(user_id).users.get(user_id)
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            if user_id in shard.users:
+                raise ValueError(f"user '{user_id}' already exists")
+            shard.users[user_id] = StoredUser(password=password)
+            shard.user_ids.add(user_id)
+        shard.persister.mark_dirty(wait)
+
+    # Locks every touched shard (in shard order) for the whole batch
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        by_shard: Dict[int, List[str]] = {}
+        for user_id in users:
+            by_shard.setdefault(self._shard_number(user_id), []).append(user_id)
+        shards = [self._shards[n] for n in sorted(by_shard)]
+
+        with contextlib.ExitStack() as stack:
+            for shard in shards:
+                stack.enter_context(shard.lock)
+            for user_id in users:
+                if user_id in self._shard(user_id).users:
+                    raise ValueError(f"user '{user_id}' already exists")
+            for user_id, user in users.items():
+                self._shard(user_id).users[user_id] = user
+                with self._owners_lock:
+                    for cred in user.credentials:
+                        self._owners.setdefault(cred.credential_id, user_id)
+                    if user.user_handle is not None:
+                        self._handles[user.user_handle] = user_id
+            for n in by_shard:
+                self._shards[n].user_ids.update(by_shard[n])
+
+        for shard in shards:
+            shard.persister.mark_dirty(wait)
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            user = shard.users.get(user_id)
+            if user is None:
+                raise KeyError(f"user '{user_id}' not found")
+            shard.users[user_id] = dataclasses.replace(
+                user, credentials=(*user.credentials, credential)
+            )
+            with self._owners_lock:
+                self._owners.setdefault(credential.credential_id, user_id)
+        shard.persister.mark_dirty(wait)
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        raw_id = db.decode_credential_id(credential_id)
+        return self._owners.get(raw_id) if raw_id is not None else None
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        return self._handles.get(user_handle)
+
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        shard = self._shard(user_id)
+        with shard.lock:
+            user = shard.users.get(user_id)
+            if user is None:
+                raise KeyError(f"user '{user_id}' not found")
+            if user.user_handle is not None:
+                return user.user_handle
+            user_handle = new_user_handle()
+            shard.users[user_id] = dataclasses.replace(user, user_handle=user_handle)
+            with self._owners_lock:
+                self._handles[user_handle] = user_id
+        shard.persister.mark_dirty(wait)
+        return user_handle
+
+    # The pages of every shard, merged
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        pages = [self._page(shard, after, limit) for shard in self._shards]
+        return itertools.islice(heapq.merge(*pages, key=lambda item: item[0]), limit)
+
+    @staticmethod
+    def _page(
+        shard: _Shard, after: Optional[str], limit: Optional[int]
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        for user_id in db.page_of(shard.user_ids, shard.lock, after, limit):
+            yield user_id, shard.users[user_id]
+
+    # Must be called while holding shard.lock
+    @staticmethod
+    def _set_sign_count(shard: _Shard, update: SignCountUpdate) -> None:
+        user = shard.users.get(update.user_id)
+        if user is None:
+            raise KeyError(f"user '{update.user_id}' not found")
+        shard.users[update.user_id] = db.with_sign_count(
+            user, update.credential_id, update.sign_count, update.last_used
+        )
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            self._set_sign_count(
+                shard, SignCountUpdate(user_id, credential_id, sign_count, last_used)
+            )
+        shard.persister.mark_dirty(wait)
+
+    # One save per touched shard; unknown credentials are skipped
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        by_shard: Dict[int, List[SignCountUpdate]] = {}
+        for update in updates:
+            by_shard.setdefault(self._shard_number(update.user_id), []).append(update)
+
+        for n, shard_updates in by_shard.items():
+            shard = self._shards[n]
+            applied = 0
+            with shard.lock:
+                for update in shard_updates:
+                    try:
+                        self._set_sign_count(shard, update)
+                    except KeyError:
+                        continue
+                    applied += 1
+            if applied:
+                shard.persister.mark_dirty(wait)
+
+    # One save per shard with an applied update
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        by_shard: Dict[int, List[PasswordUpdate]] = {}
+        for update in updates:
+            by_shard.setdefault(self._shard_number(update.user_id), []).append(update)
+
+        for n, shard_updates in by_shard.items():
+            shard = self._shards[n]
+            applied = 0
+            with shard.lock:
+                for update in shard_updates:
+                    user = shard.users.get(update.user_id)
+                    if user is None or user.password != update.old_password:
+                        continue
+                    shard.users[update.user_id] = dataclasses.replace(
+                        user, password=update.password
+                    )
+                    applied += 1
+            if applied:
+                shard.persister.mark_dirty(wait)
+
+    def close(self) -> None:
+        for shard in self._shards:
+            shard.persister.close()
@@ -0,0 +1,331 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.model import (
+    Credential,
+    CredentialRecord,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    UserRecord,
+    b64decode_no_pad,
+    b64encode_no_pad,
+    new_user_handle,
+)
+
+# credentials.credential_id is unique, and credentials_user_id makes
+# "credentials of a user" an index range scan instead of a table scan.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id     TEXT PRIMARY KEY,
+    password    TEXT NOT NULL,
+    user_handle TEXT
+);
+CREATE TABLE IF NOT EXISTS credentials (
+    credential_id TEXT NOT NULL UNIQUE,
+    user_id       TEXT NOT NULL REFERENCES users (user_id),
+    public_key    TEXT NOT NULL,
+    sign_count    INTEGER NOT NULL,
+    transports    TEXT NOT NULL,
+    last_used     REAL
+);
+CREATE INDEX IF NOT EXISTS credentials_user_id ON credentials (user_id);
+"""
+# created after the migration, which adds users.user_handle to old databases
+# (NULL, i.e. no handle yet, may repeat in a UNIQUE index)
+USER_HANDLE_INDEX = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_user_handle ON users (user_handle)"
+)
+
+# Statements are kept as constants with placeholders only,
+# so sqlite3's per-connection statement cache prepares each of them once.
+SELECT_USER = "SELECT password, user_handle FROM users WHERE user_id = ?"
+SELECT_CREDENTIALS = (
+    "SELECT credential_id, public_key, sign_count, transports, last_used"
+    " FROM credentials WHERE user_id = ? ORDER BY rowid"
+)
+# A keyset page of users joined with their credentials (LIMIT -1: no limit)
+SELECT_USERS_PAGE = (
+    "SELECT u.user_id, u.password, u.user_handle, c.credential_id, c.public_key,"
+    " c.sign_count, c.transports, c.last_used"
+    " FROM (SELECT user_id, password, user_handle FROM users WHERE user_id > ?"
+    " ORDER BY user_id LIMIT ?) u"
+    " LEFT JOIN credentials c ON c.user_id = u.user_id"
+    " ORDER BY u.user_id, c.rowid"
+)
+SELECT_CREDENTIAL_OWNER = "SELECT user_id FROM credentials WHERE credential_id = ?"
+SELECT_USER_HANDLE_OWNER = "SELECT user_id FROM users WHERE user_handle = ?"
+INSERT_USER = "INSERT INTO users (user_id, password, user_handle) VALUES (?, ?, ?)"
+# no-op for a user who already has a handle
+SET_USER_HANDLE = (
+    "UPDATE users SET user_handle = ? WHERE user_id = ? AND user_handle IS NULL"
+)
+INSERT_CREDENTIAL = (
+    "INSERT INTO credentials"
+    " (credential_id, user_id, public_key, sign_count, transports, last_used)"
+    " VALUES (?, ?, ?, ?, ?, ?)"
+)
+UPDATE_SIGN_COUNT = (
+    "UPDATE credentials SET sign_count = ?, last_used = COALESCE(?, last_used)"
+    " WHERE user_id = ? AND credential_id = ?"
+)
+# no-op if another worker changed the hash since it was read
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE user_id = ? AND password = ?"
+
+
+def _credential(
+    credential_id: str,
+    public_key: str,
+    sign_count: int,
+    transports: str,
+    last_used: Optional[float],
+) -> Credential:
+    record = CredentialRecord(
+        credential_id=credential_id,
+        public_key=public_key,
+        sign_count=sign_count,
+        transports=json.loads(transports),
+    )
+    if last_used is not None:
+        record["last_used"] = last_used
+    return Credential.from_dict(record)
+
+
+def _user_handle(column: Optional[str]) -> Optional[bytes]:
+    return None if column is None else b64decode_no_pad(column)
+
+
+# User store on a SQLite file in WAL mode.
+# A sign-up or a passkey registration is a single-row insert
+# instead of rewriting the whole database like the JSON store does.
+# Every change commits before returning, so `wait` is ignored.
+class SqliteUserStore:
+    def __init__(self, path: str):
+        self.path = path
+        # sqlite3 connections must not be shared between threads,
+        # so each request thread gets its own connection.
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            # forked (e.g. a preloading server): connections of the parent
+            # must not be used, so start over without closing them
+            self._local = threading.local()
+            self._connections = []
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # durable at checkpoints, and no fsync on every commit in WAL mode
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def load(self) -> None:
+        conn = self._conn()
+        with conn:
+            conn.executescript(SCHEMA)
+            # databases created before last_used existed
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(credentials)")}
+            if "last_used" not in columns:
+                conn.execute("ALTER TABLE credentials ADD COLUMN last_used REAL")
+            # and before user_handle existed
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+            if "user_handle" not in columns:
+                conn.execute("ALTER TABLE users ADD COLUMN user_handle TEXT")
+            conn.execute(USER_HANDLE_INDEX)
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        conn = self._conn()
+        row = conn.execute(SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            return None
+
+        credentials = [
+            _credential(*columns)
+            for columns in conn.execute(SELECT_CREDENTIALS, (user_id,))
+        ]
+        return StoredUser(
+            password=row[0],
+            credentials=tuple(credentials),
+            user_handle=_user_handle(row[1]),
+        )
+
+    # One query for the whole page; rows are streamed from the cursor
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        rows = self._conn().execute(
+            SELECT_USERS_PAGE,
+            ("" if after is None else after, -1 if limit is None else limit),
+        )
+        current: Optional[str] = None
+        password = ""
+        user_handle: Optional[bytes] = None
+        credentials: List[Credential] = []
+        for user_id, user_password, user_handle_column, *columns in rows:
+            if user_id != current:
+                if current is not None:
+                    yield current, StoredUser(password, tuple(credentials), user_handle)
+                current, password, credentials = user_id, user_password, []
+                user_handle = _user_handle(user_handle_column)
+            if columns[0] is not None:
+                credentials.append(_credential(*columns))
+        if current is not None:
+            yield current, StoredUser(password, tuple(credentials), user_handle)
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        try:
+            with self._conn() as conn:
+                conn.execute(INSERT_USER, (user_id, password, None))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"user '{user_id}' already exists")
+
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        try:
+            self.add_records(
+                {user_id: user.to_dict() for user_id, user in users.items()}
+            )
+        except sqlite3.IntegrityError:
+            raise ValueError("user or credential already exists")
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        cred_dict = credential.to_dict()
+        conn = self._conn()
+        with conn:
+            if conn.execute(SELECT_USER, (user_id,)).fetchone() is None:
+                raise KeyError(f"user '{user_id}' not found")
+            try:
+                conn.execute(
+                    INSERT_CREDENTIAL,
+                    (
+                        cred_dict["credential_id"],
+                        user_id,
+                        cred_dict["public_key"],
+                        cred_dict["sign_count"],
+                        json.dumps(cred_dict.get("transports") or []),
+                        None,
+                    ),
+                )
+            except sqlite3.IntegrityError:
+                raise ValueError(
+                    f"credential '{cred_dict['credential_id']}' already exists"
+                )
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        row = self._conn().execute(SELECT_CREDENTIAL_OWNER, (credential_id,)).fetchone()
+        return row[0] if row else None
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        row = (
+            self._conn()
+            .execute(SELECT_USER_HANDLE_OWNER, (b64encode_no_pad(user_handle),))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    # The UPDATE only sets a handle where there is none, so of two concurrent
+    # calls the second one reads back the handle of the first
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        with self._conn() as conn:
+            conn.execute(
+                SET_USER_HANDLE, (b64encode_no_pad(new_user_handle()), user_id)
+            )
+            row = conn.execute(SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"user '{user_id}' not found")
+        return b64decode_no_pad(row[1])
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        with self._conn() as conn:
+            cur = conn.execute(
+                UPDATE_SIGN_COUNT, (sign_count, last_used, user_id, credential_id)
+            )
+        if cur.rowcount == 0:
+            raise KeyError(f"credential '{credential_id}' not found")
+
+    # All updates in one transaction; unknown credentials are no-ops
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        with self._conn() as conn:
+            conn.executemany(
+                UPDATE_SIGN_COUNT,
+                (
+                    (u.sign_count, u.last_used, u.user_id, u.credential_id)
+                    for u in updates
+                ),
+            )
+
+    # All updates in one transaction
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        with self._conn() as conn:
+            conn.executemany(
+                UPDATE_PASSWORD,
+                ((u.password, u.user_id, u.old_password) for u in updates),
+            )
+
+    # Insert the given records in a single transaction (used by the migration)
+    def add_records(self, records: Dict[str, UserRecord]) -> None:
+        with self._conn() as conn:
+            conn.executemany(
+                INSERT_USER,
+                (
+                    (user_id, user["password"], user.get("user_handle"))
+                    for user_id, user in records.items()
+                ),
+            )
+            conn.executemany(
+                INSERT_CREDENTIAL,
+                (
+                    (
+                        cred["credential_id"],
+                        user_id,
+                        cred["public_key"],
+                        int(cred["sign_count"]),
+                        json.dumps(cred.get("transports") or []),
+                        cred.get("last_used"),
+                    )
+                    for user_id, user in records.items()
+                    for cred in user.get("credentials", [])
+                ),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+# Copy the users of an existing userdb.json into a SQLite store.
+# Returns the number of migrated users.
+def migrate_from_json(json_path: str, store: SqliteUserStore) -> int:
+    with open(json_path, "r") as f:
+        records: Dict[str, UserRecord] = json.load(f)
+
+    store.load()
+    store.add_records(records)
+    return len(records)
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from app.model import Credential
+from webauthn.helpers.structs import (
+    AuthenticatorTransport,
+    PublicKeyCredentialDescriptor,
+)
+
+# Max number of users whose credential descriptors are kept
+DESCRIPTOR_CACHE_SIZE = int(os.getenv("DESCRIPTOR_CACHE_SIZE", "10000"))
+# Entries are dropped after this long. A registration invalidates the entry
+# of its user only in the process which served it; this bounds how long the
+# other worker processes may miss the new credential.
+DESCRIPTOR_CACHE_TTL_SECONDS = float(os.getenv("DESCRIPTOR_CACHE_TTL_SECONDS", "30"))
+
+Descriptors = Tuple[PublicKeyCredentialDescriptor, ...]
+
+_TRANSPORTS = {t.value: t for t in AuthenticatorTransport}
+
+
+# allowCredentials / excludeCredentials entries of the given credentials
+# (transports unknown to py_webauthn are left out, and a credential registered
+# without transports gets none)
+def build_descriptors(credentials: Sequence[Credential]) -> Descriptors:
+    return tuple(
+        PublicKeyCredentialDescriptor(
+            id=cred.credential_id,
+            transports=[
+                _TRANSPORTS[t] for t in cred.transports or () if t in _TRANSPORTS
+            ],
+        )
+        for cred in credentials
+    )
+
+
+# Bounded LRU of the credential descriptors of users, keyed by user_id.
+# Must be invalidated whenever the credentials of a user change.
+class DescriptorCache:
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, Descriptors]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation: a load which raced with one isn't cached
+        self._generation = 0
+
+    # Return the descriptors of user_id's credentials.
+    # On a miss, `load` returns the user's credentials, or None for an
+    # unknown user (which is not cached, so a later sign-up is seen).
+    def get(
+        self, user_id: str, load: Callable[[], Optional[Sequence[Credential]]]
+    ) -> Optional[Descriptors]:
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        credentials = load()
+        if credentials is None:
+            return None
+
+        descriptors = build_descriptors(credentials)
+        with self._lock:
+            if generation != self._generation:
+                return descriptors
+            self._entries[user_id] = (now + self.ttl, descriptors)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return descriptors
+
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+cache = DescriptorCache(DESCRIPTOR_CACHE_SIZE, DESCRIPTOR_CACHE_TTL_SECONDS)
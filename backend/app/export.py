@@ -0,0 +1,41 @@
+import json
+from typing import Iterator
+
+import app.db as db
+from app.model import StoredUser, b64encode_no_pad
+
+# Users per chunk of a streamed export
+EXPORT_CHUNK_USERS = 1000
+
+# json.dumps with non-default arguments builds a new encoder on every call
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+# What listings and exports show of a user: the credential metadata,
+# but neither the password hash nor the public keys
+def user_summary(user_id: str, user: StoredUser) -> dict:
+    credentials = []
+    for cred in user.credentials:
+        summary = {
+            "credential_id": b64encode_no_pad(cred.credential_id),
+            "sign_count": cred.sign_count,
+            "transports": cred.transports,
+        }
+        if cred.last_used is not None:
+            summary["last_used"] = cred.last_used
+        credentials.append(summary)
+    return {"username": user_id, "credentials": credentials}
+
+
+# Every user as NDJSON, in user_id order.
+# Users are read from the store as the export is consumed and yielded in
+# chunks of `chunk_users` lines, so only one chunk is held at a time.
+def export_ndjson(chunk_users: int = EXPORT_CHUNK_USERS) -> Iterator[str]:
+    lines = []
+    for user_id, user in db.store.list_users():
+        lines.append(_encoder.encode(user_summary(user_id, user)))
+        if len(lines) >= chunk_users:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
@@ -0,0 +1,177 @@
+import hashlib
+import multiprocessing
+import os
+import secrets
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.metrics import operation_seconds
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash,
+)
+
+# Processes which run password hashing. 0 hashes in the request thread.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "0"))
+# Max hashing jobs running or waiting; more are rejected instead of queued
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+# Method of new hashes in werkzeug's notation, "scrypt:<n>:<r>:<p>" or
+# "pbkdf2:<hash>:<iterations>" (`flask --app main password calibrate` picks
+# one for a latency target). Hashes of any other method are rehashed on the
+# next successful login, so lowering it is as effective as raising it.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+
+# Start method of the pool's processes. The pool is started from a request
+# thread, and fork() of a threaded process may copy a lock held by another
+# thread into the child, which then deadlocks on it; forkserver forks them
+# from a single-threaded server process instead.
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# werkzeug's parameters of "scrypt" without arguments
+SCRYPT_DEFAULTS = (2**15, 8, 1)
+
+
+# `method` with every parameter spelled out, as werkzeug records it in hashes
+def normalize_method(method: str) -> str:
+    name, *args = method.split(":")
+    try:
+        if name == "scrypt" and len(args) in (0, 3):
+            n, r, p = map(int, args) if args else SCRYPT_DEFAULTS
+            if n > 1 and n & (n - 1) == 0 and r > 0 and p > 0:
+                return f"scrypt:{n}:{r}:{p}"
+        elif name == "pbkdf2" and len(args) <= 2:
+            hash_name = args[0] if args else "sha256"
+            iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+            if hash_name in hashlib.algorithms_available and iterations > 0:
+                return f"pbkdf2:{hash_name}:{iterations}"
+    except ValueError:
+        pass
+    raise ValueError(f"invalid password hash method '{method}'")
+
+
+# Raised when the hashing queue is full (the endpoints answer 503)
+class HashingOverloaded(Exception):
+    pass
+
+
+# Password hashing (scrypt/pbkdf2) is CPU-bound and holds the GIL, which
+# stalls every other request of the process while it runs. With workers > 0
+# it runs on a process pool instead; the request thread only waits for the
+# result. Admission is bounded so a burst of password logins fails fast
+# rather than piling up latency for everyone.
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int, method: str = "scrypt"):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.method = normalize_method(method)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self._dummy_hash: Optional[str] = None
+
+    def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.workers <= 0:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingOverloaded("too many password hashing requests")
+        try:
+            if self._executor is None:
+                with self._lock:
+                    if self._executor is None:
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers, mp_context=_MP_CONTEXT
+                        )
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def check(self, pwhash: str, password: str) -> bool:
+        with operation_seconds.time("password_check"):
+            return self._run(check_password_hash, pwhash, password)
+
+    # Check a password against a hash of a random one (always False), for
+    # logins of unknown users: it costs as much as checking a real password,
+    # so the response time doesn't tell whether the user exists.
+    def check_dummy(self, password: str) -> bool:
+        dummy_hash = self._dummy_hash
+        if dummy_hash is None or self.needs_rehash(dummy_hash):
+            dummy_hash = generate_password_hash(secrets.token_urlsafe(16), self.method)
+            self._dummy_hash = dummy_hash
+        self.check(dummy_hash, password)
+        return False
+
+    def generate(self, password: str) -> str:
+        with operation_seconds.time("password_hash"):
+            return self._run(generate_password_hash, password, self.method)
+
+    # Whether pwhash was made with another method than the current one
+    def needs_rehash(self, pwhash: str) -> bool:
+        return pwhash.split("$", 1)[0] != self.method
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# Median seconds of hashing a password with `method`, over `samples` hashes
+def median_seconds(method: str, samples: int) -> float:
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        generate_password_hash("calibration", method)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+# The strongest method of `algorithm` ("scrypt" or "pbkdf2") whose median
+# hashing time on this host is at most `target` seconds, and the median time
+# of every method tried (weakest first). If even the weakest one is slower
+# than the target, that one is returned.
+# scrypt doubles n (r=8, p=1) up to 128 * n * r bytes of max_memory per hash.
+# pbkdf2's time is linear in the iterations: they are extrapolated from a
+# first measurement, then lowered by 10% until the target is met.
+def calibrate(
+    algorithm: str, target: float, samples: int = 5, max_memory: int = 64 * 2**20
+) -> Tuple[str, List[Tuple[str, float]]]:
+    tried: List[Tuple[str, float]] = []
+
+    def fits(method: str) -> bool:
+        tried.append((method, median_seconds(method, samples)))
+        return tried[-1][1] <= target
+
+    if algorithm == "scrypt":
+        n, r, p = 2**14, SCRYPT_DEFAULTS[1], SCRYPT_DEFAULTS[2]
+        chosen = f"scrypt:{n}:{r}:{p}"
+        while fits(f"scrypt:{n}:{r}:{p}"):
+            chosen = f"scrypt:{n}:{r}:{p}"
+            n *= 2
+            if 128 * n * r > max_memory:
+                break
+        return chosen, tried
+
+    if algorithm == "pbkdf2":
+        step = 10_000
+        fits(f"pbkdf2:sha256:{100_000}")
+        per_iteration = tried[-1][1] / 100_000
+        iterations = max(step, round(target / per_iteration) // step * step)
+        while not fits(f"pbkdf2:sha256:{iterations}") and iterations > step:
+            iterations = max(step, int(iterations * 0.9) // step * step)
+        return f"pbkdf2:sha256:{iterations}", tried
+
+    raise ValueError(f"unknown password hash algorithm '{algorithm}'")
+
+
+hasher = PasswordHasher(
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_METHOD
+)
@@ -1,10 +1,11 @@
+from app.hashing import HashingOverloaded, hasher
+from app.password_upgrades import upgrader
 from app.users import User
 from flask import Blueprint, jsonify, request
 from flask_login import (
     login_user,
     logout_user,
 )
-from werkzeug.security import check_password_hash
 
 bp = Blueprint("login", __name__)
 
@@ -17,10 +18,19 @@ def login():
 
     user = User.get_by_id(username)
 
-    if user is None or not check_password_hash(user.password, password):
+    try:
+        if user is None:
+            verified = hasher.check_dummy(password or "")
+        else:
+            verified = hasher.check(user.password, password)
+    except HashingOverloaded:
+        return jsonify({"error": "server busy"}), 503, {"Retry-After": "1"}
+
+    if not verified:
         error = "Incorrect username or password."
         return jsonify({"error": error}), 400
 
+    upgrader.upgrade(user.id, user.password, password)
     login_user(user)
     return jsonify({"status": "logged_in", "username": username})
 
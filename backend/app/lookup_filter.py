@@ -0,0 +1,271 @@
+import math
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.model import (
+    Credential,
+    PasswordUpdate,
+    SignCountUpdate,
+    StoredUser,
+    b64decode_no_pad,
+)
+
+if TYPE_CHECKING:
+    from app.db import UserStore
+
+# Negative lookup filter of the user store: lookups of user_ids and
+# credential_ids the filter has never seen are answered "not found" without
+# touching the store (bots trying random usernames or credential ids).
+# Comma-separated backends (USERDB_BACKEND) which are filtered; "binary" by
+# default, "" for none. A miss of the filter costs about as much as one of the
+# binary backend's index (python -m benchmarks.bench_lookup_filter), and more
+# than a dict lookup of the json, journal and sharded ones, so it pays off only
+# where a lookup may have to read the disk (binary snapshots larger than the
+# page cache).
+LOOKUP_FILTER_BACKENDS = {
+    b for b in os.getenv("LOOKUP_FILTER_BACKENDS", "binary").split(",") if b
+}
+# keys of the first Bloom filter; each further one holds twice as many
+LOOKUP_FILTER_CAPACITY = int(os.getenv("LOOKUP_FILTER_CAPACITY", "100000"))
+# bound of the false positive rate (a miss which still goes to the store)
+LOOKUP_FILTER_ERROR_RATE = float(os.getenv("LOOKUP_FILTER_ERROR_RATE", "0.001"))
+
+# Backends written by other processes too: a filter of this process can't
+# know their keys, so they are never filtered
+SHARED_BACKENDS = {"sqlite"}
+
+_USER = b"u:"
+_CREDENTIAL = b"c:"
+_MASK64 = (1 << 64) - 1
+
+
+# Bloom filter of `capacity` keys at `error_rate`, with the optimal number of
+# bits and of hash functions. The positions of a key are derived from one
+# 64-bit hash (double hashing) by `probe`.
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError("capacity must be positive and error_rate in (0, 1)")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(bits / capacity * math.log(2)))
+        self._bits = bytearray((bits + 7) // 8)
+        self.size = len(self._bits) * 8
+        # keys which set at least one bit (about the number of distinct keys)
+        self.count = 0
+
+    # Not thread-safe (a bit set is a read-modify-write); see ScalableBloomFilter
+    def add(self, h: int) -> None:
+        bits, size = self._bits, self.size
+        p, step = h % size, (h >> 32) | 1
+        new = False
+        for _ in range(self.hashes):
+            if not bits[p >> 3] >> (p & 7) & 1:
+                bits[p >> 3] |= 1 << (p & 7)
+                new = True
+            p = (p + step) % size
+        if new:
+            self.count += 1
+
+    # Stops at the first unset bit, so a miss costs about two probes
+    def probe(self, h: int) -> bool:
+        bits, size = self._bits, self.size
+        p, step = h % size, (h >> 32) | 1
+        for _ in range(self.hashes):
+            if not bits[p >> 3] >> (p & 7) & 1:
+                return False
+            p = (p + step) % size
+        return True
+
+    # Expected false positive rate at the current number of keys
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+
+# Bloom filters added as the keys grow: a full filter is followed by one twice
+# as large with half the error rate, so the overall false positive rate stays
+# below `error_rate` however many keys are added.
+# Keys are hashed with hash(), the cheapest hash there is in Python. It is
+# seeded per process, which is fine for a filter that is never persisted, and
+# keeps keys colliding in one worker from colliding in the others.
+# Adds are serialized; lookups take no lock (bits are only ever set).
+class ScalableBloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.error_rate = error_rate
+        self._filters: List[BloomFilter] = [BloomFilter(capacity, error_rate / 2)]
+        self._lock = threading.Lock()
+
+    def add(self, key: bytes) -> None:
+        h = hash(key) & _MASK64
+        with self._lock:
+            if any(f.probe(h) for f in self._filters):
+                return
+            last = self._filters[-1]
+            if last.count >= last.capacity:
+                last = BloomFilter(last.capacity * 2, last.error_rate / 2)
+                self._filters.append(last)
+            last.add(h)
+
+    def __contains__(self, key: bytes) -> bool:
+        h = hash(key) & _MASK64
+        return any(f.probe(h) for f in self._filters)
+
+    def __len__(self) -> int:
+        return sum(f.count for f in self._filters)
+
+    def false_positive_rate(self) -> float:
+        return 1 - math.prod(1 - f.false_positive_rate() for f in self._filters)
+
+    def memory_bytes(self) -> int:
+        return sum(f.memory_bytes() for f in self._filters)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "keys": len(self),
+            "filters": len(self._filters),
+            "memory_bytes": self.memory_bytes(),
+            "false_positive_rate": self.false_positive_rate(),
+        }
+
+
+# A UserStore whose get_user / find_by_credential first ask a filter of every
+# user_id and credential_id of the store.
+# The filter is built from the store in a background thread on load (so
+# startup costs no more than the store's own load); lookups go to the store
+# until it is ready. Keys are added before the store is changed, so a lookup
+# never misses a user or credential which the store already has.
+class FilteredUserStore:
+    def __init__(self, store: "UserStore", capacity: int, error_rate: float):
+        self.store = store
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = ScalableBloomFilter(capacity, error_rate)
+        self._ready = threading.Event()
+        self._builder: Optional[threading.Thread] = None
+        # lookups answered by the filter, and those passed on to the store
+        self.rejected = 0
+        self.passed = 0
+
+    def load(self) -> None:
+        if self._builder is not None:
+            self._builder.join()
+        self._ready.clear()
+        self.store.load()
+        self._filter = ScalableBloomFilter(self.capacity, self.error_rate)
+        self._builder = threading.Thread(target=self._build, daemon=True)
+        self._builder.start()
+
+    def _build(self) -> None:
+        for user_id, user in self.store.list_users():
+            self._add_user(user_id, user)
+        self._ready.set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def _add_user(self, user_id: str, user: StoredUser) -> None:
+        self._filter.add(_USER + user_id.encode())
+        for cred in user.credentials:
+            self._filter.add(_CREDENTIAL + cred.credential_id)
+
+    # False only if `key` is certainly unknown to the store
+    def _may_exist(self, key: bytes) -> bool:
+        if not self._ready.is_set() or key in self._filter:
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def get_user(self, user_id: str) -> Optional[StoredUser]:
+        if not self._may_exist(_USER + user_id.encode()):
+            return None
+        return self.store.get_user(user_id)
+
+    def find_by_credential(self, credential_id: str) -> Optional[str]:
+        try:
+            raw_id = b64decode_no_pad(credential_id)
+        except ValueError:
+            return None
+        if not self._may_exist(_CREDENTIAL + raw_id):
+            return None
+        return self.store.find_by_credential(credential_id)
+
+    def add_user(self, user_id: str, password: str, wait: bool = True) -> None:
+        self._filter.add(_USER + user_id.encode())
+        self.store.add_user(user_id, password, wait)
+
+    def add_users(self, users: Dict[str, StoredUser], wait: bool = True) -> None:
+        for user_id, user in users.items():
+            self._add_user(user_id, user)
+        self.store.add_users(users, wait)
+
+    def add_credential(
+        self, user_id: str, credential: Credential, wait: bool = True
+    ) -> None:
+        self._filter.add(_CREDENTIAL + credential.credential_id)
+        self.store.add_credential(user_id, credential, wait)
+
+    def find_by_user_handle(self, user_handle: bytes) -> Optional[str]:
+        return self.store.find_by_user_handle(user_handle)
+
+    def assign_user_handle(self, user_id: str, wait: bool = True) -> bytes:
+        return self.store.assign_user_handle(user_id, wait)
+
+    def list_users(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, StoredUser]]:
+        return self.store.list_users(after, limit)
+
+    def update_sign_count(
+        self,
+        user_id: str,
+        credential_id: str,
+        sign_count: int,
+        last_used: Optional[float] = None,
+        wait: bool = True,
+    ) -> None:
+        self.store.update_sign_count(user_id, credential_id, sign_count, last_used, wait)
+
+    def update_sign_counts(
+        self, updates: Iterable[SignCountUpdate], wait: bool = True
+    ) -> None:
+        self.store.update_sign_counts(updates, wait)
+
+    def update_passwords(
+        self, updates: Iterable[PasswordUpdate], wait: bool = True
+    ) -> None:
+        self.store.update_passwords(updates, wait)
+
+    def close(self) -> None:
+        if self._builder is not None:
+            self._builder.join()
+        self.store.close()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            **self._filter.stats(),
+            "ready": int(self._ready.is_set()),
+            "rejected": self.rejected,
+            "passed": self.passed,
+        }
+
+
+# The store of `backend`, filtered if it is one of LOOKUP_FILTER_BACKENDS
+def wrap(store: "UserStore", backend: str) -> "UserStore":
+    if backend not in LOOKUP_FILTER_BACKENDS:
+        return store
+    if backend in SHARED_BACKENDS:
+        raise ValueError(
+            f"USERDB_BACKEND '{backend}' can't be filtered: other processes write to it"
+        )
+    return FilteredUserStore(store, LOOKUP_FILTER_CAPACITY, LOOKUP_FILTER_ERROR_RATE)
+
+
+# Stats of the filter of `store` (empty if it isn't filtered)
+def stats(store: "UserStore") -> Dict[str, float]:
+    return store.stats() if isinstance(store, FilteredUserStore) else {}
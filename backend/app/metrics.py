@@ -0,0 +1,255 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+from flask import Blueprint, Flask, Response, g, request
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)  # fmt: skip
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+# Base of Counter and Histogram.
+#
+# Every thread updates its own rows (one list of numbers per label set), so
+# recording takes no lock: no other thread ever writes to them. A scrape
+# sums up the rows of all threads. When a thread ends, its rows are folded
+# into `_retired` (under the lock), so short-lived threads don't accumulate.
+class _ThreadLocalMetric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], width: int):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._width = width
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads: Dict[int, Dict[Labels, List[float]]] = {}
+        self._retired: Dict[Labels, List[float]] = {}
+
+    def _rows(self) -> Dict[Labels, List[float]]:
+        rows = getattr(self._local, "rows", None)
+        if rows is None:
+            rows = self._local.rows = {}
+            key = id(rows)
+            with self._lock:
+                self._threads[key] = rows
+            weakref.finalize(threading.current_thread(), self._retire, key)
+        return rows
+
+    def _row(self, labels: Labels) -> List[float]:
+        rows = self._rows()
+        row = rows.get(labels)
+        if row is None:
+            row = rows[labels] = [0.0] * self._width
+        return row
+
+    def _retire(self, key: int) -> None:
+        with self._lock:
+            rows = self._threads.pop(key, None)
+            if rows:
+                self._merge_into(self._retired, rows)
+
+    def _merge_into(
+        self, total: Dict[Labels, List[float]], rows: Dict[Labels, List[float]]
+    ) -> None:
+        for labels, row in list(rows.items()):
+            acc = total.setdefault(labels, [0.0] * self._width)
+            for i, value in enumerate(row):
+                acc[i] += value
+
+    def totals(self) -> Dict[Labels, List[float]]:
+        total: Dict[Labels, List[float]] = {}
+        with self._lock:
+            self._merge_into(total, self._retired)
+            for rows in list(self._threads.values()):
+                self._merge_into(total, rows)
+        return total
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(_ThreadLocalMetric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames, 1)
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._row(labels)[0] += amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, (value,) in sorted(self.totals().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}"
+
+
+# Row layout: one count per bucket (the last one is +Inf), then the sum
+class Histogram(_ThreadLocalMetric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames, len(self.buckets) + 2)
+
+    def observe(self, value: float, *labels: str) -> None:
+        row = self._row(labels)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> Iterator[str]:
+        bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        for labels, row in sorted(self.totals().items()):
+            cumulative = 0.0
+            for bound, count in zip(bounds, row):
+                cumulative += count
+                label_str = _format_labels(
+                    (*self.labelnames, "le"), (*labels, bound)
+                )
+                yield f"{self.name}_bucket{label_str} {cumulative:g}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {row[-1]:g}"
+            yield f"{self.name}_count{label_str} {cumulative:g}"
+
+
+# Gauges read from a `stats()`-style function at scrape time: each key of the
+# returned dict becomes the gauge <prefix>_<key>
+class StatsGauges:
+    def __init__(self, prefix: str, help: str, stats: Callable[[], Mapping[str, float]]):
+        self.name = prefix
+        self.help = help
+        self.stats = stats
+
+    def collect(self) -> Iterator[str]:
+        for key, value in sorted(self.stats().items()):
+            name = f"{self.name}_{key}"
+            yield f"# HELP {name} {self.help}: {key}"
+            yield f"# TYPE {name} gauge"
+            yield f"{name} {value:g}"
+
+
+# Metrics exposed at /metrics, by name (registering a name again replaces it)
+registry: Dict[str, object] = {}
+
+
+def register(metric):
+    registry[metric.name] = metric
+    return metric
+
+
+def register_stats(prefix: str, help: str, stats: Callable[[], Mapping[str, float]]) -> None:
+    register(StatsGauges(prefix, help, stats))
+
+
+def exposition() -> str:
+    lines: List[str] = []
+    for name in sorted(registry):
+        try:
+            lines.extend(registry[name].collect())  # type: ignore[attr-defined]
+        except Exception as e:
+            lines.append(f"# {name} failed: {_escape(str(e))}")
+    return "\n".join(lines) + "\n"
+
+
+requests_total = register(
+    Counter("http_requests_total", "HTTP requests", ("endpoint", "method", "status"))
+)
+request_seconds = register(
+    Histogram("http_request_duration_seconds", "HTTP request latency", ("endpoint",))
+)
+# password hashing, WebAuthn verification, userdb persistence and lookups
+operation_seconds = register(
+    Histogram(
+        "app_operation_duration_seconds", "Latency of internal operations", ("operation",)
+    )
+)
+
+
+# Decorator: record the duration of every call as operation_seconds{operation}
+def timed(operation: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                operation_seconds.observe(time.perf_counter() - started, operation)
+
+        return wrapper
+
+    return decorator
+
+
+bp = Blueprint("metrics", __name__)
+
+
+# Prometheus text format. Each worker process has its own metrics.
+@bp.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(exposition(), mimetype="text/plain; version=0.0.4")
+
+
+def _endpoint() -> str:
+    # the route pattern, not the path, so the number of series stays bounded
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def _start_timer() -> None:
+    g.metrics_started = time.perf_counter()
+
+
+def _record(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        endpoint = _endpoint()
+        request_seconds.observe(time.perf_counter() - started, endpoint)
+        requests_total.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+
+# Count and time every request of the app, and serve /metrics
+def init_app(app: Flask) -> None:
+    app.before_request(_start_timer)
+    app.after_request(_record)
+    app.register_blueprint(bp)
@@ -1,51 +1,151 @@
+import os
+import sys
 from base64 import urlsafe_b64decode, urlsafe_b64encode
-from dataclasses import dataclass
-from typing import List, Optional, TypedDict
+from dataclasses import dataclass, field
+from typing import List, NamedTuple, Optional, Tuple, TypedDict
 
+# CredentialRecord / UserRecord are the persisted (JSON) form of
+# Credential / StoredUser, which are what is kept in memory.
 
-class CredentialRecord(TypedDict):
+
+class _CredentialRecordRequired(TypedDict):
     credential_id: str
     public_key: str
     sign_count: int
     transports: List[str]
 
 
-class UserRecord(TypedDict):
+class CredentialRecord(_CredentialRecordRequired, total=False):
+    # unix time of the last successful authentication
+    last_used: float
+
+
+# A new sign_count (and last use) of a credential, written by the stores in batches
+class SignCountUpdate(NamedTuple):
+    user_id: str
+    credential_id: str
+    sign_count: int
+    last_used: Optional[float] = None
+
+
+# A rehash of a user's password, written by the stores in batches. It only
+# applies while the stored hash is still `old_password`, so a password
+# changed in the meantime is never overwritten with an upgrade of the old one.
+class PasswordUpdate(NamedTuple):
+    user_id: str
+    old_password: str
+    password: str
+
+
+class _UserRecordRequired(TypedDict):
     password: str
     credentials: List[CredentialRecord]
 
 
-@dataclass
+class UserRecord(_UserRecordRequired, total=False):
+    # WebAuthn user handle (urlsafe-base64 w/o padding), once assigned
+    user_handle: str
+
+
+# Length of new user handles: random, so they are opaque (no user_id or other
+# personal data, which authenticators may show and store) and unique
+USER_HANDLE_BYTES = 16
+
+
+def new_user_handle() -> bytes:
+    return os.urandom(USER_HANDLE_BYTES)
+
+
+def b64encode_no_pad(b: bytes) -> str:
+    return urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+def b64decode_no_pad(s: str) -> bytes:
+    s_p = s + "=" * (-len(s) % 4)
+    return urlsafe_b64decode(s_p)
+
+
+# Slotted and immutable: a credential costs no per-instance dict, and keeps its
+# ids as raw bytes (not base64 strings) while in memory. Changing one means
+# replacing it (dataclasses.replace), which the copy-on-write userdb relies on.
+@dataclass(frozen=True, slots=True)
 class Credential:
     credential_id: bytes
     public_key: bytes
     sign_count: int
     transports: Optional[List[str]]
+    # unix time of the last successful authentication
+    last_used: Optional[float] = None
+    # The stored text of credential_id / public_key when it isn't the one
+    # b64encode_no_pad gives for its bytes (base64 with non-zero trailing
+    # bits), so that records round-trip unchanged. None otherwise, which is
+    # the case of every value encoded by this server.
+    credential_id_text: Optional[str] = field(default=None, compare=False, repr=False)
+    public_key_text: Optional[str] = field(default=None, compare=False, repr=False)
 
     def to_dict(self) -> dict:
         """Return a JSON-serializable dict; bytes fields are urlsafe-base64 encoded w/o padding."""
-
-        def _b64_no_pad(b: bytes) -> str:
-            return urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
-
-        return {
-            "credential_id": _b64_no_pad(self.credential_id),
-            "public_key": _b64_no_pad(self.public_key),
+        d = {
+            "credential_id": _text_of(self.credential_id, self.credential_id_text),
+            "public_key": _text_of(self.public_key, self.public_key_text),
             "sign_count": self.sign_count,
             "transports": self.transports,
         }
+        if self.last_used is not None:
+            d["last_used"] = self.last_used
+        return d
 
     @staticmethod
     def from_dict(d: CredentialRecord) -> "Credential":
         """Create a Credential from a dict (assuming produced by to_dict)."""
-
-        def _decode_b64(s: str) -> bytes:
-            s_p = s + "=" * (-len(s) % 4)
-            return urlsafe_b64decode(s_p)
-
+        transports = d.get("transports")
+        credential_id, credential_id_text = _bytes_of(d["credential_id"])
+        public_key, public_key_text = _bytes_of(d["public_key"])
         return Credential(
-            credential_id=_decode_b64(d["credential_id"]),
-            public_key=_decode_b64(d["public_key"]),
+            credential_id=credential_id,
+            public_key=public_key,
             sign_count=int(d["sign_count"]),
-            transports=d.get("transports"),
+            # the few transport names are shared by every credential
+            transports=None if transports is None else [sys.intern(t) for t in transports],
+            last_used=d.get("last_used"),
+            credential_id_text=credential_id_text,
+            public_key_text=public_key_text,
+        )
+
+
+# Decoded bytes of a stored base64 text, and the text if it isn't canonical
+def _bytes_of(text: str) -> Tuple[bytes, Optional[str]]:
+    raw = b64decode_no_pad(text)
+    return raw, None if b64encode_no_pad(raw) == text else text
+
+
+def _text_of(raw: bytes, text: Optional[str]) -> str:
+    return b64encode_no_pad(raw) if text is None else text
+
+
+# A user as kept in userdb (see Credential).
+# user_handle is None until the user first registers a passkey (see
+# UserStore.assign_user_handle).
+@dataclass(frozen=True, slots=True)
+class StoredUser:
+    password: str
+    credentials: Tuple[Credential, ...] = ()
+    user_handle: Optional[bytes] = None
+
+    def to_dict(self) -> UserRecord:
+        record = UserRecord(
+            password=self.password,
+            credentials=[cred.to_dict() for cred in self.credentials],  # type: ignore[misc]
+        )
+        if self.user_handle is not None:
+            record["user_handle"] = b64encode_no_pad(self.user_handle)
+        return record
+
+    @staticmethod
+    def from_dict(d: UserRecord) -> "StoredUser":
+        user_handle = d.get("user_handle")
+        return StoredUser(
+            password=d["password"],
+            credentials=tuple(Credential.from_dict(c) for c in d.get("credentials", [])),
+            user_handle=None if user_handle is None else b64decode_no_pad(user_handle),
         )
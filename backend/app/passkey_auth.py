@@ -1,6 +1,10 @@
 import os
 import traceback
+from typing import Optional, Tuple
 
+from app import challenges, descriptor_cache, pubkey_cache
+from app.metrics import operation_seconds
+from app.sign_counts import tracker
 from app.users import User
 from flask import Blueprint, jsonify, request, session
 from flask_login import login_user
@@ -8,29 +12,135 @@ from webauthn.authentication.generate_authentication_options import (
     generate_authentication_options,
 )
 from webauthn.authentication.verify_authentication_response import (
+    VerifiedAuthentication,
     verify_authentication_response,
 )
-from webauthn.helpers import options_to_json_dict
+from webauthn.helpers import base64url_to_bytes, options_to_json_dict
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
 from webauthn.helpers.structs import (
     UserVerificationRequirement,
 )
 
-RP_ID = os.getenv("RP_ID")
-EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN")
+RP_ID = os.getenv("RP_ID", "")
+EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN", "")
 
 bp = Blueprint("auth", __name__)
 
 
+# Descriptors of the credentials of user_id (None for an unknown user),
+# cached so that repeated options don't load the user and build them again
+def credential_descriptors(user_id: str) -> Optional[descriptor_cache.Descriptors]:
+    def load():
+        user = User.get_by_id(user_id)
+        return user.credentials if user else None
+
+    return descriptor_cache.cache.get(user_id, load)
+
+
+# Authentication options (as JSON), and their challenge.
+# With a username (username-first flow) allowCredentials lists that user's
+# credentials; without one the request is for a discoverable credential.
+def authentication_options(username: Optional[str] = None) -> Tuple[dict, bytes]:
+    allow_credentials = None
+    if username:
+        allow_credentials = list(credential_descriptors(username) or ())
+    options = generate_authentication_options(
+        rp_id=RP_ID,
+        user_verification=UserVerificationRequirement.PREFERRED,
+        allow_credentials=allow_credentials,
+    )
+    return options_to_json_dict(options), options.challenge
+
+
+# The userHandle of an authentication response (raw bytes), if any.
+# Authenticators return it with discoverable credentials.
+def user_handle_of(body: dict) -> Optional[bytes]:
+    response = body.get("response")
+    user_handle = response.get("userHandle") if isinstance(response, dict) else None
+    if not user_handle or not isinstance(user_handle, str):
+        return None
+    try:
+        return base64url_to_bytes(user_handle)
+    except ValueError:
+        return None
+
+
+# The owner of a credential and its (cached) public key, if both exist.
+# The user is resolved from the userHandle (user_handle), or is the one of
+# the username-first flow (user_id); then only that user's credentials are
+# candidates, and the credential must be one of them. Without either (or for
+# a userHandle the store doesn't know, e.g. of a credential registered before
+# users had a stable handle) the owner is found by the credential index.
+def credential_owner(
+    credential_id: str,
+    user_id: Optional[str] = None,
+    user_handle: Optional[bytes] = None,
+) -> Optional[Tuple[User, pubkey_cache.CachedPublicKey]]:
+    user = User.find_user_by_user_handle(user_handle) if user_handle else None
+    if user is None and user_id is not None:
+        user = User.get_by_id(user_id)
+        if user is None:
+            return None
+    if user is not None:
+        if user_id is not None and user.id != user_id:
+            return None
+        if user.get_pubkey(credential_id) is None:
+            return None
+    else:
+        user = User.find_user_by_credential_id(credential_id)
+        if not user:
+            return None
+    # decoded and parsed public keys of returning users are reused
+    public_key = pubkey_cache.cache.get(
+        credential_id, user.id, lambda: user.get_pubkey(credential_id)
+    )
+    if not public_key:
+        return None
+    return user, public_key
+
+
+# Verify an authentication response (JSON) against the challenge, and record
+# the new sign count of the credential.
+# Shared by the views of this module and of async_views.
+def verify_assertion(
+    user: User,
+    public_key: pubkey_cache.CachedPublicKey,
+    body: dict,
+    challenge: bytes,
+) -> VerifiedAuthentication:
+    stored = user.get_sign_count(body["id"])
+    with pubkey_cache.use(public_key), operation_seconds.time("verify_authentication"):
+        v = verify_authentication_response(
+            credential=body,
+            expected_challenge=challenge,
+            expected_rp_id=RP_ID,
+            expected_origin=EXPECTED_ORIGIN,
+            credential_public_key=public_key.public_key,
+            # py_webauthn rejects a counter which did not increase (a cloned authenticator)
+            credential_current_sign_count=tracker.current(body["id"], stored),
+            require_user_verification=False,
+        )
+    # checked again atomically: a concurrent login may have recorded the same
+    # (or a newer) counter since it was read above
+    if not tracker.record(user.id, body["id"], v.new_sign_count, stored):
+        raise InvalidAuthenticationResponse(
+            f"Response sign count of {v.new_sign_count} was not greater than "
+            "the current count"
+        )
+    return v
+
+
 # 認証オプション生成
+# ?username=<user_id> starts the username-first flow: only that user's
+# credentials are allowed, and then accepted by /verify-authentication.
 @bp.route("/generate-authentication-options", methods=["GET"])
 def authenticate_options():
+    username = request.args.get("username") or None
     try:
-        options = generate_authentication_options(
-            rp_id=RP_ID,
-            user_verification=UserVerificationRequirement.PREFERRED,
-        )
-        data = options_to_json_dict(options)
-        session["challenge"] = options.challenge
+        data, challenge = authentication_options(username)
+        # only the handle of the challenge goes into the (cookie) session
+        session["challenge"] = challenges.store.put(challenge)
+        session["challenge_user"] = username
         return jsonify(data)
     except Exception as e:
         print("error: with", e)
@@ -42,28 +152,22 @@ def authenticate_options():
 def authenticate_verify():
     body = request.json
 
-    user = User.find_user_by_credential_id(body["id"])
+    # one-shot: the challenge can't be used again whatever the result, even
+    # for an unknown credential
+    challenge_user = session.pop("challenge_user", None)
+    challenge = challenges.store.pop(session.pop("challenge", None))
 
     # Doesn't disclose whether user (or credential) exists for security reasons
-    if not user:
+    owner = credential_owner(body["id"], challenge_user, user_handle_of(body))
+    if owner is None:
         return jsonify({"error": "No credential for user with this site"}), 404
+    user, public_key = owner
 
-    public_key = user.get_pubkey(body["id"])
-
-    if not public_key:
-        return jsonify({"error": "No credential for user with this site"}), 404
+    if challenge is None:
+        return jsonify({"status": "failed", "error": "challenge expired or missing"}), 400
 
     try:
-        v = verify_authentication_response(
-            credential=body,
-            expected_challenge=session.get("challenge"),
-            expected_rp_id=RP_ID,
-            expected_origin=EXPECTED_ORIGIN,
-            credential_public_key=public_key,
-            credential_current_sign_count=0,
-            require_user_verification=False,
-        )
-        session["challenge"] = None
+        v = verify_assertion(user, public_key, body, challenge)
         session.clear()
         login_user(user)
         return jsonify({"status": "ok", "verified": v.user_verified})
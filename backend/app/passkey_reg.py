@@ -1,7 +1,11 @@
 import os
 import traceback
+from typing import Tuple
 
 import app.db as db
+from app import challenges, descriptor_cache
+from app.metrics import operation_seconds
+from app.model import b64encode_no_pad
 from app.users import User
 from flask import Blueprint, jsonify, request, session
 from flask_login import login_required
@@ -10,15 +14,69 @@ from webauthn.registration.generate_registration_options import (
     generate_registration_options,
 )
 from webauthn.registration.verify_registration_response import (
+    VerifiedRegistration,
     verify_registration_response,
 )
 
-RP_ID = os.getenv("RP_ID")
-EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN")
+RP_ID = os.getenv("RP_ID", "")
+EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN", "")
 
 bp = Blueprint("register", __name__)
 
 
+# Registration options for the user (as JSON), and their challenge.
+# user.id is the user's stable handle, which the authenticator stores with a
+# discoverable credential and returns as userHandle on login.
+# excludeCredentials lists the user's credentials, so an authenticator which
+# is already registered refuses to register again.
+def registration_options(user: User) -> Tuple[dict, bytes]:
+    exclude_credentials = descriptor_cache.cache.get(user.id, lambda: user.credentials)
+    options = generate_registration_options(
+        rp_id=RP_ID,
+        rp_name="Example WebAuthn",
+        user_name=user.get_id(),
+        user_id=user.get_user_handle(),
+        exclude_credentials=list(exclude_credentials or ()),
+    )
+    return options_to_json_dict(options), options.challenge
+
+
+# Verify a registration response (JSON) against the challenge and add the
+# new credential to the user.
+def register_credential(user: User, body: dict, challenge: bytes) -> VerifiedRegistration:
+    v = verify_registration(body, challenge)
+    store_credential(user, body, v)
+    return v
+
+
+# The two steps of register_credential, which async_views runs on its CPU
+# and I/O thread pools respectively
+def verify_registration(body: dict, challenge: bytes) -> VerifiedRegistration:
+    with operation_seconds.time("verify_registration"):
+        return verify_registration_response(
+            credential=body,
+            expected_challenge=challenge,
+            expected_rp_id=RP_ID,
+            expected_origin=EXPECTED_ORIGIN,
+            require_user_verification=False,
+        )
+
+
+def store_credential(user: User, body: dict, v: VerifiedRegistration) -> None:
+    # clients may ignore excludeCredentials
+    if db.store.find_by_credential(b64encode_no_pad(v.credential_id)) is not None:
+        raise ValueError("credential already registered")
+
+    user.update_credential(
+        db.Credential(
+            credential_id=v.credential_id,
+            public_key=v.credential_public_key,
+            sign_count=v.sign_count,
+            transports=body.get("transports", []),
+        )
+    )
+
+
 # 登録オプション生成
 @bp.route("/generate-registration-options", methods=["GET"])
 @login_required
@@ -26,13 +84,9 @@ def register_options():
     user = User.get_by_id(session.get("_user_id"))
 
     try:
-        options = generate_registration_options(
-            rp_id=RP_ID,
-            rp_name="Example WebAuthn",
-            user_name=user.get_id(),
-        )
-        data = options_to_json_dict(options)
-        session["challenge"] = options.challenge
+        data, challenge = registration_options(user)
+        # only the handle of the challenge goes into the (cookie) session
+        session["challenge"] = challenges.store.put(challenge)
         return jsonify(data)
     except Exception as e:
         print("error: with", e)
@@ -46,24 +100,13 @@ def register_verify():
     user = User.get_by_id(session.get("_user_id"))
     body = request.json
 
-    try:
-        v = verify_registration_response(
-            credential=body,
-            expected_challenge=session.get("challenge"),
-            expected_rp_id=RP_ID,
-            expected_origin=EXPECTED_ORIGIN,
-            require_user_verification=False,
-        )
+    # one-shot: the challenge can't be used again whatever the result
+    challenge = challenges.store.pop(session.pop("challenge", None))
+    if challenge is None:
+        return jsonify({"status": "failed", "error": "challenge expired or missing"}), 400
 
-        user.update_credential(
-            db.Credential(
-                credential_id=v.credential_id,
-                public_key=v.credential_public_key,
-                sign_count=v.sign_count,
-                transports=body.get("transports", []),
-            )
-        )
-        session["challenge"] = None
+    try:
+        v = register_credential(user, body, challenge)
         return jsonify({"status": "ok", "verified": v.user_verified})
     except Exception as e:
         traceback.print_exc()
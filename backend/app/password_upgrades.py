@@ -0,0 +1,94 @@
+import os
+import threading
+from typing import Dict, Optional
+
+import app.db as db
+from app.hashing import HashingOverloaded, hasher
+from app.model import PasswordUpdate
+
+# Interval of writing rehashed passwords to the store (0 = on every login).
+# Rehashes lost on a crash are simply made again on the next login.
+PASSWORD_UPGRADE_FLUSH_SECONDS = float(
+    os.getenv("PASSWORD_UPGRADE_FLUSH_SECONDS", "5")
+)
+
+
+# Transparent upgrade of password hashes made with an outdated method
+# (PASSWORD_HASH_METHOD changed since). A successful password login is the
+# only time the plain password is known, so the new hash is made then; it is
+# written by a worker thread, in one batch through store.update_passwords
+# every `interval` seconds, like the sign counts.
+class PasswordUpgrader:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending: Dict[str, PasswordUpdate] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.flushed_updates = 0
+
+    # Rehash `password`, just verified against the user's `pwhash`, if that
+    # was made with another method. Returns whether it was rehashed.
+    def upgrade(self, user_id: str, pwhash: str, password: str) -> bool:
+        if not hasher.needs_rehash(pwhash) or user_id in self._pending:
+            return False
+        try:
+            new_hash = hasher.generate(password)
+        except HashingOverloaded:
+            # the login succeeded anyway; the next one upgrades
+            return False
+        with self._lock:
+            self._pending[user_id] = PasswordUpdate(user_id, pwhash, new_hash)
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._ensure_worker()
+        return True
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._run, name="password-upgrader", daemon=True
+                    )
+                    self._worker.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("error: password upgrade flush failed with", e)
+
+    # Write every pending rehash to the store in one batch
+    def flush(self) -> None:
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+
+        try:
+            db.store.update_passwords(list(pending.values()))
+        except Exception:
+            with self._lock:
+                for user_id, update in pending.items():
+                    self._pending.setdefault(user_id, update)
+            raise
+        self.flushes += 1
+        self.flushed_updates += len(pending)
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        self.flush()
+
+
+upgrader = PasswordUpgrader(PASSWORD_UPGRADE_FLUSH_SECONDS)
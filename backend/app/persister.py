@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Union
+
+_STOP = object()
+
+
+# Write-behind persistence with group commit.
+#
+# Changes only mark the data dirty; a worker thread flushes as soon as there
+# is a mark, and the marks made while a flush is running (up to `max_batch`)
+# are coalesced into the next single call of `flush`. So an idle store saves
+# without delay, and a busy one saves about once per flush time however many
+# changes arrive. A caller either waits until a flush covering its change is
+# done ("wait for flush") or returns right away ("fire and forget").
+# With window=0 there is no worker and every mark flushes synchronously.
+class WriteBehindPersister:
+    def __init__(self, flush: Callable[[], None], window: float, max_batch: int):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+
+        self._queue: "queue.Queue[Union[Future, object]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+        # metrics
+        self.marks = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._run, name="userdb-persister", daemon=True
+                    )
+                    self._worker.start()
+
+    # Mark the data dirty.
+    # With wait=True, block until it has been flushed (and raise if it failed).
+    def mark_dirty(self, wait: bool = True) -> None:
+        if self.window <= 0:
+            self.marks += 1
+            self._flush_batch([])
+            return
+
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put(future)
+        if wait:
+            future.result()
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            # Coalesce only the marks already queued: those made while the
+            # previous flush ran. A lone mark is flushed right away.
+            batch: List[Future] = [item]  # type: ignore[list-item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)  # type: ignore[arg-type]
+
+            self.marks += len(batch)
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch: List[Future]) -> None:
+        started = time.perf_counter()
+        try:
+            self.flush()
+        except Exception as e:
+            self.flush_errors += 1
+            for future in batch:
+                future.set_exception(e)
+            if not batch:
+                raise
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+        for future in batch:
+            future.set_result(None)
+
+    # Flush whatever is pending and stop the worker
+    def close(self) -> None:
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None:
+            self._queue.put(_STOP)
+            worker.join()
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "marks": self.marks,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "total_flush_seconds": self.total_flush_seconds,
+        }
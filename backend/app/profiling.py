@@ -0,0 +1,299 @@
+import cProfile
+import dataclasses
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, FrozenSet, Optional
+
+from flask import Flask, g, request
+
+# Opt-in profiling of sampled requests (see Profiler). Off unless PROFILE_ENABLED=1;
+# every setting can be changed at runtime with POST /admin/profiling.
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+# "cprofile" (one .prof file per request) or "stacks" (aggregated collapsed stacks)
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+# fraction of all requests to profile
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# comma-separated route patterns (as in /metrics, e.g. "/login") always profiled
+PROFILE_ENDPOINTS = os.getenv("PROFILE_ENDPOINTS", "")
+# requests sent with the header "X-Profile: <PROFILE_TOKEN>" are profiled (empty = never)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# oldest files in PROFILE_DIR are removed beyond this size
+PROFILE_MAX_BYTES = int(os.getenv("PROFILE_MAX_BYTES", str(100 * 1024 * 1024)))
+# stack sampler: sampling interval, and interval of writing a new stacks file
+PROFILE_STACK_INTERVAL_MS = float(os.getenv("PROFILE_STACK_INTERVAL_MS", "5"))
+PROFILE_STACK_FLUSH_SECONDS = float(os.getenv("PROFILE_STACK_FLUSH_SECONDS", "60"))
+
+PROFILE_HEADER = "X-Profile"
+MODES = ("cprofile", "stacks")
+
+
+def _split(value: str) -> FrozenSet[str]:
+    return frozenset(v for v in value.split(",") if v)
+
+
+# Replaced as a whole on every change, so a request reads one consistent config
+@dataclasses.dataclass(frozen=True)
+class ProfileConfig:
+    enabled: bool = False
+    mode: str = "cprofile"
+    sample_rate: float = 0.0
+    endpoints: FrozenSet[str] = frozenset()
+    token: str = ""
+    directory: str = "profiles"
+    max_bytes: int = 100 * 1024 * 1024
+    stack_interval: float = 0.005
+    stack_flush_seconds: float = 60.0
+
+    def __post_init__(self) -> None:
+        if self.mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        if not 0.0 <= self.sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        if self.max_bytes < 0:
+            raise ValueError("max_bytes must not be negative")
+        if self.stack_interval <= 0 or self.stack_flush_seconds <= 0:
+            raise ValueError("stack intervals must be positive")
+
+    def to_dict(self) -> dict:
+        d = dataclasses.asdict(self)
+        d["endpoints"] = sorted(self.endpoints)
+        del d["token"]
+        return d
+
+
+def config_from_env() -> ProfileConfig:
+    return ProfileConfig(
+        enabled=PROFILE_ENABLED,
+        mode=PROFILE_MODE,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        endpoints=_split(PROFILE_ENDPOINTS),
+        token=PROFILE_TOKEN,
+        directory=PROFILE_DIR,
+        max_bytes=PROFILE_MAX_BYTES,
+        stack_interval=PROFILE_STACK_INTERVAL_MS / 1000,
+        stack_flush_seconds=PROFILE_STACK_FLUSH_SECONDS,
+    )
+
+
+# Name of a frame in a collapsed stack
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# Samples the stacks of the threads serving profiled requests every
+# `interval` seconds, aggregated as collapsed stacks ("root;...;leaf count",
+# the input format of flamegraph.pl and speedscope). A new file is written
+# every `flush_seconds` and when the sampler stops.
+class StackSampler:
+    def __init__(self, profiler: "Profiler", interval: float, flush_seconds: float):
+        self.profiler = profiler
+        self.interval = interval
+        self.flush_seconds = flush_seconds
+        self.samples = 0
+        self._threads: Dict[int, int] = {}  # thread ident -> profiled requests
+        self._stacks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+        self._worker.start()
+
+    def add_thread(self, ident: int) -> None:
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+
+    def remove_thread(self, ident: int) -> None:
+        with self._lock:
+            count = self._threads.pop(ident, 1) - 1
+            if count > 0:
+                self._threads[ident] = count
+
+    def sample(self) -> None:
+        with self._lock:
+            idents = list(self._threads)
+        if not idents:
+            return
+        frames = sys._current_frames()
+        with self._lock:
+            for ident in idents:
+                frame = frames.get(ident)
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if names:
+                    stack = ";".join(reversed(names))
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            stacks, self._stacks = self._stacks, {}
+        if stacks:
+            lines = "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+            self.profiler.write("stacks", "txt", lines.encode())
+
+    def _run(self) -> None:
+        next_flush = time.monotonic() + self.flush_seconds
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_seconds
+        self.flush()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._worker.join()
+
+
+# Profiling hook around the requests of an app.
+#
+# When enabled, a request is profiled if its route is one of `endpoints`,
+# if it carries the X-Profile header with the configured token, or else
+# with probability `sample_rate`. In "cprofile" mode each profiled request
+# is written to <directory>/<time>-<pid>-<route>.prof (load it with pstats
+# or snakeviz); in "stacks" mode a sampler thread aggregates the stacks of
+# profiled requests (see StackSampler).
+# When disabled a request only reads `config.enabled`.
+# Files of this process beyond `max_bytes` in total are removed oldest first.
+class Profiler:
+    def __init__(self, config: ProfileConfig):
+        self.config = ProfileConfig()
+        self.profiled = 0
+        self.skipped = 0
+        self.files_written = 0
+        self.files_removed = 0
+        self._lock = threading.Lock()
+        self._sampler: Optional[StackSampler] = None
+        self.configure(config)
+
+    # Apply a new config, starting or stopping the stack sampler as needed
+    def configure(self, config: ProfileConfig) -> None:
+        with self._lock:
+            sampler = self._sampler
+            self._sampler = None
+            if config.enabled and config.mode == "stacks":
+                self._sampler = StackSampler(
+                    self, config.stack_interval, config.stack_flush_seconds
+                )
+            self.config = config
+        if sampler is not None:
+            sampler.stop()
+
+    def update(self, **changes) -> ProfileConfig:
+        if "endpoints" in changes:
+            if isinstance(changes["endpoints"], str):
+                raise ValueError("endpoints must be a list of routes")
+            changes["endpoints"] = frozenset(changes["endpoints"])
+        config = dataclasses.replace(self.config, **changes)
+        self.configure(config)
+        return config
+
+    def should_profile(self, config: ProfileConfig) -> bool:
+        rule = request.url_rule
+        if rule is not None and rule.rule in config.endpoints:
+            return True
+        if config.token and request.headers.get(PROFILE_HEADER) == config.token:
+            return True
+        return config.sample_rate > 0 and random.random() < config.sample_rate
+
+    def _start(self) -> None:
+        config = self.config
+        if not config.enabled or not self.should_profile(config):
+            return
+        if config.mode == "stacks":
+            sampler = self._sampler
+            if sampler is None:
+                return
+            sampler.add_thread(threading.get_ident())
+            g.profile = sampler
+        else:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is active in this thread (or, on Python
+                # 3.12+, in this process)
+                self.skipped += 1
+                return
+            g.profile = profile
+        self.profiled += 1
+
+    def _stop(self, exc: Optional[BaseException] = None) -> None:
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        if isinstance(profile, StackSampler):
+            profile.remove_thread(threading.get_ident())
+            return
+        profile.disable()
+        rule = request.url_rule
+        route = rule.rule.strip("/").replace("/", "_") if rule is not None else ""
+        self.write(route or "unmatched", "prof", _dump(profile))
+
+    # Write a profile file, then enforce the size cap
+    def write(self, name: str, suffix: str, data: bytes) -> None:
+        config = self.config
+        os.makedirs(config.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        base = f"{stamp}-{time.time_ns() % 10**9:09d}-{os.getpid()}-{name}"
+        path = os.path.join(config.directory, f"{base}.{suffix}")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.files_written += 1
+            self._rotate(config)
+
+    # Remove the oldest files of this process until they fit in max_bytes.
+    # Other processes (workers) sharing the directory rotate their own files.
+    def _rotate(self, config: ProfileConfig) -> None:
+        marker = f"-{os.getpid()}-"
+        files = []
+        with os.scandir(config.directory) as entries:
+            for entry in entries:
+                if marker in entry.name and entry.name.endswith((".prof", ".txt")):
+                    files.append((entry.name, entry.stat().st_size, entry.path))
+        files.sort()  # names start with the time written
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= config.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.files_removed += 1
+
+    def stats(self) -> Dict[str, float]:
+        sampler = self._sampler
+        return {
+            "enabled": int(self.config.enabled),
+            "profiled": self.profiled,
+            "skipped": self.skipped,
+            "files_written": self.files_written,
+            "files_removed": self.files_removed,
+            "stack_samples": sampler.samples if sampler is not None else 0,
+        }
+
+    def init_app(self, app: Flask) -> None:
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+
+    def close(self) -> None:
+        self.configure(dataclasses.replace(self.config, enabled=False))
+
+
+# The stats of a cProfile.Profile in the format of Profile.dump_stats
+def _dump(profile: cProfile.Profile) -> bytes:
+    profile.create_stats()
+    return marshal.dumps(profile.stats)  # type: ignore[attr-defined]
+
+
+profiler = Profiler(config_from_env())
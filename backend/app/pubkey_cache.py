@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, Set
+
+import webauthn.authentication.verify_authentication_response as _verify_module
+from webauthn.helpers import (
+    decode_credential_public_key,
+    decoded_public_key_to_cryptography,
+)
+
+# Max number of credentials whose public keys are kept
+PUBKEY_CACHE_SIZE = int(os.getenv("PUBKEY_CACHE_SIZE", "10000"))
+
+
+# Public key of a credential in the forms verification needs:
+# the COSE bytes, py_webauthn's decoded COSE structure and the cryptography
+# key object. The latter two are built on first use and then reused.
+class CachedPublicKey:
+    __slots__ = ("user_id", "public_key", "_decoded", "_crypto")
+
+    def __init__(self, user_id: str, public_key: bytes):
+        self.user_id = user_id
+        self.public_key = public_key
+        self._decoded: Any = None
+        self._crypto: Any = None
+
+    def decoded(self) -> Any:
+        if self._decoded is None:
+            self._decoded = decode_credential_public_key(self.public_key)
+        return self._decoded
+
+    def crypto(self) -> Any:
+        if self._crypto is None:
+            self._crypto = decoded_public_key_to_cryptography(self.decoded())
+        return self._crypto
+
+
+# Bounded LRU of CachedPublicKey keyed by credential_id
+# (urlsafe-base64 w/o padding, as sent in the assertion's `id`).
+class PublicKeyCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, CachedPublicKey]" = OrderedDict()
+        self._by_user: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached key of credential_id owned by user_id.
+    # On a miss, `load` returns the decoded public key bytes (or None).
+    def get(
+        self, credential_id: str, user_id: str, load: Callable[[], Optional[bytes]]
+    ) -> Optional[CachedPublicKey]:
+        with self._lock:
+            entry = self._entries.get(credential_id)
+            if entry is not None and entry.user_id == user_id:
+                self._entries.move_to_end(credential_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        public_key = load()
+        if public_key is None:
+            return None
+
+        entry = CachedPublicKey(user_id, public_key)
+        with self._lock:
+            self._entries[credential_id] = entry
+            self._entries.move_to_end(credential_id)
+            self._by_user.setdefault(user_id, set()).add(credential_id)
+            while len(self._entries) > self.maxsize:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self._forget(evicted.user_id, evicted_id)
+                self.evictions += 1
+        return entry
+
+    def _forget(self, user_id: str, credential_id: str) -> None:
+        ids = self._by_user.get(user_id)
+        if ids is not None:
+            ids.discard(credential_id)
+            if not ids:
+                del self._by_user[user_id]
+
+    # Drop every cached key of the user (called when its credentials change)
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            for credential_id in self._by_user.pop(user_id, set()):
+                self._entries.pop(credential_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+cache = PublicKeyCache(PUBKEY_CACHE_SIZE)
+
+
+# py_webauthn's verify_authentication_response takes the public key as COSE
+# bytes and parses it on every call. While `use(key)` is active, its parsing
+# steps return the already parsed forms from `key` instead; any other key
+# (or any other caller) goes through the original functions.
+_current: ContextVar[Optional[CachedPublicKey]] = ContextVar(
+    "current_public_key", default=None
+)
+
+
+def _cached_decode_credential_public_key(key: bytes) -> Any:
+    entry = _current.get()
+    if entry is not None and entry.public_key == key:
+        return entry.decoded()
+    return decode_credential_public_key(key)
+
+
+def _cached_decoded_public_key_to_cryptography(public_key: Any) -> Any:
+    entry = _current.get()
+    if entry is not None and entry._decoded is public_key:
+        return entry.crypto()
+    return decoded_public_key_to_cryptography(public_key)
+
+
+@contextmanager
+def use(key: CachedPublicKey) -> Iterator[None]:
+    token = _current.set(key)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+# Only hook py_webauthn versions which look up these helpers as module globals
+if hasattr(_verify_module, "decode_credential_public_key") and hasattr(
+    _verify_module, "decoded_public_key_to_cryptography"
+):
+    _verify_module.decode_credential_public_key = _cached_decode_credential_public_key  # type: ignore[attr-defined]
+    _verify_module.decoded_public_key_to_cryptography = _cached_decoded_public_key_to_cryptography  # type: ignore[attr-defined]
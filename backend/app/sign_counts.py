@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import app.db as db
+from app.model import SignCountUpdate
+
+# Interval of writing sign counts / last use to the store.
+# Up to this much of them may be lost on a crash. 0 writes on every login.
+SIGN_COUNT_FLUSH_SECONDS = float(os.getenv("SIGN_COUNT_FLUSH_SECONDS", "5"))
+
+
+# Hot table of the latest sign_count and last use of credentials.
+#
+# A successful authentication only updates this table; a worker thread writes
+# the changed entries to the store in one batch every `interval` seconds.
+# Until then the table is authoritative: `current` returns its value rather
+# than the (possibly older) stored one, so clone detection sees every login.
+# Once written, an entry is dropped (unless a newer one was recorded in the
+# meantime): the store answers the same, and the table only holds credentials
+# used within the last interval instead of every one ever used.
+# The table is per process: with several worker processes (gunicorn.conf.py)
+# it only catches clones logging in through the same worker, so that
+# configuration writes through (interval 0) and every worker checks against
+# the store's count.
+class SignCountTracker:
+    def __init__(
+        self,
+        interval: float,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.interval = interval
+        self.clock = clock
+        self._hot: Dict[str, SignCountUpdate] = {}
+        self._dirty: Dict[str, SignCountUpdate] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.flushed_updates = 0
+
+    # sign_count to verify the next assertion of credential_id against
+    def current(self, credential_id: str, stored: int) -> int:
+        hot = self._hot.get(credential_id)
+        return stored if hot is None else max(hot.sign_count, stored)
+
+    # Record sign_count of a verified assertion, unless it did not increase
+    # over the current one (`stored` or the table's): two concurrent logins
+    # verified against the same count must not both succeed. Checked and set
+    # under one lock; returns whether it was recorded.
+    # A counter of 0 stays allowed while the current one is 0 too (an
+    # authenticator without counter), as in py_webauthn.
+    def record(
+        self, user_id: str, credential_id: str, sign_count: int, stored: int = 0
+    ) -> bool:
+        update = SignCountUpdate(user_id, credential_id, sign_count, self.clock())
+        with self._lock:
+            hot = self._hot.get(credential_id)
+            current = stored if hot is None else max(hot.sign_count, stored)
+            if (sign_count > 0 or current > 0) and sign_count <= current:
+                return False
+            self._hot[credential_id] = update
+            self._dirty[credential_id] = update
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._ensure_worker()
+        return True
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._run, name="sign-count-flusher", daemon=True
+                    )
+                    self._worker.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("error: sign count flush failed with", e)
+
+    # Write every changed entry to the store in one batch
+    def flush(self) -> None:
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+        if not dirty:
+            return
+
+        try:
+            db.store.update_sign_counts(list(dirty.values()))
+        except Exception:
+            # retry on the next flush, unless a newer value was recorded since
+            with self._lock:
+                for credential_id, update in dirty.items():
+                    self._dirty.setdefault(credential_id, update)
+            raise
+        with self._lock:
+            for credential_id, update in dirty.items():
+                if self._hot.get(credential_id) is update:
+                    del self._hot[credential_id]
+        self.flushes += 1
+        self.flushed_updates += len(dirty)
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        self.flush()
+
+
+tracker = SignCountTracker(SIGN_COUNT_FLUSH_SECONDS)
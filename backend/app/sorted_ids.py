@@ -0,0 +1,67 @@
+import bisect
+from typing import Iterable, Iterator, List, Optional
+
+# Ids per block of SortedIds; a block is split in two once it doubles
+BLOCK_SIZE = 1000
+
+
+# Sorted set of ids for keyset pages, kept in blocks of less than
+# 2 * BLOCK_SIZE ids. An insert moves the ids of one block rather than of the
+# whole list, so it stays cheap at millions of ids, and a page is a binary
+# search over the last id of every block and then within one block.
+# Not thread-safe: the owner's lock guards it.
+class SortedIds:
+    def __init__(self, ids: Iterable[str] = ()):
+        self._blocks: List[List[str]] = []
+        self._maxes: List[str] = []
+        self._len = 0
+        self._rebuild(sorted(set(ids)))
+
+    def _rebuild(self, ids: List[str]) -> None:
+        self._blocks = [ids[i : i + BLOCK_SIZE] for i in range(0, len(ids), BLOCK_SIZE)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(ids)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        for block in self._blocks:
+            yield from block
+
+    def add(self, user_id: str) -> None:
+        if not self._blocks:
+            self._blocks, self._maxes, self._len = [[user_id]], [user_id], 1
+            return
+        i = min(bisect.bisect_left(self._maxes, user_id), len(self._blocks) - 1)
+        block = self._blocks[i]
+        at = bisect.bisect_left(block, user_id)
+        if at < len(block) and block[at] == user_id:
+            return
+        block.insert(at, user_id)
+        self._maxes[i] = block[-1]
+        self._len += 1
+        if len(block) >= 2 * BLOCK_SIZE:
+            self._blocks[i : i + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            self._maxes[i : i + 1] = [block[BLOCK_SIZE - 1], block[-1]]
+
+    # Many at once: merged in one pass when they are many
+    def update(self, user_ids: Iterable[str]) -> None:
+        new = sorted(set(user_ids))
+        if len(new) > BLOCK_SIZE:
+            self._rebuild(sorted(set(self).union(new)))
+        else:
+            for user_id in new:
+                self.add(user_id)
+
+    # Up to `size` ids > after (from the first if None), in order
+    def slice_after(self, after: Optional[str], size: int) -> List[str]:
+        i = 0 if after is None else bisect.bisect_right(self._maxes, after)
+        page: List[str] = []
+        while i < len(self._blocks) and len(page) < size:
+            block = self._blocks[i]
+            start = 0 if after is None else bisect.bisect_right(block, after)
+            page.extend(block[start : start + size - len(page)])
+            after = None
+            i += 1
+        return page
@@ -1,82 +1,123 @@
-from typing import List, Optional
+from typing import Optional, Sequence
 
 import app.db as db
+from app import descriptor_cache, pubkey_cache
+from app.hashing import HashingOverloaded, hasher
+from app.metrics import timed
 from flask import Blueprint, jsonify, request, session
 from flask_login import UserMixin, login_required
-from werkzeug.security import generate_password_hash
 
 bp = Blueprint("user", __name__)
 
 
 # User class for flask_login
+# Stored credentials are already decoded (raw bytes) in memory,
+# so loading a user for `login_required` costs no base64 decoding.
 class User(UserMixin):
     id: str
     password: str
-    credentials: List[db.Credential]
+    credentials: Sequence[db.Credential]
+    user_handle: Optional[bytes]
 
     def __init__(
         self,
         username: str,
         password: str,
-        credentials: Optional[List[db.Credential]] = None,
+        credentials: Optional[Sequence[db.Credential]] = None,
+        user_handle: Optional[bytes] = None,
     ):
         self.id = username
         self.password = password
-        self.credentials = credentials or []
+        self.credentials = credentials if credentials is not None else []
+        self.user_handle = user_handle
 
     def get_id(self):
         return self.id
 
     # Create a new user as a record in userdb
     def create(self):
-        db.append_user(user_id=self.id, password=self.password)
+        db.store.add_user(
+            user_id=self.id, password=self.password, wait=db.USERDB_WRITE_WAIT
+        )
+
+    # The WebAuthn user handle (user.id of the registration options), which
+    # authenticators return with discoverable credentials.
+    # Users get one the first time they register a passkey.
+    def get_user_handle(self) -> bytes:
+        if self.user_handle is None:
+            self.user_handle = db.store.assign_user_handle(
+                self.id, wait=db.USERDB_WRITE_WAIT
+            )
+        return self.user_handle
 
     def update_credential(self, credential: db.Credential):
-        db.update_user_credentials(user_id=self.id, credential=credential)
+        db.store.add_credential(
+            user_id=self.id, credential=credential, wait=db.USERDB_WRITE_WAIT
+        )
+        pubkey_cache.cache.invalidate_user(self.id)
+        descriptor_cache.cache.invalidate_user(self.id)
+
+    def _find_credential(self, credential_id: bytes | str) -> Optional[db.Credential]:
+        if isinstance(credential_id, str):
+            raw_id = db.decode_credential_id(credential_id)
+            if raw_id is None:
+                return None
+            credential_id = raw_id
+
+        for cred in self.credentials:
+            if cred.credential_id == credential_id:
+                return cred
+        return None
 
     # Return public_key corresponding to the given credential_id
     def get_pubkey(self, credential_id: bytes | str) -> Optional[bytes]:
-        if isinstance(credential_id, str):
-            return db.find_decoded_public_key(self.id, credential_id)
+        cred = self._find_credential(credential_id)
+        return cred.public_key if cred else None
 
-        if isinstance(credential_id, bytes):
-            for cred in self.credentials:
-                if cred.credential_id == credential_id:
-                    return cred.public_key
-        return None
+    # Return the stored sign_count of the given credential_id (0 if unknown)
+    def get_sign_count(self, credential_id: bytes | str) -> int:
+        cred = self._find_credential(credential_id)
+        return cred.sign_count if cred else 0
 
     @staticmethod
+    @timed("get_user")
     def get_by_id(user_id: str) -> Optional["User"]:
-        user = db.userdb.get(user_id)
+        user = db.store.get_user(user_id)
         if user:
-            return User(
-                user_id,
-                user["password"],
-                [db.Credential.from_dict(cred) for cred in user["credentials"]],
-            )
+            return User(user_id, user.password, user.credentials, user.user_handle)
         return None
 
+    # The user a userHandle of an assertion belongs to (an index lookup)
+    @staticmethod
+    @timed("find_user_by_user_handle")
+    def find_user_by_user_handle(user_handle: bytes) -> Optional["User"]:
+        user_id = db.store.find_by_user_handle(user_handle)
+        if user_id is None:
+            return None
+        return User.get_by_id(user_id)
+
     # SELECT credential.credential_id FROM user
     # INNER JOIN credential ON user.id = credential.user_id
     # find the user who has
     #   1. credentials related to the user are not empty
     #   2. at least 1 credential, credential_id matches request body's id (credential_id)
+    # The join is served by the store (an index on credential_id).
     @staticmethod
+    @timed("find_user_by_credential")
     def find_user_by_credential_id(credential_id: bytes | str) -> Optional["User"]:
-        for user_id, user in db.userdb.items():
-            for cred in user.get("credentials", []):
-                if cred["credential_id"] == credential_id:
-                    return User(
-                        user_id,
-                        user["password"],
-                        [db.Credential.from_dict(cred) for cred in user["credentials"]],
-                    )
-        return None
+        if not isinstance(credential_id, str):
+            return None
+        user_id = db.store.find_by_credential(credential_id)
+        if user_id is None:
+            return None
+        return User.get_by_id(user_id)
 
 
 @bp.route("/users", methods=["POST"])
 def create_user():
     data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "username and password required"}), 400
     username = data.get("username")
     password = data.get("password")
 
@@ -86,7 +127,10 @@ def create_user():
     if User.get_by_id(username):
         return jsonify({"error": "user already exists"}), 400
 
-    user = User(username, generate_password_hash(password))
+    try:
+        user = User(username, hasher.generate(password))
+    except HashingOverloaded:
+        return jsonify({"error": "server busy"}), 503, {"Retry-After": "1"}
     user.create()
 
     return jsonify({"status": "created", "username": username})
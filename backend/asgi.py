@@ -0,0 +1,45 @@
+# Async serving mode: the auth endpoints of main.py on an ASGI server.
+#
+#   SECRET_KEY=<random string> uvicorn asgi:app     (or: hypercorn asgi:app)
+#
+# Routes, JSON bodies and session cookies are the same as main:app (a
+# session created by one mode is valid in the other with the same
+# SECRET_KEY); see app/async_views.py. The /admin endpoints are only served
+# by main:app.
+import os
+import re
+from typing import Any, Mapping, Optional
+
+import app.db as db
+from app import async_views
+from app.hashing import hasher
+from app.password_upgrades import upgrader
+from app.sign_counts import tracker
+from quart import Quart
+from quart_cors import cors
+
+
+def create_asgi_app(config: Optional[Mapping[str, Any]] = None) -> Quart:
+    app = Quart(__name__)
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+    if config:
+        app.config.update(config)
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = os.urandom(24)
+
+    # as flask_cors with supports_credentials: the request's origin is allowed
+    app = cors(app, allow_origin=re.compile(".*"), allow_credentials=True)
+    app.register_blueprint(async_views.bp)
+
+    @app.after_serving
+    async def teardown() -> None:
+        async_views.shutdown()
+        hasher.close()
+        tracker.close()
+        upgrader.close()
+        db.store.close()
+
+    return app
+
+
+app = create_asgi_app()
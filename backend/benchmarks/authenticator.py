@@ -0,0 +1,189 @@
+"""Software WebAuthn authenticator, to drive the passkey endpoints without a browser.
+
+    authenticator = SoftAuthenticator("es256")  # or "ed25519"
+    credential = authenticator.create(registration_options, origin)  # -> POST /verify-registration
+    assertion = authenticator.get(authentication_options, origin)  # -> POST /verify-authentication
+
+The options are the JSON returned by /generate-registration-options and
+/generate-authentication-options. Attestation is "none"; the user is always
+present and verified.
+"""
+
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import cbor2
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from webauthn.helpers import base64url_to_bytes, bytes_to_base64url
+
+# COSE algorithm identifiers
+ES256 = -7
+EDDSA = -8
+ALGORITHMS = {"es256": ES256, "ed25519": EDDSA}
+
+# authenticator data flags
+UP = 0x01
+UV = 0x04
+AT = 0x40
+
+AAGUID = bytes(16)
+
+PrivateKey = Union[ec.EllipticCurvePrivateKey, ed25519.Ed25519PrivateKey]
+
+
+class StoredCredential(NamedTuple):
+    credential_id: bytes
+    rp_id: str
+    user_handle: bytes
+    private_key: PrivateKey
+
+
+def generate_key(alg: int) -> PrivateKey:
+    if alg == ES256:
+        return ec.generate_private_key(ec.SECP256R1())
+    if alg == EDDSA:
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"unsupported algorithm {alg}")
+
+
+# Public key in COSE_Key format, as stored in the attested credential data
+def cose_public_key(private_key: PrivateKey) -> bytes:
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        x = private_key.public_key().public_bytes_raw()
+        return cbor2.dumps({1: 1, 3: EDDSA, -1: 6, -2: x})  # kty: OKP, crv: Ed25519
+    numbers = private_key.public_key().public_numbers()
+    return cbor2.dumps(
+        {
+            1: 2,  # kty: EC2
+            3: ES256,
+            -1: 1,  # crv: P-256
+            -2: numbers.x.to_bytes(32, "big"),
+            -3: numbers.y.to_bytes(32, "big"),
+        }
+    )
+
+
+def sign(private_key: PrivateKey, data: bytes) -> bytes:
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(data)
+    return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+
+def client_data(type_: str, challenge: str, origin: str) -> bytes:
+    return json.dumps(
+        {"type": type_, "challenge": challenge, "origin": origin, "crossOrigin": False},
+        separators=(",", ":"),
+    ).encode()
+
+
+# A platform authenticator holding resident credentials in memory.
+# `alg` is the algorithm of new credentials ("es256" or "ed25519"); the
+# relying party must list it in pubKeyCredParams.
+class SoftAuthenticator:
+    def __init__(self, alg: str = "es256", transports: Optional[List[str]] = None):
+        if alg not in ALGORITHMS:
+            raise ValueError(f"alg must be one of {', '.join(ALGORITHMS)}")
+        self.alg = ALGORITHMS[alg]
+        self.transports = transports if transports is not None else ["internal"]
+        self.sign_count = 0
+        self.credentials: Dict[bytes, StoredCredential] = {}
+
+    def _auth_data(self, rp_id: str, flags: int, attested: bytes = b"") -> bytes:
+        rp_id_hash = hashlib.sha256(rp_id.encode()).digest()
+        return rp_id_hash + bytes([flags]) + struct.pack(">I", self.sign_count) + attested
+
+    # navigator.credentials.create(): a registration response (as JSON).
+    # `credential_id` registers an existing credential again (as a client
+    # ignoring excludeCredentials would).
+    def create(
+        self, options: dict, origin: str, credential_id: Optional[bytes] = None
+    ) -> dict:
+        algs = [p["alg"] for p in options.get("pubKeyCredParams", [])]
+        if self.alg not in algs:
+            raise ValueError(f"the relying party does not accept algorithm {self.alg}")
+        rp_id = options["rp"]["id"]
+        excluded = {
+            base64url_to_bytes(c["id"]) for c in options.get("excludeCredentials", [])
+        }
+        if credential_id is not None:
+            private_key = self.credentials[credential_id].private_key
+        elif excluded & set(self.credentials):
+            raise ValueError("a credential of this authenticator is excluded")
+        else:
+            credential_id = os.urandom(32)
+            private_key = generate_key(self.alg)
+        self.credentials[credential_id] = StoredCredential(
+            credential_id, rp_id, base64url_to_bytes(options["user"]["id"]), private_key
+        )
+
+        attested = (
+            AAGUID
+            + struct.pack(">H", len(credential_id))
+            + credential_id
+            + cose_public_key(private_key)
+        )
+        attestation_object = cbor2.dumps(
+            {
+                "fmt": "none",
+                "attStmt": {},
+                "authData": self._auth_data(rp_id, UP | UV | AT, attested),
+            }
+        )
+        raw_id = bytes_to_base64url(credential_id)
+        return {
+            "id": raw_id,
+            "rawId": raw_id,
+            "type": "public-key",
+            "response": {
+                "clientDataJSON": bytes_to_base64url(
+                    client_data("webauthn.create", options["challenge"], origin)
+                ),
+                "attestationObject": bytes_to_base64url(attestation_object),
+                "transports": self.transports,
+            },
+            "transports": self.transports,
+            "clientExtensionResults": {},
+        }
+
+    # navigator.credentials.get(): an authentication response (as JSON).
+    # Uses `credential_id`, else the first credential allowed by the options
+    # (or, with an empty allowCredentials, the first one for the RP).
+    def get(
+        self, options: dict, origin: str, credential_id: Optional[bytes] = None
+    ) -> dict:
+        rp_id = options["rpId"]
+        allowed = [base64url_to_bytes(c["id"]) for c in options.get("allowCredentials", [])]
+        candidates = [
+            c
+            for c in self.credentials.values()
+            if c.rp_id == rp_id
+            and (not allowed or c.credential_id in allowed)
+            and (credential_id is None or c.credential_id == credential_id)
+        ]
+        if not candidates:
+            raise ValueError("no credential for this relying party")
+        credential = candidates[0]
+
+        self.sign_count += 1
+        auth_data = self._auth_data(rp_id, UP | UV)
+        client_data_json = client_data("webauthn.get", options["challenge"], origin)
+        signature = sign(
+            credential.private_key, auth_data + hashlib.sha256(client_data_json).digest()
+        )
+        raw_id = bytes_to_base64url(credential.credential_id)
+        return {
+            "id": raw_id,
+            "rawId": raw_id,
+            "type": "public-key",
+            "response": {
+                "clientDataJSON": bytes_to_base64url(client_data_json),
+                "authenticatorData": bytes_to_base64url(auth_data),
+                "signature": bytes_to_base64url(signature),
+                "userHandle": bytes_to_base64url(credential.user_handle),
+            },
+            "clientExtensionResults": {},
+        }
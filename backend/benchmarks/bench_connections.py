@@ -0,0 +1,161 @@
+"""Throughput and memory of the WSGI and ASGI serving modes under idle connections.
+
+    python -m benchmarks.bench_connections [--connections 1000] [--users 20] [--logins 10]
+
+For each mode a server is started on a free port: main:app on werkzeug's
+threaded server (a thread per connection, like the sync deployment), and
+asgi:app on uvicorn. `--connections` clients then connect and send an
+incomplete request, so each connection stays open and idle, and
+benchmarks.loadgen drives the passkey flows over HTTP next to them.
+Reported: the server's resident memory and threads per 1k idle connections,
+and the throughput of the load with and without the idle connections.
+"""
+
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks import loadgen
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "wsgi": [
+        sys.executable,
+        "-c",
+        "import sys; from werkzeug.serving import make_server; from main import app; "
+        "make_server('127.0.0.1', int(sys.argv[1]), app, threaded=True).serve_forever()",
+    ],
+    "asgi": [
+        sys.executable,
+        "-c",
+        "import sys, uvicorn; "
+        "uvicorn.run('asgi:app', port=int(sys.argv[1]), log_level='warning', backlog=4096)",
+    ],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid: int) -> Dict[str, int]:
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                values[key] = int(value.split()[0])
+    return values
+
+
+def wait_for(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+# Connections which sent the start of a request and then nothing
+def open_idle(port: int, count: int) -> List[socket.socket]:
+    connections = []
+    for _ in range(count):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(b"GET /users/me HTTP/1.1\r\nHost: localhost\r\n")
+        connections.append(s)
+    return connections
+
+
+def load(port: int, users: int, logins: int, concurrency: int) -> float:
+    url = f"http://127.0.0.1:{port}"
+    report, wall, errors = loadgen.run(
+        lambda: loadgen.HttpClient(url), users, logins, concurrency, "es256"
+    )
+    if errors:
+        raise RuntimeError(errors[0])
+    return sum(row["requests"] for row in report.values()) / wall
+
+
+def bench(mode: str, connections: int, users: int, logins: int, concurrency: int) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "PYTHONPATH": BACKEND_DIR,
+            "SECRET_KEY": "bench",
+            "RP_ID": loadgen.RP_ID,
+            "EXPECTED_ORIGIN": loadgen.EXPECTED_ORIGIN,
+            "USERDB_BACKEND": "json",
+            "USERDB_FLUSH_WINDOW_MS": "50",
+        }
+        server = subprocess.Popen(
+            [*SERVERS[mode], str(port)],
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(port)
+            rps_before = load(port, users, logins, concurrency)
+            before = proc_status(server.pid)
+
+            idle = open_idle(port, connections)
+            time.sleep(1)
+            during = proc_status(server.pid)
+            rps_idle = load(port, users, logins, concurrency)
+            for s in idle:
+                s.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    per_1k = 1000 / connections
+    return {
+        "rps": rps_before,
+        "rps_with_idle": rps_idle,
+        "rss_mb_per_1k": (during["VmRSS"] - before["VmRSS"]) * per_1k / 1024,
+        "threads_per_1k": (during["Threads"] - before["Threads"]) * per_1k,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_connections")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--modes", default="wsgi,asgi")
+    args = parser.parse_args()
+
+    # the idle connections need a file descriptor each, here and in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.connections + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    print(
+        f"{'mode':<5} {'req/s':>8} {'req/s idle':>11} {'RSS MB/1k conns':>16} {'threads/1k':>11}"
+    )
+    for mode in args.modes.split(","):
+        r = bench(mode, args.connections, args.users, args.logins, args.concurrency)
+        print(
+            f"{mode:<5} {r['rps']:>8.1f} {r['rps_with_idle']:>11.1f}"
+            f" {r['rss_mb_per_1k']:>16.1f} {r['threads_per_1k']:>11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Full NDJSON export, one keyset page, and paging through every user on the json store.
+
+    python -m benchmarks.bench_export [users]   (default 1000000)
+"""
+
+import os
+import sys
+import time
+
+import app.db as db
+from app.export import export_ndjson
+from app.model import Credential, StoredUser
+
+USERS = 1_000_000
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    db.userdb = {
+        f"user-{n}": StoredUser(
+            password="pw",
+            credentials=(
+                Credential(
+                    credential_id=os.urandom(32),
+                    public_key=os.urandom(77),
+                    sign_count=n,
+                    transports=["internal", "hybrid"],
+                ),
+            ),
+        )
+        for n in range(users)
+    }
+    db.store = db.JsonUserStore()
+
+    started = time.perf_counter()
+    size = sum(len(chunk) for chunk in export_ndjson())
+    export_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    page = list(db.store.list_users(f"user-{users // 2}", 100))
+    page_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pages, after = 0, None
+    while page_users := list(db.store.list_users(after, 100)):
+        pages += 1
+        after = page_users[-1][0]
+    paging_seconds = time.perf_counter() - started
+
+    print(f"{users} users")
+    print(f"export: {export_seconds:.2f}s, {size >> 20}MB")
+    print(f"page of {len(page)}: {page_seconds * 1000:.3f}ms")
+    print(f"all {pages} pages: {paging_seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
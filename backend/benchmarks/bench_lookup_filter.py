@@ -0,0 +1,99 @@
+"""Negative lookup filter: false positive rate, memory, and the cost of a miss.
+
+    python -m benchmarks.bench_lookup_filter [users ...]
+
+For each size, a store of `users` users (one credential each) is written in
+every backend. Reported:
+  - the filter of its user_ids and credential_ids: keys, memory, bytes per
+    key, and the false positive rate, estimated and measured on unknown keys
+  - microseconds per lookup of an unknown username (get_user) and of an
+    unknown credential_id (find_by_credential), for each backend with and
+    without the filter (what a bot trying random ones costs)
+"""
+
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+import app.db as db
+from app.db_binary import BinaryUserStore, write_snapshot
+from app.db_sqlite import SqliteUserStore
+from app.lookup_filter import FilteredUserStore
+from app.model import StoredUser, b64encode_no_pad
+from benchmarks.bench_startup import make_users
+
+SIZES = (10_000, 100_000)
+MISSES = 20_000
+ERROR_RATE = 0.001
+
+
+def per_call_us(fn: Callable[[int], object], calls: int) -> float:
+    started = time.perf_counter()
+    for n in range(calls):
+        fn(n)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def open_stores(directory: str, users: Dict[str, StoredUser]) -> Dict[str, db.UserStore]:
+    db.USERDB_FILE = os.path.join(directory, "userdb.json")
+    db.userdb = dict(users)
+    db.save_userdb()
+    json_store = db.JsonUserStore()
+    json_store.load()
+
+    binary_path = os.path.join(directory, "userdb.bin")
+    write_snapshot(binary_path, users.items())
+    binary = BinaryUserStore(binary_path)
+    binary.load()
+
+    sqlite = SqliteUserStore(os.path.join(directory, "userdb.sqlite3"))
+    sqlite.load()
+    sqlite.add_users(users)
+    return {"json": json_store, "binary": binary, "sqlite": sqlite}
+
+
+def main() -> None:
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    unknown_users = [f"bot-{n}" for n in range(MISSES)]
+    unknown_credentials = [b64encode_no_pad(os.urandom(32)) for _ in range(MISSES)]
+
+    for count in sizes:
+        users = dict(make_users(count))
+        with tempfile.TemporaryDirectory() as directory:
+            stores = open_stores(directory, users)
+            # a user_id and a credential_id per user
+            filtered = FilteredUserStore(stores["binary"], 2 * count, ERROR_RATE)
+            filtered.load()
+            filtered.wait_ready()
+
+            stats = filtered.stats()
+            keys = stats["keys"]
+            for credential_id in unknown_credentials:
+                filtered.find_by_credential(credential_id)
+            # the unknown ids which the filter passed on to the store
+            measured = filtered.passed / MISSES
+            print(
+                f"{count} users: {keys:.0f} keys, {stats['memory_bytes'] / 1024:.0f} KiB"
+                f" ({stats['memory_bytes'] / keys:.2f} bytes/key),"
+                f" false positive rate {stats['false_positive_rate']:.5f} estimated,"
+                f" {measured:.5f} measured"
+            )
+
+            print(f"  {'backend':<14} {'unknown user':>14} {'unknown credential':>20}")
+            for name, store in [*stores.items(), ("binary+filter", filtered)]:
+                user_us = per_call_us(lambda n: store.get_user(unknown_users[n]), MISSES)
+                credential_us = per_call_us(
+                    lambda n: store.find_by_credential(unknown_credentials[n]), MISSES
+                )
+                print(f"  {name:<14} {user_us:>12.2f}us {credential_us:>18.2f}us")
+
+            for store in stores.values():
+                if store is not stores["json"]:
+                    store.close()
+            db.persister.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Memory per user of userdb: base64 UserRecord dicts vs. StoredUser.
+
+    python -m benchmarks.bench_memory [users]   (default 1000000)
+"""
+
+import json
+import os
+import sys
+import tracemalloc
+from typing import Any, Callable
+
+import app.db as db
+from app.model import Credential, UserRecord
+
+USERS = 1_000_000
+
+
+def make_record(n: int) -> UserRecord:
+    return UserRecord(
+        password=f"scrypt:32768:8:1${os.urandom(8).hex()}${os.urandom(32).hex()}",
+        credentials=[
+            Credential(
+                credential_id=os.urandom(32),
+                public_key=os.urandom(77),
+                sign_count=n,
+                transports=["internal", "hybrid"],
+            ).to_dict()  # type: ignore[list-item]
+        ],
+    )
+
+
+# Bytes still allocated by build() while its result is alive
+def measure(build: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    text = json.dumps({f"user-{n}": make_record(n) for n in range(users)})
+
+    # userdb as loaded before: the JSON records themselves
+    as_records = measure(lambda: json.loads(text))
+    # userdb as loaded now
+    as_stored = measure(lambda: db.from_records(json.loads(text)))
+
+    print(f"{'users':>10} {'UserRecord':>12} {'StoredUser':>12}")
+    print(f"{users:>10} {as_records / users:>8.0f} B/u {as_stored / users:>8.0f} B/u")
+
+
+if __name__ == "__main__":
+    main()
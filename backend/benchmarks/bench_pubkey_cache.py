@@ -0,0 +1,92 @@
+"""Verification latency of a repeat passkey login with and without the public key cache.
+
+    python -m benchmarks.bench_pubkey_cache
+"""
+
+import hashlib
+import json
+import os
+import struct
+import timeit
+
+import cbor2
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from webauthn.authentication.verify_authentication_response import (
+    verify_authentication_response,
+)
+from webauthn.helpers import bytes_to_base64url
+
+from app.pubkey_cache import PublicKeyCache, use
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5173"
+ROUNDS = 2000
+
+
+def make_assertion(private_key: ec.EllipticCurvePrivateKey, credential_id: bytes):
+    challenge = os.urandom(32)
+    client_data = json.dumps(
+        {
+            "type": "webauthn.get",
+            "challenge": bytes_to_base64url(challenge),
+            "origin": ORIGIN,
+        }
+    ).encode()
+    # rpIdHash | flags (UP) | signCount
+    auth_data = hashlib.sha256(RP_ID.encode()).digest() + b"\x01" + struct.pack(">I", 0)
+    signature = private_key.sign(
+        auth_data + hashlib.sha256(client_data).digest(), ec.ECDSA(hashes.SHA256())
+    )
+    credential = {
+        "id": bytes_to_base64url(credential_id),
+        "rawId": bytes_to_base64url(credential_id),
+        "type": "public-key",
+        "response": {
+            "authenticatorData": bytes_to_base64url(auth_data),
+            "clientDataJSON": bytes_to_base64url(client_data),
+            "signature": bytes_to_base64url(signature),
+        },
+    }
+    return credential, challenge
+
+
+def main() -> None:
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    numbers = private_key.public_key().public_numbers()
+    public_key = cbor2.dumps(
+        {1: 2, 3: -7, -1: 1, -2: numbers.x.to_bytes(32, "big"), -3: numbers.y.to_bytes(32, "big")}
+    )
+    credential_id = os.urandom(32)
+    credential, challenge = make_assertion(private_key, credential_id)
+
+    def verify(key: bytes):
+        verify_authentication_response(
+            credential=credential,
+            expected_challenge=challenge,
+            expected_rp_id=RP_ID,
+            expected_origin=ORIGIN,
+            credential_public_key=key,
+            credential_current_sign_count=0,
+            require_user_verification=False,
+        )
+
+    cache = PublicKeyCache(maxsize=100)
+    cred_id = bytes_to_base64url(credential_id)
+
+    def uncached():
+        verify(public_key)
+
+    def cached():
+        key = cache.get(cred_id, "user", lambda: public_key)
+        with use(key):
+            verify(key.public_key)
+
+    for name, fn in (("uncached", uncached), ("cached", cached)):
+        best = min(timeit.repeat(fn, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+        print(f"{name:>9}: {best:8.2f}us per verification")
+    print(f"cache: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
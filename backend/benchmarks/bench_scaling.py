@@ -0,0 +1,305 @@
+"""Scaling of the json store and User operations with the number of users.
+
+    python -m benchmarks.bench_scaling [--sizes 1000,10000,100000] [--json FILE]
+                                       [--baseline FILE] [--tolerance 0.5] [--slack 0.3]
+    python -m benchmarks.bench_scaling --json benchmarks/bench_scaling_baseline.json
+
+db.userdb is populated with `size` synthetic users having 0 to 10
+credentials each (5 on average), and every operation below is timed at each
+size. The growth of its time with the size is fitted as size**exponent and
+checked against its declared complexity: the exponent must not exceed the
+one of the class (0 for O(1), 1 for O(n)) by more than --slack. A
+reintroduced linear scan in a lookup shows up as an exponent close to 1.
+
+--json writes the timings to a file; --baseline fails the run if any timing
+is slower than the one of such a file by more than --tolerance. It defaults
+to the committed bench_scaling_baseline.json (--baseline "" skips the
+comparison); after an intended change, or on other hardware, rewrite it with
+the second command above. The exit status is 1 on any failure.
+
+1M users is opt-in (--sizes 1000,10000,100000,1000000): it takes several GB
+of memory and minutes.
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import app.db as db
+from app.model import Credential, StoredUser, b64encode_no_pad
+from app.persister import WriteBehindPersister
+from app.users import User
+
+SIZES = (1_000, 10_000, 100_000)
+BASELINE = os.path.join(os.path.dirname(__file__), "bench_scaling_baseline.json")
+MAX_CREDENTIALS = 10
+# calls of a point operation per timing
+CALLS = 2000
+REPEAT = 3
+
+# exponent of the size in the time of each complexity class
+EXPONENTS = {"O(1)": 0.0, "O(n)": 1.0}
+
+
+class Operation(NamedTuple):
+    name: str
+    complexity: str
+    # called with the size and the populated users; returns seconds per call
+    measure: Callable[[int, "Population"], float]
+
+
+class Population(NamedTuple):
+    user_ids: List[str]
+    # (user_id, credential_id as urlsafe-base64) of some existing credentials
+    credentials: List[tuple]
+
+
+def populate(size: int, seed: int = 0) -> Population:
+    rng = random.Random(seed)
+    transports = ["internal", "hybrid"]
+    users: Dict[str, StoredUser] = {}
+    for n in range(size):
+        user_id = f"user-{n:07d}"
+        creds = tuple(
+            Credential(
+                credential_id=rng.randbytes(32),
+                public_key=rng.randbytes(77),
+                sign_count=0,
+                transports=transports,
+            )
+            for _ in range(rng.randint(0, MAX_CREDENTIALS))
+        )
+        users[user_id] = StoredUser(password="pbkdf2:sha256:1$salt$hash", credentials=creds)
+    db.userdb = users
+    db.store = db.JsonUserStore()
+
+    # spread over the whole store, so that a scan can't stop early
+    user_ids = rng.sample(list(users), min(CALLS, size))
+    credentials = [
+        (user_id, b64encode_no_pad(rng.choice(users[user_id].credentials).credential_id))
+        for user_id in user_ids
+        if users[user_id].credentials
+    ]
+    db.find_user_id_by_credential_id(credentials[0][1])  # builds the index
+    return Population(user_ids, credentials)
+
+
+# Best of REPEAT of the mean time of fn over args
+def per_call(fn: Callable, args: Sequence) -> float:
+    best = math.inf
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for arg in args:
+            fn(arg)
+        best = min(best, (time.perf_counter() - started) / len(args))
+    return best
+
+
+def once(fn: Callable[[], object], repeat: int) -> float:
+    best = math.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _get_by_id(size: int, p: Population) -> float:
+    return per_call(User.get_by_id, p.user_ids)
+
+
+def _find_user_by_credential_id(size: int, p: Population) -> float:
+    return per_call(User.find_user_by_credential_id, [c for _, c in p.credentials])
+
+
+def _find_decoded_public_key(size: int, p: Population) -> float:
+    return per_call(lambda c: db.find_decoded_public_key(*c), p.credentials)
+
+
+# Writes only: saving is measured by save_userdb
+def _without_saves(fn: Callable[[], float]) -> float:
+    persister = db.persister
+    db.persister = WriteBehindPersister(lambda: None, 0, 1)
+    try:
+        return fn()
+    finally:
+        db.persister = persister
+
+
+def _append_user(size: int, p: Population) -> float:
+    new_ids = iter(range(REPEAT * CALLS))
+    return _without_saves(
+        lambda: per_call(lambda _: db.append_user(f"new-{next(new_ids)}", "pw"), range(CALLS))
+    )
+
+
+def _update_user_credentials(size: int, p: Population) -> float:
+    rng = random.Random(size)
+
+    def add(user_id: str) -> None:
+        credential = Credential(
+            credential_id=rng.randbytes(32), public_key=b"pk", sign_count=0, transports=[]
+        )
+        db.update_user_credentials(user_id, credential)
+
+    return _without_saves(lambda: per_call(add, p.user_ids))
+
+
+def _save_userdb(size: int, p: Population) -> float:
+    return once(db.save_userdb, REPEAT if size <= 100_000 else 1)
+
+
+def _load_userdb(size: int, p: Population) -> float:
+    return once(db.load_userdb, REPEAT if size <= 100_000 else 1)
+
+
+# load_userdb last: it reads the file written by save_userdb
+OPERATIONS = [
+    Operation("get_by_id", "O(1)", _get_by_id),
+    Operation("find_user_by_credential_id", "O(1)", _find_user_by_credential_id),
+    Operation("find_decoded_public_key", "O(1)", _find_decoded_public_key),
+    Operation("append_user", "O(1)", _append_user),
+    Operation("update_user_credentials", "O(1)", _update_user_credentials),
+    Operation("save_userdb", "O(n)", _save_userdb),
+    Operation("load_userdb", "O(n)", _load_userdb),
+]
+
+
+# Least-squares slope of log(seconds) over log(size)
+def fit_exponent(timings: Dict[int, float]) -> float:
+    points = [(math.log(n), math.log(t)) for n, t in timings.items() if t > 0]
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+# USERDB_FILE in a temporary directory; populate() replaces db.userdb and
+# db.store, so all three are restored afterwards
+@contextlib.contextmanager
+def _scratch_db() -> Iterator[None]:
+    userdb_file, userdb, store = db.USERDB_FILE, db.userdb, db.store
+    with tempfile.TemporaryDirectory() as directory:
+        db.USERDB_FILE = os.path.join(directory, "userdb.json")
+        try:
+            yield
+        finally:
+            db.USERDB_FILE, db.userdb, db.store = userdb_file, userdb, store
+
+
+# Time every operation at every size: {operation: {size: seconds}}
+def measure(
+    sizes: Sequence[int], operations: Sequence[Operation] = OPERATIONS
+) -> Dict[str, Dict[int, float]]:
+    results: Dict[str, Dict[int, float]] = {op.name: {} for op in operations}
+    with _scratch_db():
+        for size in sizes:
+            population = populate(size)
+            for op in operations:
+                results[op.name][size] = op.measure(size, population)
+    return results
+
+
+# Operations whose fitted exponent exceeds the one of their class by more than slack
+def complexity_failures(
+    results: Dict[str, Dict[int, float]],
+    slack: float,
+    operations: Sequence[Operation] = OPERATIONS,
+) -> List[str]:
+    failures = []
+    for op in operations:
+        exponent = fit_exponent(results[op.name])
+        if exponent > EXPONENTS[op.complexity] + slack:
+            failures.append(
+                f"{op.name}: grows as n^{exponent:.2f}, declared {op.complexity}"
+            )
+    return failures
+
+
+def baseline_failures(
+    results: Dict[str, Dict[int, float]], baseline: dict, tolerance: float
+) -> List[str]:
+    failures = []
+    for name, timings in results.items():
+        base = baseline.get("operations", {}).get(name, {}).get("seconds", {})
+        for size, seconds in timings.items():
+            before = base.get(str(size))
+            if before and seconds > before * (1 + tolerance):
+                failures.append(
+                    f"{name} at {size}: {before * 1e6:.1f}us -> {seconds * 1e6:.1f}us"
+                )
+    return failures
+
+
+def _format(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f}us"
+    return f"{seconds * 1e3:.1f}ms"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_scaling")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, SIZES)),
+        help="comma-separated user counts (default: %(default)s; "
+        "append 1000000 for the 1M run, which takes GBs and minutes)",
+    )
+    parser.add_argument("--json", help="write the timings to this file")
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE,
+        help='timings of an earlier run to compare with ("" to skip; '
+        "default: the committed bench_scaling_baseline.json)",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--slack", type=float, default=0.3)
+    args = parser.parse_args(argv)
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+
+    results = measure(sizes)
+
+    print(f"{'operation':<27} {'class':>5} " + " ".join(f"{n:>10}" for n in sizes) + "   exponent")
+    for op in OPERATIONS:
+        timings = results[op.name]
+        cells = " ".join(f"{_format(timings[n]):>10}" for n in sizes)
+        print(f"{op.name:<27} {op.complexity:>5} {cells}   {fit_exponent(timings):8.2f}")
+
+    failures = complexity_failures(results, args.slack)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += baseline_failures(results, json.load(f), args.tolerance)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "sizes": sizes,
+                    "operations": {
+                        op.name: {
+                            "complexity": op.complexity,
+                            "exponent": fit_exponent(results[op.name]),
+                            "seconds": {str(n): t for n, t in results[op.name].items()},
+                        }
+                        for op in OPERATIONS
+                    },
+                },
+                f,
+                indent=2,
+            )
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
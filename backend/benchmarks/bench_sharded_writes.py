@@ -0,0 +1,89 @@
+"""Sign-up throughput of concurrent writers on 1, 4 and 16 shards.
+
+    python -m benchmarks.bench_sharded_writes [users] [writers]
+
+Each shard starts with users/shards of `users` existing users, and every
+sign-up waits until its shard file is rewritten (no coalescing window).
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import app.db as db
+from app.db_sharded import ShardedUserStore
+from app.model import Credential, StoredUser
+
+USERS = 20000
+WRITERS = 16
+SIGN_UPS = 5
+SHARDS = (1, 4, 16)
+
+
+def seed(path: str, users: int) -> None:
+    records = {
+        f"user-{n}": StoredUser(
+            password=f"scrypt:32768:8:1${os.urandom(8).hex()}${os.urandom(32).hex()}",
+            credentials=(
+                Credential(
+                    credential_id=os.urandom(32),
+                    public_key=os.urandom(77),
+                    sign_count=0,
+                    transports=["internal", "hybrid"],
+                ),
+            ),
+        )
+        for n in range(users)
+    }
+    with open(path, "w") as f:
+        json.dump(db.to_records(records), f)
+
+
+def run(directory: str, shards: int, writers: int) -> float:
+    store = ShardedUserStore(os.path.join(directory, f"shards-{shards}"), shards)
+    store.load()
+
+    def sign_up(writer: int) -> None:
+        for n in range(SIGN_UPS):
+            user_id = f"new-{writer}-{n}"
+            store.add_user(user_id, "pw")
+            store.add_credential(
+                user_id,
+                Credential(
+                    credential_id=os.urandom(32),
+                    public_key=os.urandom(77),
+                    sign_count=0,
+                    transports=["internal"],
+                ),
+            )
+
+    threads = [threading.Thread(target=sign_up, args=(w,)) for w in range(writers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    store.close()
+    return writers * SIGN_UPS / elapsed
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else WRITERS
+
+    with tempfile.TemporaryDirectory() as directory:
+        db.USERDB_FILE = os.path.join(directory, "userdb.json")
+        seed(db.USERDB_FILE, users)
+
+        print(f"{users} users, {writers} writers")
+        print(f"{'shards':>6} {'sign-ups/s':>12}")
+        for shards in SHARDS:
+            print(f"{shards:>6} {run(directory, shards, writers):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Cold start of the json and binary stores at 10k, 100k and 1M users.
+
+    python -m benchmarks.bench_startup [users ...]
+
+Startup is the time from opening the file until the first user is served.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Iterator, Tuple
+
+import app.db as db
+from app.db_binary import BinaryUserStore, write_snapshot
+from app.model import Credential, StoredUser
+
+SIZES = (10_000, 100_000, 1_000_000)
+
+
+def make_users(count: int) -> Iterator[Tuple[str, StoredUser]]:
+    for n in range(count):
+        yield f"user-{n}", StoredUser(
+            password=f"scrypt:32768:8:1${os.urandom(8).hex()}${os.urandom(32).hex()}",
+            credentials=(
+                Credential(
+                    credential_id=os.urandom(32),
+                    public_key=os.urandom(77),
+                    sign_count=n,
+                    transports=["internal", "hybrid"],
+                ),
+            ),
+        )
+
+
+def seconds(start: Callable[[], object]) -> float:
+    started = time.perf_counter()
+    start()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'users':>10} {'json':>10} {'binary':>10} {'json size':>10} {'bin size':>10}")
+    for count in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, "userdb.json")
+            binary_path = os.path.join(directory, "userdb.bin")
+            with open(json_path, "w") as f:
+                json.dump(db.to_records(dict(make_users(count))), f)
+            with open(json_path, "r") as f:
+                write_snapshot(binary_path, db.from_records(json.load(f)).items())
+
+            db.USERDB_FILE = json_path
+            json_seconds = seconds(lambda: db.load_userdb()["user-0"])
+
+            def open_binary() -> object:
+                store = BinaryUserStore(binary_path)
+                store.load()
+                return store.get_user("user-0")
+
+            binary_seconds = seconds(open_binary)
+
+            print(
+                f"{count:>10} {json_seconds * 1000:>8.1f}ms {binary_seconds * 1000:>8.2f}ms"
+                f" {os.path.getsize(json_path) >> 20:>8}MB"
+                f" {os.path.getsize(binary_path) >> 20:>8}MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Per-request cost of the flask_login user_loader with 1 and 50 credentials.
+
+    python -m benchmarks.bench_user_loader
+"""
+
+import os
+import timeit
+
+import app.db as db
+from app.db import Credential
+from app.users import User
+from main import app, load_user
+
+ROUNDS = 20000
+
+
+def populate(user_id: str, credentials: int) -> None:
+    db._insert_user(user_id, "pw")
+    for n in range(credentials):
+        db._insert_credential(
+            user_id,
+            Credential(
+                credential_id=os.urandom(32),
+                public_key=os.urandom(77),
+                sign_count=0,
+                transports=["internal", "hybrid"],
+            ),
+        )
+
+
+def per_call_us(stmt) -> float:
+    return min(timeit.repeat(stmt, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+
+
+def main() -> None:
+    db.userdb = {}
+    db.store = db.JsonUserStore()
+
+    print(f"{'credentials':>11} {'user_loader':>12} {'+decode all':>12} {'GET /users/me':>14}")
+    for credentials in (1, 50):
+        user_id = f"user-{credentials}"
+        populate(user_id, credentials)
+
+        lazy = per_call_us(lambda: load_user(user_id))
+        eager = per_call_us(lambda: load_user(user_id).credentials)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = user_id
+            session["_fresh"] = True
+        request = min(
+            timeit.repeat(lambda: client.get("/users/me"), number=2000, repeat=3)
+        ) / 2000 * 1e6
+
+        print(f"{credentials:>11} {lazy:>10.2f}us {eager:>10.2f}us {request:>12.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Load generator for the password and passkey flows, with a software authenticator.
+
+    python -m benchmarks.loadgen [--users N] [--logins N] [--concurrency N] [--alg ALG]
+                                 [--url URL | --asgi] [--json FILE] [--baseline FILE]
+
+Every virtual user signs up (POST /users), logs in with its password
+(POST /login), registers a passkey (/generate-registration-options and
+/verify-registration), then logs in `--logins` times with the passkey
+(/generate-authentication-options and /verify-authentication).
+
+Without --url the requests go to main.app (or, with --asgi, asgi.app) in
+this process through its test client, with the user store in a temporary
+directory (USERDB_BACKEND applies). With --url they go over HTTP to a running server, whose RP_ID and
+EXPECTED_ORIGIN must match --rp-id and --origin.
+
+Throughput and latency percentiles are reported per endpoint. --json writes
+them to a file; --baseline compares the run with such a file and exits with
+status 1 if the median latency of an endpoint got worse by more than
+--tolerance.
+"""
+
+import argparse
+import asyncio
+import http.cookiejar
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.authenticator import ALGORITHMS, SoftAuthenticator
+
+RP_ID = os.getenv("RP_ID", "localhost")
+EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN", "http://localhost:5173")
+PERCENTILES = (50, 90, 99)
+
+
+# A browser: one cookie session, requests return (status, JSON body)
+class Client:
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, dict]:
+        raise NotImplementedError
+
+
+class TestClient(Client):
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self._client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+# Quart's test client, driven from a thread by its own event loop
+class AsgiTestClient(Client):
+    def __init__(self, app):
+        self._client = app.test_client()
+        self._loop = asyncio.new_event_loop()
+
+    def request(self, method, path, body=None):
+        async def call():
+            # as Flask's: no body at all for None (Quart's would send "null")
+            kwargs = {} if body is None else {"json": body}
+            response = await self._client.open(path, method=method, **kwargs)
+            return response.status_code, await response.get_json(silent=True) or {}
+
+        return self._loop.run_until_complete(call())
+
+
+class HttpClient(Client):
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(
+            self.url + path,
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"} if data is not None else {},
+        )
+        try:
+            with self._opener.open(req) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, content = e.code, e.read()
+        try:
+            return status, json.loads(content) if content else {}
+        except ValueError:
+            return status, {}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+# Latencies and failures per endpoint ("METHOD /path"), from every thread
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+
+    def report(self, wall_seconds: float) -> Dict[str, dict]:
+        report = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            report[endpoint] = {
+                "requests": len(values),
+                "failures": self.failures.get(endpoint, 0),
+                "rps": len(values) / wall_seconds if wall_seconds else 0.0,
+                **{f"p{p}_ms": percentile(values, p) * 1000 for p in PERCENTILES},
+                "max_ms": values[-1] * 1000,
+            }
+        return report
+
+
+class VirtualUser:
+    def __init__(
+        self, client: Client, recorder: Recorder, username: str, alg: str, origin: str
+    ):
+        self.client = client
+        self.recorder = recorder
+        self.username = username
+        self.password = f"password-{username}"
+        self.authenticator = SoftAuthenticator(alg)
+        self.origin = origin
+
+    def call(self, method: str, path: str, body: Optional[dict] = None) -> dict:
+        started = time.perf_counter()
+        status, response = self.client.request(method, path, body)
+        ok = status == 200
+        self.recorder.record(f"{method} {path}", time.perf_counter() - started, ok)
+        if not ok:
+            raise RuntimeError(f"{method} {path}: {status} {response}")
+        return response
+
+    def sign_up(self) -> None:
+        self.call("POST", "/users", {"username": self.username, "password": self.password})
+        self.call("POST", "/login", {"username": self.username, "password": self.password})
+
+    def register_passkey(self) -> None:
+        options = self.call("GET", "/generate-registration-options")
+        self.call("POST", "/verify-registration", self.authenticator.create(options, self.origin))
+        self.call("POST", "/logout")
+
+    def passkey_login(self) -> None:
+        options = self.call("GET", "/generate-authentication-options")
+        self.call("POST", "/verify-authentication", self.authenticator.get(options, self.origin))
+
+    def run(self, logins: int) -> None:
+        self.sign_up()
+        self.register_passkey()
+        for _ in range(logins):
+            self.passkey_login()
+
+
+def run(
+    new_client,
+    users: int,
+    logins: int,
+    concurrency: int,
+    alg: str = "es256",
+    origin: str = EXPECTED_ORIGIN,
+) -> Tuple[Dict[str, dict], float, List[str]]:
+    recorder = Recorder()
+    errors: List[str] = []
+    next_user = iter(range(users))
+    lock = threading.Lock()
+    prefix = f"load-{os.getpid()}-{int(time.time())}"
+    algs = list(ALGORITHMS) if alg == "mixed" else [alg]
+
+    def worker() -> None:
+        while True:
+            with lock:
+                n = next(next_user, None)
+            if n is None:
+                return
+            user = VirtualUser(
+                new_client(), recorder, f"{prefix}-{n}", algs[n % len(algs)], origin
+            )
+            try:
+                user.run(logins)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return recorder.report(wall), wall, errors
+
+
+# main.app (or asgi.app) with its user store in `directory`.
+# RP_ID and EXPECTED_ORIGIN are only used if not set in the environment.
+def in_process_app(
+    directory: str, rp_id: str = RP_ID, origin: str = EXPECTED_ORIGIN, asgi: bool = False
+):
+    os.environ.setdefault("RP_ID", rp_id)
+    os.environ.setdefault("EXPECTED_ORIGIN", origin)
+    import app.db as db
+
+    served: object
+    if asgi:
+        from asgi import app as asgi_app
+
+        served = asgi_app
+    else:
+        from main import app
+
+        served = app
+
+    db.USERDB_FILE = os.path.join(directory, "userdb.json")
+    for name in ("SQLITE_FILE", "JOURNAL_DIR", "BINARY_FILE", "SHARD_DIR"):
+        setattr(db, f"USERDB_{name}", os.path.join(directory, name.lower()))
+    db.store.close()
+    db.userdb = {}
+    db.store = db.open_store(db.USERDB_BACKEND)
+    db.store.load()
+    return served
+
+
+# Write what is pending to the temporary store before it is removed
+def close_in_process_app() -> None:
+    import app.db as db
+    from app.sign_counts import tracker
+
+    tracker.close()
+    db.store.close()
+
+
+def print_report(report: Dict[str, dict], wall: float) -> None:
+    columns = ("requests", "failures", "rps", *(f"p{p}_ms" for p in PERCENTILES), "max_ms")
+    width = max([len(e) for e in report] + [8])
+    print(f"{'endpoint':<{width}} " + " ".join(f"{c:>9}" for c in columns))
+    for endpoint, row in report.items():
+        cells = " ".join(
+            f"{row[c]:>9}" if isinstance(row[c], int) else f"{row[c]:>9.2f}" for c in columns
+        )
+        print(f"{endpoint:<{width}} {cells}")
+    total = sum(row["requests"] for row in report.values())
+    print(f"{total} requests in {wall:.2f}s ({total / wall:.1f} req/s)")
+
+
+# Endpoints whose median latency is worse than the baseline by more than `tolerance`
+def regressions(report: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    worse = []
+    for endpoint, row in report.items():
+        base = baseline.get(endpoint)
+        if base and base["p50_ms"] > 0:
+            ratio = row["p50_ms"] / base["p50_ms"]
+            if ratio > 1 + tolerance:
+                worse.append(f"{endpoint}: p50 {base['p50_ms']:.2f}ms -> {row['p50_ms']:.2f}ms")
+    return worse
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadgen")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=10, help="passkey logins per user")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--alg", choices=[*ALGORITHMS, "mixed"], default="es256")
+    parser.add_argument("--url", help="server to load (default: main.app in process)")
+    parser.add_argument("--asgi", action="store_true", help="asgi.app in process")
+    parser.add_argument("--rp-id", default=RP_ID)
+    parser.add_argument("--origin", default=EXPECTED_ORIGIN)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url:
+            url = args.url
+
+            def new_client() -> Client:
+                return HttpClient(url)
+
+        else:
+            app = in_process_app(directory, args.rp_id, args.origin, args.asgi)
+            client_class = AsgiTestClient if args.asgi else TestClient
+
+            def new_client() -> Client:
+                return client_class(app)
+
+        report, wall, errors = run(
+            new_client, args.users, args.logins, args.concurrency, args.alg, args.origin
+        )
+        if not args.url:
+            close_in_process_app()
+
+    print_report(report, wall)
+    for error in errors[:10]:
+        print(f"error: {error}", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"wall_seconds": wall, "endpoints": report}, f, indent=2)
+
+    status = 1 if errors else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            worse = regressions(report, json.load(f)["endpoints"], args.tolerance)
+        for line in worse:
+            print(f"regression: {line}")
+        if worse:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+# Multi-worker deployment:
+#
+#   SECRET_KEY=<random string> gunicorn -c gunicorn.conf.py main:app
+#
+# Every worker process signs sessions with the shared SECRET_KEY and reads
+# users and challenges from the SQLite stores, so a session or a new user
+# created on one worker is visible to all of them.
+import multiprocessing
+import os
+
+if not os.getenv("SECRET_KEY"):
+    raise RuntimeError("SECRET_KEY must be set to run multiple workers")
+
+# The json/journal user stores and the memory challenge store are per process
+os.environ.setdefault("USERDB_BACKEND", "sqlite")
+os.environ.setdefault("CHALLENGE_STORE", "sqlite")
+# The hot table of sign counts is per process too: write every login's counter
+# to the store, so the clone check of any worker sees it. (Two logins with the
+# same counter on two workers at the very same moment may still both pass.)
+os.environ.setdefault("SIGN_COUNT_FLUSH_SECONDS", "0")
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.getenv("THREADS", "4"))
+# import the app once in the master, then fork the workers
+preload_app = True
@@ -1,32 +1,108 @@
 import atexit
 import os
+from typing import Any, Mapping, Optional
 
-from app import login, passkey_auth, passkey_reg, users
-from app.db import save_userdb
+import app.db as db
+from app import (
+    admin,
+    challenges,
+    descriptor_cache,
+    login,
+    lookup_filter,
+    metrics,
+    passkey_auth,
+    passkey_reg,
+    pubkey_cache,
+    users,
+)
+from app.cli import cli, password_cli
+from app.hashing import hasher
+from app.password_upgrades import upgrader
+from app.profiling import profiler
+from app.sign_counts import tracker
 from app.users import User
 from flask import Flask
 from flask_cors import CORS
 from flask_login import LoginManager
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-CORS(app, supports_credentials=True)
 
-# flask_login setup
-login_manager = LoginManager()
-login_manager.init_app(app)
+# Stats of the caches, queues and stores, read at every scrape of /metrics
+metrics.register_stats(
+    "userdb_persister", "Write-behind persister of the json store", db.persister.metrics
+)
+metrics.register_stats("pubkey_cache", "Public key cache", pubkey_cache.cache.stats)
+metrics.register_stats(
+    "descriptor_cache", "Credential descriptor cache", descriptor_cache.cache.stats
+)
+metrics.register_stats("challenges", "Challenge store", lambda: challenges.store.metrics())
+metrics.register_stats(
+    "lookup_filter",
+    "Negative lookup filter of the user store",
+    lambda: lookup_filter.stats(db.store),
+)
+metrics.register_stats(
+    "sign_counts",
+    "Sign count tracker",
+    lambda: {
+        "pending": tracker.pending(),
+        "flushes": tracker.flushes,
+        "flushed_updates": tracker.flushed_updates,
+    },
+)
+metrics.register_stats(
+    "password_hashing", "Password hashing", lambda: {"rejected": hasher.rejected}
+)
+metrics.register_stats(
+    "password_upgrades",
+    "Rehashes of passwords with an outdated hash method",
+    lambda: {
+        "pending": upgrader.pending(),
+        "flushes": upgrader.flushes,
+        "flushed_updates": upgrader.flushed_updates,
+    },
+)
+metrics.register_stats("profiler", "Request profiler", profiler.stats)
 
 
 # user_loader callback
-@login_manager.user_loader
 def load_user(user_id):
     return User.get_by_id(user_id)
 
 
-app.register_blueprint(login.bp)
-app.register_blueprint(users.bp)
-app.register_blueprint(passkey_auth.bp)
-app.register_blueprint(passkey_reg.bp)
+# Build the Flask app.
+# Sessions are signed with SECRET_KEY, which must be shared by every worker
+# process when running more than one (see gunicorn.conf.py). Without it a
+# random key is used, which is only fine for a single process.
+# Users and challenges are shared by workers only through the stores
+# selected by USERDB_BACKEND=sqlite and CHALLENGE_STORE=sqlite.
+def create_app(config: Optional[Mapping[str, Any]] = None) -> Flask:
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+    if config:
+        app.config.update(config)
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = os.urandom(24)
+
+    CORS(app, supports_credentials=True)
+
+    # flask_login setup
+    login_manager = LoginManager()
+    login_manager.init_app(app)
+    login_manager.user_loader(load_user)
+
+    app.register_blueprint(login.bp)
+    app.register_blueprint(users.bp)
+    app.register_blueprint(passkey_auth.bp)
+    app.register_blueprint(passkey_reg.bp)
+    app.register_blueprint(admin.bp)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    app.cli.add_command(cli)
+    app.cli.add_command(password_cli)
+    return app
+
+
+app = create_app()
 
 RP_ID = os.getenv("RP_ID")
 EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN")
@@ -34,7 +110,11 @@ EXPECTED_ORIGIN = os.getenv("EXPECTED_ORIGIN")
 
 ## debugging purpose only
 def teardown():
-    save_userdb()
+    profiler.close()
+    hasher.close()
+    tracker.close()
+    upgrader.close()
+    db.store.close()
     print("** UserDB saved on exit/reload.")
 
 
@@ -0,0 +1,302 @@
+import asyncio
+
+import pytest
+
+import app.db as db
+from app import descriptor_cache, passkey_auth, passkey_reg
+from app.hashing import hasher
+from app.password_upgrades import upgrader
+from app.sign_counts import tracker
+from benchmarks import loadgen
+from benchmarks.authenticator import SoftAuthenticator
+from webauthn.helpers import bytes_to_base64url
+from main import create_app
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5173"
+SECRET_KEY = "test-secret"
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    descriptor_cache.cache.clear()
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    monkeypatch.setattr(tracker, "interval", 0)
+    for module in (passkey_reg, passkey_auth):
+        monkeypatch.setattr(module, "RP_ID", RP_ID)
+        monkeypatch.setattr(module, "EXPECTED_ORIGIN", ORIGIN)
+
+
+# asgi.app needs the "async" extra (quart)
+def create_asgi_app(config):
+    return pytest.importorskip("asgi").create_asgi_app(config)
+
+
+# the same client API for both serving modes: main.app (WSGI) and asgi.app
+@pytest.fixture(params=["wsgi", "asgi"])
+def client(request, store) -> loadgen.Client:
+    config = {"TESTING": True, "SECRET_KEY": SECRET_KEY}
+    if request.param == "asgi":
+        return loadgen.AsgiTestClient(create_asgi_app(config))
+    return loadgen.TestClient(create_app(config))
+
+
+def _register(client, authenticator: SoftAuthenticator) -> None:
+    client.request("POST", "/users", {"username": "alice", "password": "pw"})
+    client.request("POST", "/login", {"username": "alice", "password": "pw"})
+    _, options = client.request("GET", "/generate-registration-options")
+    response = client.request("POST", "/verify-registration", authenticator.create(options, ORIGIN))
+    assert response == (200, {"status": "ok", "verified": True})
+    client.request("POST", "/logout")
+
+
+def _login(client, authenticator: SoftAuthenticator, origin: str = ORIGIN) -> int:
+    _, options = client.request("GET", "/generate-authentication-options")
+    status, _ = client.request("POST", "/verify-authentication", authenticator.get(options, origin))
+    return status
+
+
+@pytest.mark.parametrize("alg", ["es256", "ed25519"])
+def test_register_and_log_in_with_passkey(client, alg):
+    authenticator = SoftAuthenticator(alg)
+    _register(client, authenticator)
+    assert client.request("GET", "/users/me")[0] == 401
+
+    for sign_count in (1, 2):
+        assert _login(client, authenticator) == 200
+        assert client.request("GET", "/users/me") == (200, {"username": "alice"})
+        (credential,) = db.store.get_user("alice").credentials
+        assert credential.sign_count == sign_count
+
+
+def test_assertions_are_checked(client):
+    authenticator = SoftAuthenticator()
+    _register(client, authenticator)
+
+    assert _login(client, authenticator, "https://evil.example") == 400
+    assert _login(client, authenticator) == 200
+
+    # a counter which did not increase (a cloned authenticator) is rejected
+    authenticator.sign_count -= 1
+    assert _login(client, authenticator) == 400
+
+    # unknown credential, and a challenge which was not issued
+    assert client.request("POST", "/verify-authentication", {"id": "AAAA"})[0] == 404
+    # an unknown credential uses up the challenge too
+    _, options = client.request("GET", "/generate-authentication-options")
+    assertion = authenticator.get(options, ORIGIN)
+    assert client.request("POST", "/verify-authentication", {"id": "AAAA"})[0] == 404
+    assert client.request("POST", "/verify-authentication", assertion)[0] == 400
+    _, options = client.request("GET", "/generate-authentication-options")
+    assertion = authenticator.get(options, ORIGIN)
+    client.request("GET", "/generate-authentication-options")
+    assert client.request("POST", "/verify-authentication", assertion)[0] == 400
+
+
+def test_username_first_flow(client):
+    alice = SoftAuthenticator()
+    _register(client, alice)
+    (alice_id,) = alice.credentials
+    client.request("POST", "/users", {"username": "bob", "password": "pw"})
+    client.request("POST", "/login", {"username": "bob", "password": "pw"})
+    bob = SoftAuthenticator("ed25519")
+    _, options = client.request("GET", "/generate-registration-options")
+    client.request("POST", "/verify-registration", bob.create(options, ORIGIN))
+    client.request("POST", "/logout")
+
+    _, options = client.request("GET", "/generate-authentication-options?username=alice")
+    assert [c["id"] for c in options["allowCredentials"]] == [bytes_to_base64url(alice_id)]
+    assert options["allowCredentials"][0]["transports"] == ["internal"]
+    assert client.request("POST", "/verify-authentication", alice.get(options, ORIGIN))[0] == 200
+    client.request("POST", "/logout")
+
+    # a credential of another user is not accepted for alice
+    _, options = client.request("GET", "/generate-authentication-options?username=alice")
+    with pytest.raises(ValueError):
+        bob.get(options, ORIGIN)
+    assertion = bob.get({**options, "allowCredentials": []}, ORIGIN)
+    assert client.request("POST", "/verify-authentication", assertion)[0] == 404
+
+    # unknown users get a discoverable request
+    _, options = client.request("GET", "/generate-authentication-options?username=nobody")
+    assert options["allowCredentials"] == []
+
+
+def test_credentials_without_transports_are_listed(client):
+    client.request("POST", "/users", {"username": "alice", "password": "pw"})
+    # as stored for a client which sent "transports": null
+    credential = db.Credential(
+        credential_id=b"\x01", public_key=b"pk", sign_count=0, transports=None
+    )
+    db.store.add_credential("alice", credential)
+    expected = [{"id": bytes_to_base64url(b"\x01"), "type": "public-key"}]
+
+    status, options = client.request("GET", "/generate-authentication-options?username=alice")
+    assert (status, options["allowCredentials"]) == (200, expected)
+    client.request("POST", "/login", {"username": "alice", "password": "pw"})
+    status, options = client.request("GET", "/generate-registration-options")
+    assert (status, options["excludeCredentials"]) == (200, expected)
+
+
+def test_registered_authenticator_is_excluded(client):
+    authenticator = SoftAuthenticator()
+    _register(client, authenticator)
+    (credential_id,) = authenticator.credentials
+    client.request("POST", "/login", {"username": "alice", "password": "pw"})
+
+    _, options = client.request("GET", "/generate-registration-options")
+    assert [c["id"] for c in options["excludeCredentials"]] == [bytes_to_base64url(credential_id)]
+    with pytest.raises(ValueError):
+        authenticator.create(options, ORIGIN)
+
+    # a client ignoring excludeCredentials is refused by the server
+    again = authenticator.create(options, ORIGIN, credential_id)
+    status, body = client.request("POST", "/verify-registration", again)
+    assert (status, body["error"]) == (400, "credential already registered")
+    assert len(db.store.get_user("alice").credentials) == 1
+
+    # a new authenticator can be added, and is excluded from then on
+    other = SoftAuthenticator()
+    _, options = client.request("GET", "/generate-registration-options")
+    assert client.request("POST", "/verify-registration", other.create(options, ORIGIN))[0] == 200
+    _, options = client.request("GET", "/generate-registration-options")
+    assert len(options["excludeCredentials"]) == 2
+
+
+def test_user_is_resolved_from_user_handle(client, monkeypatch):
+    authenticator = SoftAuthenticator()
+    _register(client, authenticator)
+    user_handle = db.store.get_user("alice").user_handle
+    (credential,) = authenticator.credentials.values()
+    assert credential.user_handle == user_handle
+
+    # a second passkey of the same user gets the same handle
+    client.request("POST", "/login", {"username": "alice", "password": "pw"})
+    _, options = client.request("GET", "/generate-registration-options")
+    assert options["user"]["id"] == bytes_to_base64url(user_handle)
+    client.request("POST", "/logout")
+
+    # the credential index is not needed for a known userHandle
+    find_by_credential = db.store.find_by_credential
+    monkeypatch.setattr(db.store, "find_by_credential", None)
+    assert _login(client, authenticator) == 200
+    client.request("POST", "/logout")
+
+    # the userHandle of another user is rejected
+    client.request("POST", "/users", {"username": "bob", "password": "pw"})
+    bob_handle = db.store.assign_user_handle("bob")
+    authenticator.credentials = {
+        c.credential_id: c._replace(user_handle=bob_handle)
+        for c in authenticator.credentials.values()
+    }
+    assert _login(client, authenticator) == 404
+
+    # an unknown one (e.g. of a credential registered before users had a
+    # stable handle) falls back to the credential index
+    monkeypatch.setattr(db.store, "find_by_credential", find_by_credential)
+    authenticator.credentials = {
+        c.credential_id: c._replace(user_handle=b"legacy")
+        for c in authenticator.credentials.values()
+    }
+    assert _login(client, authenticator) == 200
+
+
+def test_password_login(client):
+    assert client.request("POST", "/users", {"username": "bob", "password": "pw"})[0] == 200
+    assert client.request("POST", "/users", {"username": "bob", "password": "pw"})[0] == 400
+    assert client.request("POST", "/login", {"username": "bob", "password": "x"})[0] == 400
+    assert client.request("POST", "/login", {"username": "nobody", "password": "x"})[0] == 400
+    assert client.request("POST", "/login", {"username": "bob", "password": "pw"}) == (
+        200,
+        {"status": "logged_in", "username": "bob"},
+    )
+    assert client.request("GET", "/users/me") == (200, {"username": "bob"})
+
+
+def test_sign_up_needs_a_json_body(client):
+    assert client.request("POST", "/users")[0] == 415
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_sign_up_rejects_malformed_json(store, asgi):
+    config = {"TESTING": True, "SECRET_KEY": SECRET_KEY}
+    headers = {"Content-Type": "application/json"}
+    if asgi:
+        client = create_asgi_app(config).test_client()
+        response = asyncio.run(client.post("/users", data=b"{", headers=headers))
+    else:
+        response = create_app(config).test_client().post("/users", data=b"{", headers=headers)
+    assert response.status_code == 400
+
+
+def test_sign_up_needs_a_json_object(client):
+    assert client.request("POST", "/users", ["alice", "pw"])[0] == 400
+
+
+def test_outdated_password_hashes_are_upgraded(client, monkeypatch):
+    client.request("POST", "/users", {"username": "bob", "password": "pw"})
+    old_hash = db.store.get_user("bob").password
+    monkeypatch.setattr(hasher, "method", "pbkdf2:sha256:1000")
+    monkeypatch.setattr(upgrader, "interval", 0)
+
+    assert client.request("POST", "/login", {"username": "bob", "password": "x"})[0] == 400
+    assert db.store.get_user("bob").password == old_hash
+    assert client.request("POST", "/login", {"username": "bob", "password": "pw"})[0] == 200
+    new_hash = db.store.get_user("bob").password
+    assert new_hash.startswith("pbkdf2:sha256:1000$")
+
+    # up to date now: logins keep working and the hash is left as it is
+    client.request("POST", "/logout")
+    assert client.request("POST", "/login", {"username": "bob", "password": "pw"})[0] == 200
+    assert db.store.get_user("bob").password == new_hash
+
+
+def test_sessions_are_valid_in_both_modes(store):
+    config = {"TESTING": True, "SECRET_KEY": SECRET_KEY}
+    flask_client = create_app(config).test_client()
+    flask_client.post("/users", json={"username": "alice", "password": "pw"})
+    flask_client.post("/login", json={"username": "alice", "password": "pw"})
+    cookie = flask_client.get_cookie("session").value
+
+    async def get_me():
+        client = create_asgi_app(config).test_client()
+        response = await client.get("/users/me", headers={"Cookie": f"session={cookie}"})
+        return response.status_code, await response.get_json()
+
+    assert asyncio.run(get_me()) == (200, {"username": "alice"})
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"User-Agent": "curl/8.5.0", "X-Forwarded-For": "198.51.100.1"},
+        {"User-Agent": "Mozilla/5.0", "X-Forwarded-For": "203.0.113.7, 10.0.0.1"},
+    ],
+)
+def test_session_identifier_matches_flask_login(headers):
+    from flask_login.utils import _create_identifier
+
+    async_views = pytest.importorskip("app.async_views")
+    config = {"TESTING": True, "SECRET_KEY": SECRET_KEY}
+    with create_app(config).test_request_context(headers=headers):
+        expected = _create_identifier()
+
+    async def identifier():
+        async with create_asgi_app(config).test_request_context("/", headers=headers):
+            return async_views._session_identifier()
+
+    assert asyncio.run(identifier()) == expected
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_load_generator_in_process(store, asgi):
+    config = {"TESTING": True}
+    app = create_asgi_app(config) if asgi else create_app(config)
+    client_class = loadgen.AsgiTestClient if asgi else loadgen.TestClient
+    report, wall, errors = loadgen.run(lambda: client_class(app), 3, 2, 2, "mixed", ORIGIN)
+    assert errors == []
+    assert report["POST /verify-authentication"]["requests"] == 6
+    assert report["POST /verify-registration"]["failures"] == 0
+    assert 0 < report["POST /users"]["p50_ms"] <= report["POST /users"]["max_ms"]
@@ -0,0 +1,179 @@
+import json
+
+import pytest
+from werkzeug.security import check_password_hash
+
+import app.admin as admin
+import app.bulk_import as bulk_import
+import app.db as db
+from app.bulk_import import import_users
+from app.db import Credential
+from app.hashing import HashingOverloaded
+from app.model import b64encode_no_pad
+from app.users import User
+from main import create_app
+
+HASH = "pbkdf2:sha256:1000$salt$" + "0" * 64
+
+
+@pytest.fixture
+def json_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+
+
+def _cred(n: int) -> dict:
+    return Credential(
+        credential_id=bytes([n]), public_key=b"pk", sign_count=n, transports=["usb"]
+    ).to_dict()
+
+
+def _lines(*rows) -> list:
+    return [r if isinstance(r, str) else json.dumps(r) for r in rows]
+
+
+def test_import_commits_once_per_batch(json_store, monkeypatch):
+    saves = []
+    save_userdb = db.save_userdb
+    monkeypatch.setattr(db, "save_userdb", lambda: saves.append(save_userdb()))
+
+    rows = [{"username": f"u{n}", "password_hash": HASH} for n in range(10)]
+    progress = []
+    report = import_users(_lines(*rows), 4, lambda r: progress.append(r.imported))
+
+    assert report.imported == 10 and report.errors == []
+    assert report.batches == 3
+    assert progress == [4, 8, 10]
+    assert len(saves) == 3
+    assert set(json.load(open(db.USERDB_FILE))) == {f"u{n}" for n in range(10)}
+
+
+def test_import_reports_bad_rows_and_continues(json_store):
+    User("taken", "pw").create()
+    User("owner", "pw").create()
+    User("owner", "pw").update_credential(Credential.from_dict(_cred(9)))
+
+    report = import_users(
+        _lines(
+            {"username": "alice", "password": "secret", "credentials": [_cred(1)]},
+            "{not json",
+            "",
+            {"username": "taken", "password_hash": HASH},
+            {"username": "bob"},
+            {"username": "carol", "password": "x", "password_hash": HASH},
+            {"username": "dave", "password_hash": "plaintext"},
+            {"username": "erin", "password_hash": HASH, "credentials": [_cred(9)]},
+            {"username": "frank", "password_hash": HASH, "credentials": [_cred(1)]},
+            {"username": "alice", "password_hash": HASH},
+            {"username": "gina", "password_hash": HASH, "credentials": [{"x": 1}]},
+            {"username": "hank", "password_hash": HASH, "credentials": [_cred(2)]},
+        ),
+        batch_size=100,
+    )
+
+    assert report.rows == 11
+    assert report.imported == 2
+    assert [e.line for e in report.errors] == [2, 4, 5, 6, 7, 8, 9, 10, 11]
+
+    alice = db.store.get_user("alice")
+    assert alice is not None
+    assert check_password_hash(alice.password, "secret")
+    assert db.store.find_by_credential(b64encode_no_pad(b"\x01")) == "alice"
+    hank = db.store.get_user("hank")
+    assert hank is not None and hank.password == HASH
+    assert hank.credentials[0].sign_count == 2
+
+
+def test_import_retries_rows_of_a_rejected_batch(json_store, monkeypatch):
+    add_users = db.store.add_users
+
+    def racing_add_users(users, wait=True):
+        # another request signs up "u1" between the check and the commit
+        if len(users) > 1 and db.store.get_user("u1") is None:
+            User("u1", "pw").create()
+        add_users(users, wait)
+
+    monkeypatch.setattr(db.store, "add_users", racing_add_users)
+    rows = [{"username": f"u{n}", "password_hash": HASH} for n in range(3)]
+    report = import_users(_lines(*rows), 10)
+
+    assert report.imported == 2
+    assert [e.line for e in report.errors] == [2]
+    assert db.store.get_user("u1").password == "pw"
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite", "binary", "sharded"])
+def test_add_users_is_all_or_nothing(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    for name in ("SQLITE_FILE", "JOURNAL_DIR", "BINARY_FILE", "SHARD_DIR"):
+        monkeypatch.setattr(db, f"USERDB_{name}", str(tmp_path / name.lower()))
+    store = db.open_store(backend)
+    store.load()
+
+    store.add_user("b", "pw")
+    users = {
+        "a": db.StoredUser(password="pw", credentials=(Credential.from_dict(_cred(1)),)),
+        "b": db.StoredUser(password="pw"),
+    }
+    with pytest.raises(ValueError):
+        store.add_users(users)
+    assert store.get_user("a") is None
+
+    del users["b"]
+    store.add_users(users)
+    store.close()
+
+    store = db.open_store(backend)
+    store.load()
+    assert store.get_user("a") == users["a"]
+    assert store.find_by_credential(b64encode_no_pad(b"\x01")) == "a"
+    store.close()
+
+
+def test_import_endpoint_requires_admin(json_store, monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_USERS", {"root"})
+    User("root", HASH).create()
+    User("guest", HASH).create()
+    client = create_app({"TESTING": True}).test_client()
+    body = "\n".join(_lines({"username": "new", "password_hash": HASH}, "{bad"))
+
+    assert client.post("/admin/users/import", data=body).status_code == 401
+
+    with client.session_transaction() as session:
+        session["_user_id"] = "guest"
+    assert client.post("/admin/users/import", data=body).status_code == 403
+
+    with client.session_transaction() as session:
+        session["_user_id"] = "root"
+    response = client.post(
+        "/admin/users/import",
+        data=body,
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 200
+    assert response.json["imported"] == 1
+    assert [e["line"] for e in response.json["errors"]] == [2]
+    assert db.store.get_user("new") is not None
+
+
+def test_import_waits_for_an_overloaded_hasher(json_store, monkeypatch):
+    generate = bulk_import.hasher.generate
+    calls = []
+
+    def overloaded_twice(password):
+        calls.append(password)
+        if len(calls) <= 2:
+            raise HashingOverloaded("too many password hashing requests")
+        return generate(password)
+
+    sleeps = []
+    monkeypatch.setattr(bulk_import.hasher, "generate", overloaded_twice)
+    monkeypatch.setattr(bulk_import.time, "sleep", sleeps.append)
+
+    report = import_users(_lines({"username": "alice", "password": "secret"}))
+    assert report.errors == []
+    assert report.imported == 1
+    assert sleeps == [0.01, 0.02]
+    assert check_password_hash(db.store.get_user("alice").password, "secret")
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+import app.challenges as challenges
+import app.passkey_auth as passkey_auth
+from app.challenges import MemoryChallengeStore, SqliteChallengeStore
+from main import app
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store_and_clock(request, tmp_path):
+    clock = Clock()
+    if request.param == "memory":
+        return MemoryChallengeStore(ttl=60, max_entries=3, clock=clock), clock
+    return SqliteChallengeStore(str(tmp_path / "c.sqlite3"), ttl=60, clock=clock), clock
+
+
+def test_pop_is_one_shot(store_and_clock):
+    store, _ = store_and_clock
+    handle = store.put(b"challenge")
+    assert store.pop(handle) == b"challenge"
+    assert store.pop(handle) is None
+    assert store.pop("unknown") is None
+    assert store.pop(None) is None
+
+
+def test_expired_challenge_is_not_returned(store_and_clock):
+    store, clock = store_and_clock
+    handle = store.put(b"old")
+    clock.now += 61
+    fresh = store.put(b"fresh")
+
+    assert store.pop(handle) is None
+    metrics = store.metrics()
+    assert metrics["live"] == 1
+    assert metrics["expired"] == 1
+    assert store.pop(fresh) == b"fresh"
+
+
+def test_concurrent_pops_consume_once(store_and_clock):
+    store, _ = store_and_clock
+    handle = store.put(b"challenge")
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(store.pop(handle)))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(b"challenge") == 1
+
+
+def test_memory_store_evicts_oldest_when_full():
+    store = MemoryChallengeStore(ttl=60, max_entries=2, clock=Clock())
+    handles = [store.put(bytes([i])) for i in range(3)]
+    assert store.pop(handles[0]) is None
+    assert store.pop(handles[2]) == b"\x02"
+    assert store.metrics()["evicted"] == 1
+
+
+def test_session_holds_only_the_handle(monkeypatch):
+    store = MemoryChallengeStore(ttl=60, max_entries=10)
+    monkeypatch.setattr(challenges, "store", store)
+    monkeypatch.setattr(passkey_auth, "RP_ID", "localhost")
+    client = app.test_client()
+
+    res = client.get("/generate-authentication-options")
+    assert res.status_code == 200
+    with client.session_transaction() as session:
+        handle = session["challenge"]
+    assert isinstance(handle, str)
+    assert store.pop(handle) is not None
@@ -0,0 +1,316 @@
+import json
+from array import array
+
+import pytest
+
+import app.db as db
+from app.db import Credential, CredentialRecord, UserRecord
+from app.db_binary import (
+    HEADER_V1,
+    MAGIC_V1,
+    RECORD_LENGTH,
+    BinarySnapshot,
+    BinaryUserStore,
+    _build_index,
+    binary_to_json,
+    encode_user,
+    json_to_binary,
+    key_hash,
+    write_snapshot,
+)
+from app.model import PasswordUpdate, SignCountUpdate, StoredUser
+
+
+def _cred(n: int) -> Credential:
+    return Credential(
+        credential_id=bytes([n, n]),
+        public_key=b"pk-%d" % n,
+        sign_count=0,
+        transports=["usb", "internal"],
+    )
+
+
+def _open(path: str) -> BinaryUserStore:
+    store = BinaryUserStore(path)
+    store.load()
+    return store
+
+
+def test_snapshot_lookups(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    users = {
+        f"u{n}": StoredUser(password=f"pw{n}", credentials=(_cred(n),))
+        for n in range(200)
+    }
+    users["none"] = StoredUser(password="pw")
+    odd = Credential(
+        credential_id=b"\xff" * 64,
+        public_key=b"k",
+        sign_count=2**32 - 1,
+        transports=None,
+        last_used=12.5,
+    )
+    users["odd"] = StoredUser(password="pw", credentials=(odd,))
+    assert write_snapshot(path, users.items()) == 202
+
+    snapshot = BinarySnapshot(path)
+    assert len(snapshot) == 202
+    for user_id, user in users.items():
+        assert snapshot.get(user_id) == user
+    assert snapshot.get("nobody") is None
+    assert snapshot.find_credential(bytes([7, 7])) == "u7"
+    assert snapshot.find_credential(b"\xff" * 64) == "odd"
+    assert snapshot.find_credential(b"\x00") is None
+    # records are kept in the order they were written
+    assert list(snapshot.items()) == list(users.items())
+    snapshot.close()
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    write_snapshot(path, [])
+    snapshot = BinarySnapshot(path)
+    assert len(snapshot) == 0
+    assert snapshot.get("alice") is None
+    assert list(snapshot.items()) == []
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "userdb.bin"
+    path.write_bytes(b"{}")
+    with pytest.raises(ValueError):
+        BinarySnapshot(str(path))
+
+
+def test_store_changes_survive_restart(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    store = _open(path)
+    store.add_user("alice", "pw")
+    with pytest.raises(ValueError):
+        store.add_user("alice", "pw")
+    store.add_credential("alice", _cred(1))
+    with pytest.raises(KeyError):
+        store.add_credential("nobody", _cred(2))
+    store.add_user("bob", "pw")
+
+    cred_id = _cred(1).to_dict()["credential_id"]
+    store.update_sign_count("alice", cred_id, 5, last_used=100.0)
+    with pytest.raises(KeyError):
+        store.update_sign_count("alice", "NON-EXISTENT", 1)
+    # flushed on every change (window 0), so nothing is pending in memory
+    assert store._changed == {}
+    store.close()
+
+    store = _open(path)
+    alice = store.get_user("alice")
+    assert alice is not None
+    assert alice.credentials[0].sign_count == 5
+    assert alice.credentials[0].last_used == 100.0
+    assert store.get_user("bob") == StoredUser(password="pw")
+    assert store.find_by_credential(cred_id) == "alice"
+    assert store.find_by_credential("NON-EXISTENT") is None
+
+    store.update_sign_counts(
+        [
+            SignCountUpdate("alice", cred_id, 6),
+            SignCountUpdate("bob", cred_id, 7),
+            SignCountUpdate("nobody", cred_id, 8),
+        ]
+    )
+    alice = store.get_user("alice")
+    assert alice is not None and alice.credentials[0].sign_count == 6
+    assert alice.credentials[0].last_used == 100.0
+    store.close()
+
+
+def test_first_credential_owner_is_kept(tmp_path):
+    store = _open(str(tmp_path / "userdb.bin"))
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+    store.add_credential("alice", _cred(1))
+    store.add_credential("bob", _cred(1))
+    assert store.find_by_credential(_cred(1).to_dict()["credential_id"]) == "alice"
+    store.close()
+
+
+def test_json_conversion_roundtrip(tmp_path):
+    json_path = tmp_path / "userdb.json"
+    binary_path = str(tmp_path / "userdb.bin")
+    records = {
+        "u1": UserRecord(
+            password="p1",
+            credentials=[
+                CredentialRecord(
+                    credential_id="AAA", public_key="BBBB", sign_count=3, transports=["usb"]
+                )
+            ],
+        ),
+        "u2": UserRecord(password="p2", credentials=[]),
+    }
+    json_path.write_text(json.dumps(records))
+
+    assert json_to_binary(str(json_path), binary_path) == 2
+    store = _open(binary_path)
+    assert store.get_user("u1") == StoredUser.from_dict(records["u1"])
+    assert store.find_by_credential("AAA") == "u1"
+    store.close()
+
+    out_path = tmp_path / "out.json"
+    assert binary_to_json(binary_path, str(out_path)) == 2
+    assert json.loads(out_path.read_text()) == records
+
+
+def test_open_store_selects_binary_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_BINARY_FILE", str(tmp_path / "userdb.bin"))
+    assert isinstance(db.open_store("binary"), BinaryUserStore)
+
+
+def test_user_handles(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    store = _open(path)
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+    handle = store.assign_user_handle("alice")
+    assert store.assign_user_handle("alice") == handle
+    assert store.find_by_user_handle(handle) == "alice"
+    with pytest.raises(KeyError):
+        store.assign_user_handle("nobody")
+    store.close()
+
+    # found through the user_handle index of the snapshot
+    store = _open(path)
+    assert store.get_user("alice").user_handle == handle
+    assert store.get_user("bob").user_handle is None
+    assert store.find_by_user_handle(handle) == "alice"
+    assert store.find_by_user_handle(b"unknown") is None
+    store.close()
+
+
+# A snapshot as written before user handles existed
+def _write_v1(path: str, users: dict) -> None:
+    records, hashes, offsets = [], array("Q"), array("Q")
+    credential_hashes, credential_offsets = array("Q"), array("Q")
+    offset = HEADER_V1.size
+    for user_id, user in users.items():
+        # version 1 records lack the (here empty) user_handle field
+        payload = encode_user(user_id, user)[RECORD_LENGTH.size :]
+        handle_at = 4 + len(user_id) + len(user.password)
+        payload = payload[:handle_at] + payload[handle_at + 2 :]
+        records.append(RECORD_LENGTH.pack(len(payload)) + payload)
+        hashes.append(key_hash(user_id.encode()))
+        offsets.append(offset)
+        for cred in user.credentials:
+            credential_hashes.append(key_hash(cred.credential_id))
+            credential_offsets.append(offset)
+        offset += len(records[-1])
+    user_table, user_slots = _build_index(hashes, offsets)
+    credential_table, credential_slots = _build_index(
+        credential_hashes, credential_offsets
+    )
+    header = HEADER_V1.pack(
+        MAGIC_V1, len(users), offset, user_slots, offset + len(user_table), credential_slots
+    )
+    with open(path, "wb") as f:
+        f.write(header + b"".join(records) + user_table + credential_table)
+
+
+def test_reads_version_1_snapshots(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    users = {"alice": StoredUser("pw", (_cred(1),)), "bob": StoredUser("pw")}
+    _write_v1(path, users)
+
+    store = _open(path)
+    assert dict(store.list_users()) == users
+    assert store.find_by_credential(_cred(1).to_dict()["credential_id"]) == "alice"
+    assert store.find_by_user_handle(b"unknown") is None
+
+    # the next flush writes the current format
+    handle = store.assign_user_handle("bob")
+    store.close()
+    store = _open(path)
+    assert store.find_by_user_handle(handle) == "bob"
+    assert store.get_user("alice") == users["alice"]
+    store.close()
+
+
+def test_password_updates_survive_restart(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    store = _open(path)
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+    store.update_passwords(
+        [
+            PasswordUpdate("alice", "pw", "new"),
+            PasswordUpdate("bob", "changed-since", "new"),
+            PasswordUpdate("nobody", "pw", "new"),
+        ]
+    )
+    store.close()
+
+    store = _open(path)
+    assert store.get_user("alice").password == "new"
+    assert store.get_user("bob").password == "pw"
+    assert store.get_user("nobody") is None
+    store.close()
+
+
+def test_values_which_do_not_fit_are_rejected_by_the_change(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    store = _open(path)
+    store.add_user("alice", "pw")
+    with pytest.raises(ValueError, match="password"):
+        store.add_user("bob", "x" * 70000)
+    with pytest.raises(ValueError, match="public_key"):
+        store.add_credential(
+            "alice",
+            Credential(
+                credential_id=b"\x09",
+                public_key=b"k" * 70000,
+                sign_count=0,
+                transports=[],
+            ),
+        )
+    store.add_credential("alice", _cred(1))
+    cred_id = _cred(1).to_dict()["credential_id"]
+    with pytest.raises(ValueError, match="sign_count"):
+        store.update_sign_count("alice", cred_id, 2**32)
+    store.update_sign_counts([SignCountUpdate("alice", cred_id, 2**32)])
+
+    # nothing was accepted, and later changes are still written
+    store.update_sign_count("alice", cred_id, 3)
+    snapshot = store._snapshot
+    store.close()
+    assert snapshot is not None and snapshot._map.closed
+
+    store = _open(path)
+    alice = store.get_user("alice")
+    assert alice is not None and alice.credentials[0].sign_count == 3
+    assert len(alice.credentials) == 1
+    assert store.get_user("bob") is None
+    store.close()
+
+
+def test_pages_search_the_user_id_order(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    # written out of order: the order table sorts them
+    users = {f"u{n}": StoredUser("pw") for n in (5, 1, 9, 3, 7)}
+    write_snapshot(path, users.items())
+    snapshot = BinarySnapshot(path)
+    assert [u for u, _ in snapshot.items_after()] == ["u1", "u3", "u5", "u7", "u9"]
+    assert [u for u, _ in snapshot.items_after("u4")] == ["u5", "u7", "u9"]
+    assert [u for u, _ in snapshot.items_after("u9")] == []
+    snapshot.close()
+
+    # changes not yet flushed are merged in
+    store = BinaryUserStore(path, window=3600)
+    store.load()
+    store.add_user("u4", "pw")
+    store.update_passwords([PasswordUpdate("u5", "pw", "new")])
+    assert [u for u, _ in store.list_users("u3", 3)] == ["u4", "u5", "u7"]
+    assert dict(store.list_users("u4", 1)) == {"u5": StoredUser("new")}
+    store.close()
+
+    # a flush writes the records themselves in user_id order
+    snapshot = BinarySnapshot(path)
+    assert [u for u, _ in snapshot.items()] == ["u1", "u3", "u4", "u5", "u7", "u9"]
+    snapshot.close()
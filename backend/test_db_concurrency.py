@@ -0,0 +1,89 @@
+import threading
+
+import app.db as db
+from app.db import Credential
+from app.persister import WriteBehindPersister
+from app.users import User
+
+THREADS = 8
+USERS_PER_THREAD = 25
+
+
+def test_concurrent_signups_and_registrations_lose_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    persister = WriteBehindPersister(lambda: db.save_userdb(), 0.005, 20)
+    monkeypatch.setattr(db, "persister", persister)
+
+    errors = []
+    stop = threading.Event()
+
+    def sign_up(t: int) -> None:
+        try:
+            for i in range(USERS_PER_THREAD):
+                user = User(f"user-{t}-{i}", "pw")
+                user.create()
+                for n in range(2):
+                    user.update_credential(
+                        Credential(
+                            credential_id=f"{t}-{i}-{n}".encode(),
+                            public_key=b"pk",
+                            sign_count=0,
+                            transports=[],
+                        )
+                    )
+        except Exception as e:
+            errors.append(e)
+
+    def read() -> None:
+        try:
+            while not stop.wait(0.001):
+                for user_id, user in db.snapshot_userdb().items():
+                    assert User.get_by_id(user_id) is not None
+                    for cred in user.credentials:
+                        assert cred.credential_id in db.credential_index
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    writers = [threading.Thread(target=sign_up, args=(t,)) for t in range(THREADS)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+    persister.close()
+
+    assert errors == []
+    assert persister.flushes < persister.marks
+
+    expected = {f"user-{t}-{i}" for t in range(THREADS) for i in range(USERS_PER_THREAD)}
+    for records in (db.userdb, db.load_userdb()):
+        assert set(records) == expected
+        assert all(len(user.credentials) == 2 for user in records.values())
+    assert len(db.credential_index) == 2 * len(expected)
+
+
+def test_requests_can_return_before_the_save(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    release = threading.Event()
+
+    def save() -> None:
+        release.wait()
+        db.save_userdb()
+
+    persister = WriteBehindPersister(save, 0.005, 20)
+    monkeypatch.setattr(db, "persister", persister)
+    monkeypatch.setattr(db, "USERDB_WRITE_WAIT", False)
+
+    # returns although the save is blocked
+    User("alice", "pw").create()
+    assert User.get_by_id("alice") is not None
+    release.set()
+    persister.close()
+    assert set(db.load_userdb()) == {"alice"}
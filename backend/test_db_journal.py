@@ -0,0 +1,179 @@
+import os
+import threading
+
+import pytest
+
+import app.db as db
+from app.db import Credential
+from app.db_journal import JournalUserStore
+from app.model import PasswordUpdate
+
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    return str(tmp_path / "userdb.d")
+
+
+def _open(directory: str, compact_every: int = 1000) -> JournalUserStore:
+    store = JournalUserStore(directory, compact_every)
+    store.load()
+    return store
+
+
+def _cred(n: int) -> Credential:
+    return Credential(
+        credential_id=bytes([n]), public_key=b"pk", sign_count=0, transports=["usb"]
+    )
+
+
+def test_journal_replays_after_restart(journal_dir):
+    store = _open(journal_dir)
+    store.add_user("alice", "pw")
+    store.add_credential("alice", _cred(1))
+    store.update_sign_count("alice", _cred(1).to_dict()["credential_id"], 5)
+    store.close()
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert store.entries == 3
+    user = store.get_user("alice")
+    assert user is not None
+    assert user.credentials[0].sign_count == 5
+    assert store.find_by_credential(_cred(1).to_dict()["credential_id"]) == "alice"
+    store.close()
+
+
+def test_journal_ignores_torn_last_line(journal_dir):
+    store = _open(journal_dir)
+    store.add_user("alice", "pw")
+    store.close()
+
+    journal = os.path.join(journal_dir, "journal.0.ndjson")
+    with open(journal, "a") as f:
+        f.write('{"op":"add_user","user_id":"bo')
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert store.get_user("bob") is None
+    # the torn line is cut off, so the next change starts on a fresh line
+    store.add_user("bob", "pw")
+    store.close()
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert set(db.userdb) == {"alice", "bob"}
+    store.close()
+
+
+def test_compaction_folds_journal_into_snapshot(journal_dir):
+    store = _open(journal_dir, compact_every=3)
+    for i in range(7):
+        store.add_user(f"u{i}", "pw")
+        store.add_credential(f"u{i}", _cred(i))
+    store.close()
+
+    files = sorted(os.listdir(journal_dir))
+    assert [f for f in files if f.startswith("snapshot.")]
+    assert not [f for f in files if f.endswith(".tmp")]
+    # journals older than the newest snapshot are removed
+    assert len([f for f in files if f.startswith("journal.")]) <= 2
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert set(db.userdb) == {f"u{i}" for i in range(7)}
+    assert all(len(u.credentials) == 1 for u in db.userdb.values())
+    store.close()
+
+
+def test_failed_journal_write_changes_nothing(journal_dir, monkeypatch):
+    store = _open(journal_dir)
+    store.add_user("alice", "pw")
+
+    fsync = os.fsync
+
+    def fail(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError):
+        store.add_credential("alice", _cred(1))
+    with pytest.raises(OSError):
+        store.add_user("bob", "pw")
+    assert db.userdb["alice"].credentials == ()
+    assert "bob" not in db.userdb
+    monkeypatch.setattr(os, "fsync", fsync)
+    store.close()
+
+    # nor is the failed change replayed
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert set(db.userdb) == {"alice"}
+    assert db.userdb["alice"].credentials == ()
+    store.close()
+
+
+def test_one_compactor_runs_at_a_time(journal_dir, monkeypatch):
+    store = _open(journal_dir, compact_every=1)
+    started = []
+    release = threading.Event()
+    compact = store.compact
+
+    def slow_compact():
+        started.append(1)
+        release.wait()
+        compact()
+
+    monkeypatch.setattr(store, "compact", slow_compact)
+    for i in range(5):
+        store.add_user(f"u{i}", "pw")
+    assert len(started) == 1
+    release.set()
+    store.close()
+    assert not store._compactor.is_alive()
+
+
+def test_user_handles_are_journaled(journal_dir):
+    store = _open(journal_dir)
+    store.add_user("alice", "pw")
+    handle = store.assign_user_handle("alice")
+    # already assigned: nothing to journal
+    assert store.assign_user_handle("alice") == handle
+    store.close()
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert store.entries == 2
+    assert store.get_user("alice").user_handle == handle
+    assert store.find_by_user_handle(handle) == "alice"
+
+    # and kept by compaction
+    store.compact()
+    store.close()
+    db.userdb = {}
+    store = _open(journal_dir)
+    assert store.find_by_user_handle(handle) == "alice"
+    store.close()
+
+
+def test_password_updates_are_journaled(journal_dir):
+    store = _open(journal_dir)
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+    store.update_passwords(
+        [
+            PasswordUpdate("alice", "pw", "new"),
+            PasswordUpdate("bob", "changed-since", "new"),
+            PasswordUpdate("nobody", "pw", "new"),
+        ]
+    )
+    store.close()
+
+    db.userdb = {}
+    store = _open(journal_dir)
+    # only the applied update was journaled
+    assert store.entries == 3
+    assert store.get_user("alice").password == "new"
+    assert store.get_user("bob").password == "pw"
+    store.close()
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+
+import pytest
+
+import app.db as db
+from app.db import Credential
+from app.db_sharded import ShardedUserStore
+from app.model import PasswordUpdate, SignCountUpdate, StoredUser
+
+
+@pytest.fixture
+def shard_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    return str(tmp_path / "userdb.shards")
+
+
+def _open(directory: str, shards: int = 4) -> ShardedUserStore:
+    store = ShardedUserStore(directory, shards)
+    store.load()
+    return store
+
+
+def _cred(n: int) -> Credential:
+    return Credential(
+        credential_id=bytes([n]), public_key=b"pk", sign_count=0, transports=["usb"]
+    )
+
+
+def _file_users(directory: str) -> dict:
+    users = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            users[name] = set(json.load(f))
+    return users
+
+
+def test_write_rewrites_only_its_shard(shard_dir):
+    store = _open(shard_dir)
+    for n in range(20):
+        store.add_user(f"u{n}", "pw")
+
+    files = _file_users(shard_dir)
+    assert set(files) == {f"shard-{n}.json" for n in range(4)}
+    assert set().union(*files.values()) == {f"u{n}" for n in range(20)}
+
+    mtimes = {name: os.stat(os.path.join(shard_dir, name)).st_mtime_ns for name in files}
+    store.add_credential("u0", _cred(1))
+    changed = [
+        name
+        for name in files
+        if os.stat(os.path.join(shard_dir, name)).st_mtime_ns != mtimes[name]
+    ]
+    assert changed == [f"shard-{store._shard_number('u0')}.json"]
+    store.close()
+
+
+def test_store_changes_survive_restart(shard_dir):
+    store = _open(shard_dir)
+    store.add_user("alice", "pw")
+    with pytest.raises(ValueError):
+        store.add_user("alice", "pw")
+    store.add_credential("alice", _cred(1))
+    with pytest.raises(KeyError):
+        store.add_credential("nobody", _cred(2))
+    store.add_user("bob", "pw")
+    store.add_credential("bob", _cred(1))
+
+    cred_id = _cred(1).to_dict()["credential_id"]
+    # the first owner of a credential is kept
+    assert store.find_by_credential(cred_id) == "alice"
+    store.update_sign_counts(
+        [
+            SignCountUpdate("alice", cred_id, 5, 100.0),
+            SignCountUpdate("bob", "NON-EXISTENT", 6),
+            SignCountUpdate("nobody", cred_id, 7),
+        ]
+    )
+    with pytest.raises(KeyError):
+        store.update_sign_count("alice", "NON-EXISTENT", 1)
+    store.close()
+
+    store = _open(shard_dir)
+    alice = store.get_user("alice")
+    assert alice is not None
+    assert alice.credentials[0].sign_count == 5
+    assert alice.credentials[0].last_used == 100.0
+    assert store.find_by_credential(cred_id) in ("alice", "bob")
+    assert store.find_by_credential("NON-EXISTENT") is None
+    store.close()
+
+
+def test_changing_shard_count_redistributes_users(shard_dir):
+    store = _open(shard_dir, shards=4)
+    for n in range(30):
+        store.add_user(f"u{n}", "pw")
+    store.close()
+
+    store = _open(shard_dir, shards=2)
+    assert set(_file_users(shard_dir)) == {"shard-0.json", "shard-1.json"}
+    for name, users in _file_users(shard_dir).items():
+        assert all(f"shard-{store._shard_number(u)}.json" == name for u in users)
+    assert all(store.get_user(f"u{n}") is not None for n in range(30))
+    store.close()
+
+
+def test_first_start_seeds_from_userdb_json(shard_dir):
+    with open(db.USERDB_FILE, "w") as f:
+        json.dump({"alice": StoredUser(password="pw").to_dict()}, f)
+    store = _open(shard_dir)
+    assert store.get_user("alice") == StoredUser(password="pw")
+    assert "alice" in set().union(*_file_users(shard_dir).values())
+    store.close()
+
+
+def test_concurrent_writers(shard_dir):
+    store = _open(shard_dir)
+
+    def sign_up(worker: int) -> None:
+        for n in range(10):
+            user_id = f"w{worker}-{n}"
+            store.add_user(user_id, "pw")
+            store.add_credential(user_id, _cred(worker * 10 + n))
+
+    threads = [threading.Thread(target=sign_up, args=(w,)) for w in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    store.close()
+
+    store = _open(shard_dir)
+    for w in range(8):
+        for n in range(10):
+            cred_id = _cred(w * 10 + n).to_dict()["credential_id"]
+            assert store.find_by_credential(cred_id) == f"w{w}-{n}"
+    store.close()
+
+
+def test_user_handles_survive_restart(shard_dir):
+    store = _open(shard_dir)
+    store.add_user("alice", "pw")
+    handle = store.assign_user_handle("alice")
+    assert store.assign_user_handle("alice") == handle
+    with pytest.raises(KeyError):
+        store.assign_user_handle("nobody")
+    store.close()
+
+    store = _open(shard_dir)
+    assert store.get_user("alice").user_handle == handle
+    assert store.find_by_user_handle(handle) == "alice"
+    assert store.find_by_user_handle(b"unknown") is None
+    store.close()
+
+
+def test_password_updates_survive_restart(shard_dir):
+    store = _open(shard_dir)
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+    store.update_passwords(
+        [
+            PasswordUpdate("alice", "pw", "new"),
+            PasswordUpdate("bob", "changed-since", "new"),
+            PasswordUpdate("nobody", "pw", "new"),
+        ]
+    )
+    store.close()
+
+    store = _open(shard_dir)
+    assert store.get_user("alice").password == "new"
+    assert store.get_user("bob").password == "pw"
+    assert store.get_user("nobody") is None
+    store.close()
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+
+import pytest
+
+import app.db as db
+from app.db import Credential, CredentialRecord, UserRecord
+from app.model import PasswordUpdate, StoredUser
+from app.db_sqlite import SqliteUserStore, migrate_from_json
+from app.users import User
+
+
+@pytest.fixture
+def sqlite_store(tmp_path, monkeypatch):
+    store = SqliteUserStore(str(tmp_path / "userdb.sqlite3"))
+    store.load()
+    monkeypatch.setattr(db, "store", store)
+    yield store
+    store.close()
+
+
+def test_sqlite_store_add_and_find(sqlite_store):
+    sqlite_store.add_user("alice", "pw")
+    with pytest.raises(ValueError):
+        sqlite_store.add_user("alice", "pw")
+
+    cred = Credential(
+        credential_id=b"\x01\x02", public_key=b"\x03\x04", sign_count=1, transports=["usb"]
+    )
+    sqlite_store.add_credential("alice", cred)
+    with pytest.raises(KeyError):
+        sqlite_store.add_credential("nobody", cred)
+
+    cred_id = cred.to_dict()["credential_id"]
+    assert sqlite_store.find_by_credential(cred_id) == "alice"
+    assert sqlite_store.find_by_credential("NON-EXISTENT") is None
+
+    record = sqlite_store.get_user("alice")
+    assert record is not None
+    assert record.password == "pw"
+    assert list(record.credentials) == [cred]
+
+    sqlite_store.update_sign_count("alice", cred_id, 9)
+    assert sqlite_store.get_user("alice").credentials[0].sign_count == 9
+    with pytest.raises(KeyError):
+        sqlite_store.update_sign_count("alice", "NON-EXISTENT", 1)
+
+
+def test_sqlite_store_uses_wal(sqlite_store):
+    conn = sqlite3.connect(sqlite_store.path)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+
+def test_user_goes_through_configured_store(sqlite_store):
+    User("bob", "secret").create()
+    User("bob", "secret").update_credential(
+        Credential(credential_id=b"\x10", public_key=b"pk", sign_count=0, transports=[])
+    )
+
+    user = User.get_by_id("bob")
+    assert user is not None and user.password == "secret"
+    assert user.credentials[0].public_key == b"pk"
+
+    cred_id = user.credentials[0].to_dict()["credential_id"]
+    found = User.find_user_by_credential_id(cred_id)
+    assert found is not None and found.id == "bob"
+    assert found.get_pubkey(cred_id) == b"pk"
+
+
+def test_migrate_from_json(tmp_path, sqlite_store):
+    json_path = tmp_path / "userdb.json"
+    records = {
+        "u1": UserRecord(
+            password="p1",
+            credentials=[
+                CredentialRecord(
+                    credential_id="AAA", public_key="BBB", sign_count=3, transports=["usb"]
+                )
+            ],
+        ),
+        "u2": UserRecord(password="p2", credentials=[]),
+    }
+    json_path.write_text(json.dumps(records))
+
+    assert migrate_from_json(str(json_path), sqlite_store) == 2
+    assert sqlite_store.get_user("u1") == StoredUser.from_dict(records["u1"])
+    assert sqlite_store.get_user("u2") == StoredUser.from_dict(records["u2"])
+    assert sqlite_store.find_by_credential("AAA") == "u1"
+
+
+def test_sqlite_user_handles(tmp_path, sqlite_store):
+    sqlite_store.add_user("alice", "pw")
+    sqlite_store.add_user("bob", "pw")
+    handle = sqlite_store.assign_user_handle("alice")
+    assert sqlite_store.assign_user_handle("alice") == handle
+    assert sqlite_store.assign_user_handle("bob") != handle
+    assert sqlite_store.find_by_user_handle(handle) == "alice"
+    assert sqlite_store.find_by_user_handle(b"unknown") is None
+    assert sqlite_store.get_user("alice").user_handle == handle
+    assert dict(sqlite_store.list_users())["alice"].user_handle == handle
+    with pytest.raises(KeyError):
+        sqlite_store.assign_user_handle("nobody")
+
+    # databases created before user_handle existed are migrated on load
+    path = str(tmp_path / "old.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, password TEXT NOT NULL)")
+    conn.execute("INSERT INTO users VALUES ('carol', 'pw')")
+    conn.commit()
+    conn.close()
+    old = SqliteUserStore(path)
+    old.load()
+    assert old.get_user("carol").user_handle is None
+    assert old.find_by_user_handle(old.assign_user_handle("carol")) == "carol"
+    old.close()
+
+
+def test_sqlite_password_updates(sqlite_store):
+    sqlite_store.add_user("alice", "pw")
+    sqlite_store.add_user("bob", "pw")
+    sqlite_store.update_passwords(
+        [
+            PasswordUpdate("alice", "pw", "new"),
+            PasswordUpdate("bob", "changed-since", "new"),
+            PasswordUpdate("nobody", "pw", "new"),
+        ]
+    )
+    assert sqlite_store.get_user("alice").password == "new"
+    assert sqlite_store.get_user("bob").password == "pw"
+    assert sqlite_store.get_user("nobody") is None
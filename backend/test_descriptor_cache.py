@@ -0,0 +1,89 @@
+import app.db as db
+from app.descriptor_cache import DescriptorCache, build_descriptors
+from app.model import Credential
+from webauthn.helpers.structs import AuthenticatorTransport
+
+
+def _cred(n: int, transports=("internal",)) -> Credential:
+    return Credential(
+        credential_id=bytes([n]), public_key=b"pk", sign_count=0, transports=list(transports)
+    )
+
+
+def test_build_descriptors_skips_unknown_transports():
+    (descriptor,) = build_descriptors([_cred(1, ("usb", "carrier-pigeon", "hybrid"))])
+    assert descriptor.id == b"\x01"
+    assert descriptor.transports == [AuthenticatorTransport.USB, AuthenticatorTransport.HYBRID]
+
+
+def test_build_descriptors_of_credentials_without_transports():
+    cred = Credential(credential_id=b"\x01", public_key=b"pk", sign_count=0, transports=None)
+    (descriptor,) = build_descriptors([cred])
+    assert descriptor.transports == []
+
+
+def test_hits_ttl_and_invalidation():
+    now = [0.0]
+    cache = DescriptorCache(maxsize=10, ttl=30, clock=lambda: now[0])
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [_cred(1)]
+
+    first = cache.get("alice", load)
+    assert cache.get("alice", load) is first
+    assert len(loads) == 1
+
+    now[0] = 31.0  # expired
+    cache.get("alice", load)
+    cache.invalidate_user("alice")
+    cache.get("alice", load)
+    assert len(loads) == 3
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 3, "evictions": 0}
+
+    # unknown users are not cached
+    assert cache.get("nobody", lambda: None) is None
+    assert cache.stats()["size"] == 1
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    cache = DescriptorCache(maxsize=10, ttl=30)
+
+    def load():
+        # the user registers a credential while its old list is being loaded
+        cache.invalidate_user("alice")
+        return [_cred(1)]
+
+    assert len(cache.get("alice", load)) == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_lru_eviction():
+    cache = DescriptorCache(maxsize=2, ttl=30)
+    for user in ("a", "b", "a", "c"):
+        cache.get(user, lambda: [])
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("a", lambda: None) == ()  # kept: recently used
+    assert cache.get("b", lambda: None) is None  # evicted
+
+
+def test_options_do_not_load_the_user_on_a_hit(tmp_path, monkeypatch):
+    from app import descriptor_cache, passkey_auth
+
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    monkeypatch.setattr(passkey_auth, "RP_ID", "localhost")
+    monkeypatch.setattr(descriptor_cache, "cache", DescriptorCache(10, 30))
+    db.store.add_user("alice", "pw")
+    db.store.add_credential("alice", _cred(7))
+
+    loads = []
+    get_user = db.store.get_user
+    monkeypatch.setattr(db.store, "get_user", lambda u: loads.append(u) or get_user(u))
+
+    for _ in range(3):
+        data, _ = passkey_auth.authentication_options("alice")
+        assert [c["id"] for c in data["allowCredentials"]] == ["Bw"]
+    assert loads == ["alice"]
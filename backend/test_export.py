@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import app.admin as admin
+import app.db as db
+from app.db import Credential, StoredUser
+from app.export import export_ndjson
+from app.users import User
+from main import create_app
+
+
+@pytest.fixture(params=["json", "journal", "sqlite", "binary", "sharded"])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    for name in ("SQLITE_FILE", "JOURNAL_DIR", "BINARY_FILE", "SHARD_DIR"):
+        monkeypatch.setattr(db, f"USERDB_{name}", str(tmp_path / name.lower()))
+    store = db.open_store(request.param)
+    store.load()
+    monkeypatch.setattr(db, "store", store)
+
+    # added out of order, some before and some after a restart of the store
+    for n in (5, 1, 9, 3):
+        store.add_user(f"u{n}", "pw")
+    store.add_credential(
+        "u3",
+        Credential(
+            credential_id=b"\x03", public_key=b"pk", sign_count=7, transports=["usb"]
+        ),
+    )
+    store.close()
+    store.load()
+    for n in (0, 7, 2):
+        store.add_user(f"u{n}", "pw")
+    yield store
+    store.close()
+
+
+def test_paging_sees_users_added_between_pages(store):
+    store.add_users({"u4": StoredUser(password="pw"), "u10": StoredUser(password="pw")})
+    seen, after = [], None
+    while page := [u for u, _ in store.list_users(after, 2)]:
+        seen += page
+        after = page[-1]
+        if after == "u2":
+            store.add_user("u8", "pw")
+    assert seen == sorted(seen)
+    assert seen == ["u0", "u1", "u10", "u2", "u3", "u4", "u5", "u7", "u8", "u9"]
+
+
+def test_list_users_pages_in_user_id_order(store):
+    assert [u for u, _ in store.list_users(limit=3)] == ["u0", "u1", "u2"]
+    assert [u for u, _ in store.list_users("u2", 3)] == ["u3", "u5", "u7"]
+    assert [u for u, _ in store.list_users("u7", 3)] == ["u9"]
+    assert [u for u, _ in store.list_users("u9", 3)] == []
+    assert len(list(store.list_users())) == 7
+
+    (user_id, user), = store.list_users("u2", 1)
+    assert user_id == "u3"
+    assert user.credentials[0].sign_count == 7
+
+
+def test_pages_span_several_chunks(store, monkeypatch):
+    monkeypatch.setattr(db, "PAGE_CHUNK", 2)
+    expected = ["u0", "u1", "u2", "u3", "u5", "u7", "u9"]
+    assert [u for u, _ in store.list_users()] == expected
+    assert [u for u, _ in store.list_users("u0", 5)] == expected[1:6]
+
+
+def test_export_streams_chunks(store):
+    chunks = list(export_ndjson(chunk_users=3))
+    assert len(chunks) == 3
+    rows = [json.loads(line) for line in "".join(chunks).splitlines()]
+    assert [r["username"] for r in rows] == ["u0", "u1", "u2", "u3", "u5", "u7", "u9"]
+    assert rows[3]["credentials"] == [
+        {"credential_id": "Aw", "sign_count": 7, "transports": ["usb"]}
+    ]
+    # no secrets in the export
+    assert "password" not in rows[0] and "public_key" not in rows[3]["credentials"][0]
+
+
+def test_admin_listing_and_export(store, monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_USERS", {"u0"})
+    client = create_app({"TESTING": True}).test_client()
+    assert client.get("/admin/users").status_code == 401
+    with client.session_transaction() as session:
+        session["_user_id"] = "u0"
+
+    seen = []
+    after = ""
+    while after is not None:
+        page = client.get(f"/admin/users?after={after}&limit=3").json
+        seen += [u["username"] for u in page["users"]]
+        after = page["next"]
+    assert seen == ["u0", "u1", "u2", "u3", "u5", "u7", "u9"]
+    assert client.get("/admin/users?limit=0").status_code == 400
+
+    response = client.get("/admin/users/export")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.is_streamed
+    assert len(response.get_data(as_text=True).splitlines()) == 7
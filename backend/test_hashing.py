@@ -0,0 +1,110 @@
+import pytest
+
+import app.db as db
+import app.hashing as hashing
+from app.hashing import HashingOverloaded, PasswordHasher, calibrate, normalize_method
+from main import app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash
+
+
+def test_pool_hashes_and_checks():
+    hasher = PasswordHasher(workers=1, max_pending=4)
+    try:
+        pwhash = hasher.generate("secret")
+        assert hasher.check(pwhash, "secret")
+        assert not hasher.check(pwhash, "wrong")
+        # not forked from the (threaded) server process
+        assert hasher._executor._mp_context.get_start_method() != "fork"
+    finally:
+        hasher.close()
+
+
+def test_full_queue_is_rejected():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    # simulate a job already holding the only slot
+    hasher._slots.acquire()
+    with pytest.raises(HashingOverloaded):
+        hasher.generate("secret")
+    assert hasher.rejected == 1
+    hasher._slots.release()
+    hasher.close()
+
+
+def test_endpoints_answer_503_when_overloaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    client = app.test_client()
+
+    assert client.post("/users", json={"username": "a", "password": "pw"}).status_code == 200
+
+    busy = PasswordHasher(workers=1, max_pending=1)
+    busy._slots.acquire()
+    monkeypatch.setattr(hashing.hasher, "_run", busy._run)
+
+    res = client.post("/login", json={"username": "a", "password": "pw"})
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    res = client.post("/users", json={"username": "b", "password": "pw"})
+    assert res.status_code == 503
+    assert db.store.get_user("b") is None
+
+
+def test_unknown_users_cost_a_password_check(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    checked = []
+    check = hashing.hasher.check
+    monkeypatch.setattr(
+        hashing.hasher, "check", lambda pwhash, pw: checked.append(pw) or check(pwhash, pw)
+    )
+    client = app.test_client()
+
+    res = client.post("/login", json={"username": "nobody", "password": "pw"})
+    assert res.status_code == 400
+    # same answer as a wrong password, after the same work
+    client.post("/users", json={"username": "a", "password": "pw"})
+    wrong = client.post("/login", json={"username": "a", "password": "x"})
+    assert wrong.get_json() == res.get_json()
+    assert checked == ["pw", "x"]
+
+
+def test_hash_method_policy():
+    assert normalize_method("scrypt") == "scrypt:32768:8:1"
+    assert normalize_method("pbkdf2:sha256") == f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+    for invalid in ("bcrypt", "scrypt:3:8:1", "scrypt:1024", "pbkdf2:sha256:x"):
+        with pytest.raises(ValueError):
+            normalize_method(invalid)
+
+    hasher = PasswordHasher(workers=0, max_pending=1, method="pbkdf2:sha256:1000")
+    pwhash = hasher.generate("pw")
+    assert pwhash.startswith("pbkdf2:sha256:1000$")
+    assert not hasher.needs_rehash(pwhash)
+    assert hasher.needs_rehash(generate_password_hash("pw", "pbkdf2:sha256:2000"))
+    assert hasher.needs_rehash(generate_password_hash("pw", "scrypt:16384:8:1"))
+    assert not hasher.check_dummy("pw")
+    assert not hasher.needs_rehash(hasher._dummy_hash)
+
+
+def test_calibrate_picks_the_strongest_method_within_target(monkeypatch):
+    # 50 ms for werkzeug's defaults, linear in the cost
+    def median_seconds(method, samples):
+        name, *args = method.split(":")
+        if name == "scrypt":
+            return int(args[0]) / 2**15 * 0.05
+        return int(args[1]) / DEFAULT_PBKDF2_ITERATIONS * 0.05
+
+    monkeypatch.setattr(hashing, "median_seconds", median_seconds)
+    method, tried = calibrate("scrypt", 0.06)
+    assert method == "scrypt:32768:8:1"
+    assert [m for m, _ in tried] == ["scrypt:16384:8:1", "scrypt:32768:8:1", "scrypt:65536:8:1"]
+    # bounded by memory (128 * n * r bytes)
+    assert calibrate("scrypt", 1, max_memory=16 * 2**20)[0] == "scrypt:16384:8:1"
+    # too slow a host still gets the weakest method
+    assert calibrate("scrypt", 0.001)[0] == "scrypt:16384:8:1"
+
+    assert calibrate("pbkdf2", 0.05)[0] == f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+    assert calibrate("pbkdf2", 0.025)[0] == "pbkdf2:sha256:500000"
+    with pytest.raises(ValueError):
+        calibrate("md5", 0.05)
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from app import lookup_filter
+from app.db_binary import BinaryUserStore
+from app.lookup_filter import BloomFilter, FilteredUserStore, ScalableBloomFilter
+from app.model import Credential, StoredUser, b64encode_no_pad
+
+
+def _cred(n: int) -> Credential:
+    return Credential(
+        credential_id=bytes([n]) * 16, public_key=b"pk", sign_count=0, transports=[]
+    )
+
+
+def test_bloom_filter_size_and_error_rate():
+    f = BloomFilter(10_000, 0.01)
+    # about 9.6 bits and 7 hash functions per key
+    assert f.hashes == 7
+    assert 95_000 < f.size < 97_000
+
+    scalable = ScalableBloomFilter(1000, 0.01)
+    keys = [os.urandom(16) for _ in range(5000)]
+    for key in keys:
+        scalable.add(key)
+    # no false negatives, and filters were added as it filled up
+    assert all(key in scalable for key in keys)
+    assert scalable.stats()["filters"] == 3
+    assert 4900 <= len(scalable) <= 5000
+    assert scalable.false_positive_rate() < 0.01
+    false_positives = sum(os.urandom(16) in scalable for _ in range(20_000))
+    assert false_positives < 20_000 * 0.01
+
+
+class CountingStore(BinaryUserStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.lookups = 0
+
+    def get_user(self, user_id):
+        self.lookups += 1
+        return super().get_user(user_id)
+
+    def find_by_credential(self, credential_id):
+        self.lookups += 1
+        return super().find_by_credential(credential_id)
+
+
+def test_unknown_keys_do_not_reach_the_store(tmp_path):
+    path = str(tmp_path / "userdb.bin")
+    inner = CountingStore(path)
+    store = FilteredUserStore(inner, 100, 0.001)
+    store.load()
+    store.add_users({"alice": StoredUser("pw", (_cred(1),))})
+    store.add_user("bob", "pw")
+    store.add_credential("bob", _cred(2))
+    store.close()
+
+    # rebuilt from the store on load
+    inner = CountingStore(path)
+    store = FilteredUserStore(inner, 100, 0.001)
+    store.load()
+    assert store.wait_ready(5)
+    for user_id, n in (("alice", 1), ("bob", 2)):
+        assert store.get_user(user_id) is not None
+        assert store.find_by_credential(b64encode_no_pad(_cred(n).credential_id)) == user_id
+    assert inner.lookups == 4
+
+    for n in range(100):
+        assert store.get_user(f"bot-{n}") is None
+        assert store.find_by_credential(b64encode_no_pad(os.urandom(16))) is None
+    assert store.find_by_credential("not base64!") is None
+    # at most a false positive or two went to the store
+    assert inner.lookups <= 6
+    assert store.stats()["rejected"] >= 198
+
+    # new keys are known as soon as they are added
+    store.add_user("carol", "pw")
+    assert store.get_user("carol") is not None
+    store.close()
+
+
+def test_wrap(monkeypatch):
+    store = BinaryUserStore("unused")
+    # filtered by default
+    assert isinstance(lookup_filter.wrap(store, "binary"), FilteredUserStore)
+    monkeypatch.setattr(lookup_filter, "LOOKUP_FILTER_BACKENDS", {"binary", "sqlite"})
+    assert isinstance(lookup_filter.wrap(store, "binary"), FilteredUserStore)
+    assert lookup_filter.wrap(store, "json") is store
+    with pytest.raises(ValueError):
+        lookup_filter.wrap(store, "sqlite")
+    assert lookup_filter.stats(store) == {}
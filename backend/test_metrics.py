@@ -0,0 +1,74 @@
+import threading
+
+import app.db as db
+from app import metrics
+from app.metrics import Counter, Histogram
+from main import create_app
+
+
+def test_histogram_buckets_and_threads():
+    h = Histogram("test_seconds", "test", ("op",), buckets=(0.1, 1.0))
+
+    def work():
+        for value in (0.05, 0.1, 0.5, 2.0):
+            h.observe(value, "a")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    h.observe(0.5, "b")
+
+    lines = list(h.collect())
+    assert lines[:2] == ["# HELP test_seconds test", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{op="a",le="0.1"} 8' in lines
+    assert 'test_seconds_bucket{op="a",le="1"} 12' in lines
+    assert 'test_seconds_bucket{op="a",le="+Inf"} 16' in lines
+    assert 'test_seconds_sum{op="a"} 10.6' in lines
+    assert 'test_seconds_count{op="a"} 16' in lines
+    assert 'test_seconds_count{op="b"} 1' in lines
+
+
+def test_rows_of_finished_threads_are_kept():
+    c = Counter("test_total", "test", ("k",))
+    for _ in range(20):
+        t = threading.Thread(target=lambda: c.inc('x"y'))
+        t.start()
+        t.join()
+    del t
+    assert list(c.samples()) == ['test_total{k="x\\"y"} 20']
+    # finished threads were folded into the retired rows
+    assert len(c._threads) <= 2
+
+
+def test_metrics_endpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    client = create_app({"TESTING": True}).test_client()
+
+    client.post("/users", json={"username": "alice", "password": "pw"})
+    client.post("/login", json={"username": "alice", "password": "wrong"})
+    client.get("/no-such-page")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'http_requests_total{endpoint="/users",method="POST",status="200"}' in text
+    assert 'http_requests_total{endpoint="/login",method="POST",status="400"}' in text
+    assert 'http_requests_total{endpoint="unmatched",method="GET",status="404"}' in text
+    assert 'http_request_duration_seconds_count{endpoint="/login"}' in text
+    for operation in ("password_hash", "password_check", "get_user", "save_userdb"):
+        assert f'app_operation_duration_seconds_count{{operation="{operation}"}}' in text
+    assert "pubkey_cache_hits " in text
+    assert "challenges_issued " in text
+    assert "userdb_persister_flushes " in text
+
+
+def test_failing_stats_do_not_break_the_scrape(monkeypatch):
+    monkeypatch.setitem(metrics.registry, "broken", metrics.StatsGauges("broken", "x", lambda: {"x": 1 / 0}))
+    text = metrics.exposition()
+    assert "# broken failed" in text
+    assert "http_requests_total" in text
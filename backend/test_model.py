@@ -2,6 +2,8 @@
 import json
 from base64 import urlsafe_b64encode
 
+import pytest
+
 import app.db as db
 from app.db import Credential, CredentialRecord, UserRecord
 from app.users import User
@@ -64,22 +66,22 @@ def test_user_save_updates_userdb_and_calls_save_userdb(monkeypatch):
     def fake_save_userdb():
         called["v"] = True
 
-    db.save_userdb = fake_save_userdb
+    monkeypatch.setattr(db, "save_userdb", fake_save_userdb)
 
     u = User("charlie", "secret", [])
     u.create()
 
     assert "charlie" in db.userdb
     entry = db.userdb["charlie"]
-    assert entry["password"] == "secret"
-    # credentials stored as provided (empty list)
-    assert entry["credentials"] == []
+    assert entry.password == "secret"
+    # credentials stored as provided (none)
+    assert entry.credentials == ()
     assert called["v"] is True
 
 
 def test_get_by_id_and_find_user_by_credential_id():
-    # Prepare userdb where credentials are stored as dicts (persisted form)
-    db.userdb = {
+    # Prepare userdb from records in the persisted form
+    db.userdb = db.from_records({
         "u1": UserRecord(
             {
                 "username": "u1",
@@ -101,15 +103,15 @@ def test_get_by_id_and_find_user_by_credential_id():
                 "credentials": [],
             }
         ),
-    }
+    })
     user = User.get_by_id("u1")
     assert user is not None
     assert isinstance(user, User)
     assert user.id == "u1"
     assert user.password == "p1"
-    # get_by_id returns the raw credentials value stored in userdb
-    for user_cred, db_cred in zip(user.credentials, db.userdb["u1"]["credentials"]):
-        assert user_cred == Credential.from_dict(db_cred)
+    # get_by_id returns the credentials stored in userdb
+    assert list(user.credentials) == list(db.userdb["u1"].credentials)
+    assert user.credentials[0].to_dict()["credential_id"] == "AAA"
 
     # find_user_by_credential_id should find u1 by matching credential_id string
     found = User.find_user_by_credential_id("AAA")
@@ -138,14 +140,16 @@ def test_save_userdb_encodes_bytes_and_writes_file(tmp_path, monkeypatch) -> Non
             "transports": ["usb"],
         }
     )
-    db.userdb = {
-        "alice": UserRecord(
-            {
-                "password": "pw",
-                "credentials": [cred],
-            }
-        ),
-    }
+    db.userdb = db.from_records(
+        {
+            "alice": UserRecord(
+                {
+                    "password": "pw",
+                    "credentials": [cred],
+                }
+            ),
+        }
+    )
 
     db.save_userdb()
 
@@ -167,9 +171,11 @@ def test_save_userdb_includes_empty_credentials(tmp_path, monkeypatch):
     out_file = tmp_path / "userdb.json"
     monkeypatch.setattr(db, "USERDB_FILE", str(out_file))
 
-    db.userdb = {
-        "bob": UserRecord({"password": "p", "credentials": []}),
-    }
+    db.userdb = db.from_records(
+        {
+            "bob": UserRecord({"password": "p", "credentials": []}),
+        }
+    )
 
     db.save_userdb()
 
@@ -217,7 +223,7 @@ def test_save_userdb_and_load_userdb_roundtrip(tmp_path, monkeypatch):
     }
 
     # Inject into in-memory userdb and save to file
-    db.userdb = original_userdb.copy()
+    db.userdb = db.from_records(original_userdb)
     db.save_userdb()
 
     # Read file directly to assert it was written (sanity)
@@ -239,10 +245,89 @@ def test_save_userdb_and_load_userdb_roundtrip(tmp_path, monkeypatch):
     # Expect loaded to contain the same persisted structure
     assert "alice" in loaded
     entry = loaded["alice"]
-    assert entry["password"] == "pw"
-    assert isinstance(entry["credentials"], list)
-    loaded_cred = entry["credentials"][0]
+    assert entry.password == "pw"
+    assert len(entry.credentials) == 1
+    loaded_cred = entry.credentials[0].to_dict()
     assert loaded_cred["credential_id"] == credential_id
     assert loaded_cred["public_key"] == public_key
     assert int(loaded_cred["sign_count"]) == 5
     assert loaded_cred.get("transports") == ["usb"]
+    assert loaded == db.from_records(original_userdb)
+
+
+def test_credential_index_stays_consistent_after_mutations(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    db.userdb = db.from_records(
+        {
+            "u1": UserRecord(
+                password="p1",
+                credentials=[
+                    CredentialRecord(
+                        credential_id="AAA", public_key="BBB", sign_count=0, transports=[]
+                    )
+                ],
+            ),
+        }
+    )
+
+    for user_id, cred_id in [("u2", b"\x01\x02"), ("u3", b"\x03")]:
+        user = User(user_id, "pw")
+        user.create()
+        user.update_credential(
+            Credential(credential_id=cred_id, public_key=b"k", sign_count=0, transports=[])
+        )
+
+    # the maintained index matches one rebuilt from the primary dict
+    assert db.credential_index == db.build_credential_index(db.userdb)
+    assert set(db.credential_index.values()) == {"u1", "u2", "u3"}
+
+    b64id = urlsafe_b64encode(b"\x01\x02").rstrip(b"=").decode("ascii")
+    found = User.find_user_by_credential_id(b64id)
+    assert found is not None and found.id == "u2"
+
+    # load_userdb rebuilds the index for the loaded records
+    db.userdb = db.load_userdb()
+    assert db.credential_index == db.build_credential_index(db.userdb)
+    assert db.find_user_id_by_credential_id(b64id) == "u2"
+    assert db.find_user_id_by_credential_id("NON-EXISTENT") is None
+
+
+def test_user_handles(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    store = db.JsonUserStore()
+    store.add_user("alice", "pw")
+    store.add_user("bob", "pw")
+
+    handle = store.assign_user_handle("alice")
+    assert len(handle) == 16
+    assert store.assign_user_handle("alice") == handle
+    assert store.assign_user_handle("bob") != handle
+    assert store.find_by_user_handle(handle) == "alice"
+    assert store.find_by_user_handle(b"unknown") is None
+    with pytest.raises(KeyError):
+        store.assign_user_handle("nobody")
+
+    # persisted with the user, and indexed again on load
+    db.save_userdb()
+    record = json.loads((tmp_path / "userdb.json").read_text())["alice"]
+    assert record["user_handle"] == urlsafe_b64encode(handle).rstrip(b"=").decode()
+    monkeypatch.setattr(db, "userdb", db.load_userdb())
+    assert db.userdb["alice"].user_handle == handle
+    assert store.find_by_user_handle(handle) == "alice"
+    # records written before user handles existed have none
+    legacy = db.StoredUser.from_dict(UserRecord(password="pw", credentials=[]))
+    assert legacy.user_handle is None
+
+
+def test_non_canonical_base64_round_trips_unchanged():
+    # "BBB" has non-zero trailing bits: it decodes to the bytes of "BBA"
+    record = db.CredentialRecord(
+        credential_id="AAB", public_key="BBB", sign_count=0, transports=None
+    )
+    cred = Credential.from_dict(record)
+    assert cred.public_key == Credential.from_dict({**record, "public_key": "BBA"}).public_key
+    assert cred.to_dict() == record
+    # canonical values don't keep their text
+    canonical = Credential.from_dict({**record, "credential_id": "AAA", "public_key": "BBA"})
+    assert canonical.credential_id_text is None and canonical.public_key_text is None
@@ -0,0 +1,72 @@
+import http.cookiejar
+import json
+import os
+import subprocess
+import sys
+import urllib.request
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKERS = 3
+
+# A worker process: the app from the factory on an ephemeral port
+WORKER = """
+from werkzeug.serving import make_server
+from main import create_app
+
+server = make_server("127.0.0.1", 0, create_app(), threaded=True)
+print(server.port, flush=True)
+server.serve_forever()
+"""
+
+
+@pytest.fixture
+def workers(tmp_path):
+    env = {
+        **os.environ,
+        "SECRET_KEY": "test-shared-secret",
+        "USERDB_BACKEND": "sqlite",
+        "USERDB_SQLITE_FILE": str(tmp_path / "userdb.sqlite3"),
+        "CHALLENGE_STORE": "sqlite",
+        "CHALLENGE_SQLITE_FILE": str(tmp_path / "challenges.sqlite3"),
+    }
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-c", WORKER],
+            cwd=BACKEND_DIR,
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(WORKERS)
+    ]
+    try:
+        yield [f"http://127.0.0.1:{int(p.stdout.readline())}" for p in procs]
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+
+def test_sessions_and_users_are_shared_by_workers(workers):
+    # cookies are not port specific, so every worker sees the same session
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+    )
+
+    def call(url: str, path: str, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        req = urllib.request.Request(
+            url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with opener.open(req) as res:
+            return json.load(res)
+
+    credentials = {"username": "alice", "password": "pw"}
+    assert call(workers[0], "/users", credentials)["status"] == "created"
+    # the user created on worker 0 can log in on worker 1 ...
+    assert call(workers[1], "/login", credentials)["status"] == "logged_in"
+    # ... and the session of worker 1 is valid on every worker
+    for url in workers:
+        assert call(url, "/users/me") == {"username": "alice"}
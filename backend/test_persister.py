@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from app.persister import WriteBehindPersister
+
+
+def test_marks_are_coalesced_into_few_flushes():
+    flushed = []
+
+    def flush():
+        time.sleep(0.01)
+        flushed.append(1)
+
+    persister = WriteBehindPersister(flush, 0.05, 1000)
+
+    threads = [threading.Thread(target=persister.mark_dirty) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # every waiting caller returned after a flush; the marks made while one
+    # was running were coalesced into the next
+    assert persister.marks == 20
+    assert 1 <= len(flushed) < 20
+    persister.close()
+
+
+def test_lone_mark_is_flushed_right_away():
+    persister = WriteBehindPersister(lambda: None, 10.0, 1000)
+    started = time.monotonic()
+    persister.mark_dirty()
+    assert time.monotonic() - started < 1.0
+    assert persister.flushes == 1
+    persister.close()
+
+
+def test_max_batch_bounds_a_flush():
+    release = threading.Event()
+    persister = WriteBehindPersister(release.wait, 10.0, 2)
+    persister.mark_dirty(wait=False)
+    while persister.metrics()["queue_depth"]:
+        time.sleep(0.001)
+    # five marks queued behind the running flush go out in batches of two
+    for _ in range(5):
+        persister.mark_dirty(wait=False)
+    release.set()
+    persister.close()
+    assert persister.marks == 6
+    assert persister.flushes == 4
+
+
+def test_fire_and_forget_is_flushed_on_close():
+    flushed = []
+    release = threading.Event()
+
+    def flush():
+        release.wait()
+        flushed.append(1)
+
+    persister = WriteBehindPersister(flush, 10.0, 1000)
+
+    persister.mark_dirty(wait=False)
+    assert flushed == []
+    release.set()
+    persister.close()
+    assert flushed == [1]
+
+    metrics = persister.metrics()
+    assert metrics["queue_depth"] == 0
+    assert metrics["flushes"] == 1
+    assert metrics["max_flush_seconds"] >= metrics["last_flush_seconds"] >= 0
+
+
+def test_flush_error_is_raised_to_waiting_caller():
+    def fail():
+        raise OSError("disk full")
+
+    persister = WriteBehindPersister(fail, 0.01, 10)
+    with pytest.raises(OSError):
+        persister.mark_dirty()
+    assert persister.flush_errors == 1
+    persister.close()
+
+
+def test_zero_window_flushes_synchronously():
+    flushed = []
+    persister = WriteBehindPersister(lambda: flushed.append(1), 0, 10)
+    persister.mark_dirty(wait=False)
+    assert flushed == [1]
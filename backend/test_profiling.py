@@ -0,0 +1,103 @@
+import marshal
+import os
+import pstats
+import time
+
+import pytest
+
+import app.admin as admin
+import app.db as db
+from app.profiling import ProfileConfig, Profiler, profiler
+from app.users import User
+from main import create_app
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    config = profiler.config
+    profiler.configure(ProfileConfig(directory=str(tmp_path / "profiles")))
+    yield create_app({"TESTING": True}).test_client()
+    profiler.configure(config)
+
+
+def _files(suffix: str) -> list:
+    directory = profiler.config.directory
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(suffix))
+
+
+def test_disabled_profiles_nothing(client):
+    profiler.update(sample_rate=1.0, endpoints=["/users"])
+    client.post("/users", json={"username": "alice", "password": "pw"})
+    assert _files(".prof") == []
+    assert profiler.stats()["profiled"] == 0
+
+
+def test_cprofile_by_endpoint_and_header(client):
+    profiler.update(enabled=True, endpoints=["/users"], token="t0ken")
+    client.post("/users", json={"username": "alice", "password": "pw"})
+    client.post("/login", json={"username": "alice", "password": "pw"})
+    client.post("/login", json={"username": "alice", "password": "pw"}, headers={"X-Profile": "wrong"})
+    client.post("/login", json={"username": "alice", "password": "pw"}, headers={"X-Profile": "t0ken"})
+
+    files = _files(".prof")
+    assert [os.path.basename(f).rsplit("-", 1)[1] for f in files] == ["users.prof", "login.prof"]
+    # loadable with pstats, and it covers the view
+    stats = pstats.Stats(files[0])
+    assert any(func == "create_user" for _, _, func in stats.stats)  # type: ignore[attr-defined]
+    assert isinstance(marshal.loads(open(files[1], "rb").read()), dict)
+
+
+def test_size_cap_removes_oldest(tmp_path):
+    p = Profiler(ProfileConfig(directory=str(tmp_path), max_bytes=250))
+    for n in range(5):
+        p.write(f"r{n}", "prof", b"x" * 100)
+    names = sorted(os.listdir(tmp_path))
+    assert [n.rsplit("-", 1)[1] for n in names] == ["r3.prof", "r4.prof"]
+    assert p.files_written == 5 and p.files_removed == 3
+
+
+def test_stack_sampler_collapsed_stacks(client, monkeypatch):
+    User("alice", "pw").create()
+    real_get = User.get_by_id
+
+    def slow_get(user_id):
+        time.sleep(0.05)
+        return real_get(user_id)
+
+    monkeypatch.setattr(User, "get_by_id", staticmethod(slow_get))
+    with client.session_transaction() as session:
+        session["_user_id"] = "alice"
+    profiler.update(enabled=True, mode="stacks", endpoints=["/users/me"], stack_interval=0.002)
+    assert client.get("/users/me").status_code == 200
+    profiler.update(enabled=False)  # stops the sampler, which writes the stacks
+
+    (path,) = _files(".txt")
+    lines = open(path).read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("slow_get" in line for line in lines)
+
+
+def test_profiling_endpoint(client, monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_USERS", {"root"})
+    User("root", "pw").create()
+    with client.session_transaction() as session:
+        session["_user_id"] = "root"
+
+    response = client.post("/admin/profiling", json={"enabled": True, "sample_rate": 1})
+    assert response.status_code == 200
+    assert response.json["enabled"] is True and "token" not in response.json
+    assert profiler.config.sample_rate == 1
+
+    # profiling starts with the next request
+    client.get("/admin/profiling")
+    assert len(_files(".prof")) == 1
+
+    assert client.post("/admin/profiling", json={"mode": "perf"}).status_code == 400
+    assert client.post("/admin/profiling", json={"directory": "/"}).status_code == 400
+    assert client.post("/admin/profiling", json={"endpoints": "/login"}).status_code == 400
+    assert profiler.config.mode == "cprofile"
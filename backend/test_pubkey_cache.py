@@ -0,0 +1,76 @@
+import cbor2
+from cryptography.hazmat.primitives.asymmetric import ec
+from webauthn.helpers import decode_credential_public_key
+
+import webauthn.authentication.verify_authentication_response as verify_module
+from app.pubkey_cache import PublicKeyCache, use
+
+
+def _cose_p256_public_key() -> bytes:
+    numbers = ec.generate_private_key(ec.SECP256R1()).public_key().public_numbers()
+    return cbor2.dumps(
+        {
+            1: 2,  # kty: EC2
+            3: -7,  # alg: ES256
+            -1: 1,  # crv: P-256
+            -2: numbers.x.to_bytes(32, "big"),
+            -3: numbers.y.to_bytes(32, "big"),
+        }
+    )
+
+
+def test_hits_misses_and_evictions():
+    cache = PublicKeyCache(maxsize=2)
+    loads = []
+
+    def loader(key: bytes):
+        def load():
+            loads.append(key)
+            return key
+
+        return load
+
+    assert cache.get("c1", "alice", loader(b"k1")).public_key == b"k1"
+    assert cache.get("c1", "alice", loader(b"k1")).public_key == b"k1"
+    assert loads == [b"k1"]
+
+    cache.get("c2", "alice", loader(b"k2"))
+    cache.get("c1", "alice", loader(b"k1"))  # c1 becomes most recently used
+    cache.get("c3", "bob", loader(b"k3"))  # evicts c2
+
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 3, "evictions": 1}
+    cache.get("c2", "alice", loader(b"k2"))
+    assert loads == [b"k1", b"k2", b"k3", b"k2"]
+
+    # unknown credential is not cached
+    assert cache.get("c4", "bob", lambda: None) is None
+    assert cache.stats()["size"] == 2
+
+
+def test_invalidate_user_drops_only_that_user():
+    cache = PublicKeyCache(maxsize=10)
+    cache.get("c1", "alice", lambda: b"k1")
+    cache.get("c2", "bob", lambda: b"k2")
+
+    cache.invalidate_user("alice")
+
+    assert cache.get("c1", "alice", lambda: b"new").public_key == b"new"
+    assert cache.get("c2", "bob", lambda: b"unused").public_key == b"k2"
+
+
+def test_verification_reuses_parsed_key():
+    public_key = _cose_p256_public_key()
+    cache = PublicKeyCache(maxsize=10)
+    key = cache.get("c1", "alice", lambda: public_key)
+
+    with use(key):
+        decoded = verify_module.decode_credential_public_key(public_key)
+        crypto = verify_module.decoded_public_key_to_cryptography(decoded)
+        assert verify_module.decode_credential_public_key(public_key) is decoded
+        assert verify_module.decoded_public_key_to_cryptography(decoded) is crypto
+
+    # outside of use() keys are parsed as usual
+    assert verify_module.decode_credential_public_key(public_key) is not decoded
+    assert verify_module.decode_credential_public_key(public_key) == (
+        decode_credential_public_key(public_key)
+    )
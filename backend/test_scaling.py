@@ -0,0 +1,46 @@
+import pytest
+
+import app.db as db
+from benchmarks import bench_scaling
+from benchmarks.bench_scaling import OPERATIONS, complexity_failures, fit_exponent, measure
+
+SIZES = (200, 4000)
+LOOKUPS = [op for op in OPERATIONS if op.name in ("get_by_id", "find_user_by_credential_id")]
+
+
+@pytest.fixture(autouse=True)
+def small_runs(monkeypatch):
+    monkeypatch.setattr(bench_scaling, "CALLS", 200)
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+
+
+def test_fit_exponent():
+    assert fit_exponent({1000: 2e-6, 10000: 2e-6, 100000: 2e-6}) == pytest.approx(0.0)
+    assert fit_exponent({1000: 1e-3, 10000: 1e-2, 100000: 1e-1}) == pytest.approx(1.0)
+
+
+def test_lookups_are_constant_time():
+    results = measure(SIZES, LOOKUPS)
+    assert complexity_failures(results, 0.5, LOOKUPS) == []
+
+
+def test_linear_scan_is_caught(monkeypatch):
+    def linear_scan(credential_id):
+        raw_id = db.decode_credential_id(credential_id)
+        for user_id, user in db.userdb.items():
+            if any(c.credential_id == raw_id for c in user.credentials):
+                return user_id
+        return None
+
+    monkeypatch.setattr(db, "find_user_id_by_credential_id", linear_scan)
+    results = measure(SIZES, LOOKUPS)
+    (failure,) = complexity_failures(results, 0.5, LOOKUPS)
+    assert failure.startswith("find_user_by_credential_id:")
+
+
+def test_measure_restores_the_store():
+    userdb, store = db.userdb, db.store
+    measure(SIZES[:1], LOOKUPS)
+    assert db.userdb is userdb
+    assert db.store is store
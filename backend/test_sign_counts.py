@@ -0,0 +1,122 @@
+import pytest
+
+import app.db as db
+from app.db import Credential
+from app.model import b64encode_no_pad
+from app.sign_counts import SignCountTracker
+from app.users import User
+
+
+@pytest.fixture
+def json_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "USERDB_FILE", str(tmp_path / "userdb.json"))
+    monkeypatch.setattr(db, "userdb", {})
+    monkeypatch.setattr(db, "store", db.JsonUserStore())
+    user = User("alice", "pw")
+    user.create()
+    user.update_credential(
+        Credential(credential_id=b"\x01", public_key=b"pk", sign_count=3, transports=[])
+    )
+    return b64encode_no_pad(b"\x01")
+
+
+def test_hot_value_is_authoritative_until_flushed(json_store):
+    cred_id = json_store
+    tracker = SignCountTracker(interval=3600, clock=lambda: 1234.0)
+
+    stored = User.get_by_id("alice").get_sign_count(cred_id)
+    assert tracker.current(cred_id, stored) == 3
+
+    tracker.record("alice", cred_id, 4)
+    tracker.record("alice", cred_id, 5)
+    # the store still has the old counter, the tracker answers the new one
+    assert User.get_by_id("alice").get_sign_count(cred_id) == 3
+    assert tracker.current(cred_id, 3) == 5
+    assert tracker.pending() == 1
+
+    tracker.close()
+    assert tracker.pending() == 0
+    assert tracker.flushes == 1
+
+    # survives a restart of the store
+    db.userdb = db.load_userdb()
+    record = db.store.get_user("alice").credentials[0]
+    assert record.sign_count == 5
+    assert record.last_used == 1234.0
+
+
+def test_older_counter_does_not_overwrite_newer(json_store):
+    cred_id = json_store
+    tracker = SignCountTracker(interval=3600)
+    tracker.record("alice", cred_id, 9)
+    tracker.record("alice", cred_id, 7)
+    assert tracker.current(cred_id, 0) == 9
+
+
+def test_failed_flush_is_retried(json_store, monkeypatch):
+    cred_id = json_store
+    tracker = SignCountTracker(interval=3600)
+    tracker.record("alice", cred_id, 8)
+
+    store = db.store
+
+    class FailingStore:
+        def update_sign_counts(self, updates, wait=True):
+            raise OSError("disk full")
+
+    monkeypatch.setattr(db, "store", FailingStore())
+    with pytest.raises(OSError):
+        tracker.flush()
+    assert tracker.pending() == 1
+
+    monkeypatch.setattr(db, "store", store)
+    tracker.flush()
+    assert db.store.get_user("alice").credentials[0].sign_count == 8
+
+
+def test_zero_interval_writes_through(json_store):
+    tracker = SignCountTracker(interval=0)
+    tracker.record("alice", json_store, 6)
+    assert tracker.pending() == 0
+    assert db.store.get_user("alice").credentials[0].sign_count == 6
+
+
+def test_flushed_entries_are_dropped(json_store, monkeypatch):
+    cred_id = json_store
+    tracker = SignCountTracker(interval=3600)
+    tracker.record("alice", cred_id, 4)
+    tracker.flush()
+    assert tracker._hot == {}
+    # the store answers the flushed value from now on
+    stored = User.get_by_id("alice").get_sign_count(cred_id)
+    assert tracker.current(cred_id, stored) == 4
+
+    # a newer counter recorded during a flush stays until it is flushed itself
+    store = db.store
+
+    class RecordingStore:
+        def update_sign_counts(self, updates, wait=True):
+            store.update_sign_counts(updates, wait)
+            tracker.record("alice", cred_id, 6)
+
+    tracker.record("alice", cred_id, 5)
+    monkeypatch.setattr(db, "store", RecordingStore())
+    tracker.flush()
+    monkeypatch.setattr(db, "store", store)
+    assert tracker.current(cred_id, 5) == 6
+    tracker.flush()
+    assert tracker._hot == {}
+
+
+def test_record_rejects_a_counter_not_above_the_current_one(json_store):
+    cred_id = json_store
+    tracker = SignCountTracker(interval=3600)
+    # two logins verified against the same stored count 3
+    assert tracker.record("alice", cred_id, 4, stored=3)
+    assert not tracker.record("alice", cred_id, 4, stored=3)
+    assert not tracker.record("alice", cred_id, 3, stored=3)
+    assert tracker.current(cred_id, 3) == 4
+
+    # authenticators without a counter always send 0
+    assert tracker.record("bob", "no-counter", 0)
+    assert tracker.record("bob", "no-counter", 0)
@@ -0,0 +1,25 @@
+import random
+
+from app import sorted_ids
+from app.sorted_ids import SortedIds
+
+
+def test_inserts_and_pages_match_a_sorted_list(monkeypatch):
+    monkeypatch.setattr(sorted_ids, "BLOCK_SIZE", 4)
+    rng = random.Random(0)
+    ids = SortedIds(f"u{n:03d}" for n in rng.sample(range(1000), 30))
+    expected = set(ids)
+    for n in rng.sample(range(1000), 200):
+        ids.add(f"u{n:03d}")
+        expected.add(f"u{n:03d}")
+    ids.update(f"v{n}" for n in range(10))
+    expected.update(f"v{n}" for n in range(10))
+    ids.add("v0")  # already there
+
+    ordered = sorted(expected)
+    assert list(ids) == ordered
+    assert len(ids) == len(ordered)
+    assert all(len(block) < 8 for block in ids._blocks)
+    for after in (None, "", "u500", ordered[17], "v9", "w"):
+        start = 0 if after is None else sum(1 for i in ordered if i <= after)
+        assert ids.slice_after(after, 9) == ordered[start : start + 9]